@@ -1,12 +1,37 @@
 import os
+import io
+import time
+import bisect
+import cProfile
+import pstats
+import csv
 import json
+import codecs
+import base64
+import operator
+import re
 import logging
 import math
-from typing import List, Dict, Any, Tuple
-
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+import zlib
+import gzip
+import hashlib
+import heapq
+import queue
+import sqlite3
+import sys
+import types
+import atexit
+import threading
+import tracemalloc
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import List, Dict, Any, Tuple, Optional
+
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, send_from_directory, abort
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import text, event
+from sqlalchemy.orm import Session
 from flask_cors import CORS
 
 import numpy as np
@@ -22,6 +47,7 @@ from datetime import datetime
 import math
 from random import shuffle
 from sklearn.cluster import KMeans
+from sklearn.neighbors import BallTree
 
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
@@ -68,6 +94,10 @@ class City(db.Model):
     lat = db.Column(db.Float, nullable=False)
     lng = db.Column(db.Float, nullable=False)
 
+    # Dataset version: bumped in the same transaction as any change to the
+    # city or its sites, so it can key caches and HTTP validators.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
     def __init__(self, name, lat, lng):
         self.name = name
         self.lat = lat
@@ -75,6 +105,10 @@ class City(db.Model):
 
 class Site(db.Model):
     __tablename__ = "site"
+    __table_args__ = (
+        # Serves per-city listings ordered by name (admin keyset pagination)
+        db.Index("ix_site_city_name", "city_id", "name", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -143,6 +177,10 @@ class User(db.Model):
 
 class Trip(db.Model):
     __tablename__ = "trips"
+    __table_args__ = (
+        # Serves per-user history ordered by newest first (keyset pagination)
+        db.Index("ix_trips_user_id_id", "user_id", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     city = db.Column(db.String(100))
@@ -152,10 +190,196 @@ class Trip(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     user = db.relationship("User", backref=db.backref("trips", lazy=True))
 
-    def __init__(self, city, days, user_id=None):
+    # Content-addressed reference to the itinerary generated for this trip
+    snapshot_digest = db.Column(db.String(64), index=True)
+
+    def __init__(self, city, days, user_id=None, created_at=None, snapshot_digest=None):
         self.city = city
         self.days = days
         self.user_id = user_id
+        self.snapshot_digest = snapshot_digest
+        if created_at is not None:
+            self.created_at = created_at
+
+
+class ItinerarySnapshot(db.Model):
+    """
+    zlib-compressed JSON of a generated itinerary, keyed by the SHA-256 of
+    its canonical JSON.  Identical itineraries (same city, days and data)
+    share one row no matter how many trips reference them.
+    """
+    __tablename__ = "itinerary_snapshots"
+
+    digest = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, digest, data):
+        self.digest = digest
+        self.data = data
+
+
+class CatalogChange(db.Model):
+    """
+    One change to a city's catalog, stamped with the dataset version it
+    produced.  Versions are contiguous from a city's first logged change,
+    so anything derived at version v can catch up by replaying the rows
+    after v instead of rebuilding.
+    """
+    __tablename__ = "catalog_changes"
+    __table_args__ = (
+        db.Index("ix_catalog_changes_city_version", "city_id", "version"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    city_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    # added | moved | updated | removed (a site), or city (the city row)
+    op = db.Column(db.String(16), nullable=False)
+    site_id = db.Column(db.Integer)
+    # Position after the change (added / moved)
+    lat = db.Column(db.Float)
+    lng = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"version": self.version, "op": self.op, "site_id": self.site_id, "lat": self.lat, "lng": self.lng}
+
+
+def encode_snapshot(itinerary: Dict[str, Any]) -> Tuple[str, bytes]:
+    """Returns (digest, compressed_bytes) for an itinerary dict."""
+    raw = json.dumps(itinerary, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest(), zlib.compress(raw, 6)
+
+
+def decode_snapshot(data: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+# --------------------------------------------------
+# Dataset Versioning
+# --------------------------------------------------
+
+@event.listens_for(Session, "before_flush")
+def _bump_city_versions(session, flush_context, instances):
+    """Increment City.version for every city whose row or sites are changing."""
+    city_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Site):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            city_ids.add(obj.city_id)
+            # A site moved to another city changes the old city as well
+            city_ids.update(db.inspect(obj).attrs.city_id.history.deleted or ())
+        elif isinstance(obj, City) and obj in session.dirty:
+            changed = {
+                attr.key for attr in db.inspect(obj).attrs
+                if attr.history.has_changes()
+            }
+            if changed - {"version", "sites"}:
+                city_ids.add(obj.id)
+
+    with session.no_autoflush:
+        for city_id in city_ids:
+            if city_id is None:
+                continue
+            city = session.get(City, city_id)
+            if city is not None and city not in session.deleted:
+                # SQL-side increment: concurrent writers cannot lose a bump
+                city.version = City.version + 1
+
+
+def _site_change(session, site: "Site") -> List[Tuple[int, str]]:
+    """(city_id, op) pairs for one flushed site."""
+    if site in session.new:
+        return [(site.city_id, "added")]
+    state = db.inspect(site)
+    old_city = state.attrs.city_id.history.deleted
+    if site in session.deleted:
+        return [((old_city or [site.city_id])[0], "removed")]
+    if old_city and old_city[0] != site.city_id:
+        return [(old_city[0], "removed"), (site.city_id, "added")]
+    if state.attrs.latitude.history.has_changes() or state.attrs.longitude.history.has_changes():
+        return [(site.city_id, "moved")]
+    return [(site.city_id, "updated")]
+
+
+@event.listens_for(Session, "after_flush")
+def _log_catalog_changes(session, flush_context):
+    """Append a CatalogChange row per site or city changed by this flush."""
+    changes = []
+    deleted_cities = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Site):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            for city_id, op in _site_change(session, obj):
+                position = (obj.latitude, obj.longitude) if op in ("added", "moved") else (None, None)
+                changes.append((city_id, op, obj.id, *position))
+        elif isinstance(obj, City):
+            if obj in session.deleted:
+                deleted_cities.add(obj.id)
+            elif obj in session.dirty and any(
+                attr.history.has_changes() for attr in db.inspect(obj).attrs if attr.key not in ("version", "sites")
+            ):
+                changes.append((obj.id, "city", None, None, None))
+
+    conn = session.connection()
+    if deleted_cities:
+        conn.execute(CatalogChange.__table__.delete().where(CatalogChange.city_id.in_(deleted_cities)))
+    changes = [c for c in changes if c[0] is not None and c[0] not in deleted_cities]
+    if not changes:
+        return
+    # The versions as bumped by this flush (an SQL expression until now)
+    versions = dict(conn.execute(
+        db.select(City.id, City.version).where(City.id.in_({c[0] for c in changes}))
+    ).all())
+    now = datetime.utcnow()
+    conn.execute(CatalogChange.__table__.insert(), [
+        {"city_id": city_id, "version": versions[city_id], "op": op, "site_id": site_id,
+         "lat": lat, "lng": lng, "created_at": now}
+        for city_id, op, site_id, lat, lng in changes if city_id in versions
+    ])
+
+
+def catalog_changes(city_id: int, since: int, current: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Changes taking the city from version `since` to `current`, oldest
+    first, or None if the log does not reach back that far (the city
+    predates the log): the caller must rebuild from scratch.
+    """
+    if since >= current:
+        return []
+    first = db.session.query(db.func.min(CatalogChange.version)).filter(CatalogChange.city_id == city_id).scalar()
+    if first is None or since < first - 1:
+        return None
+    rows = (CatalogChange.query
+            .filter(CatalogChange.city_id == city_id, CatalogChange.version > since, CatalogChange.version <= current)
+            .order_by(CatalogChange.id))
+    return [row.to_dict() for row in rows]
+
+
+# --------------------------------------------------
+# Catalog Change Hooks
+# --------------------------------------------------
+
+# Callbacks run after a city's catalog (the city row or any of its sites)
+# has been committed.  Anything derived from the catalog registers here.
+CITY_CHANGE_HOOKS = []
+
+def on_city_change(func):
+    """Decorator: register func(city_id) as a catalog invalidation hook."""
+    CITY_CHANGE_HOOKS.append(func)
+    return func
+
+def invalidate_city_caches(*city_ids):
+    """Run every change hook once per affected city (call after commit)."""
+    for city_id in set(city_ids):
+        for hook in CITY_CHANGE_HOOKS:
+            try:
+                hook(city_id)
+            except Exception as e:
+                logger.error(f"❌ Cache invalidation hook {hook.__name__} failed for city {city_id}: {e}")
 
 
 def seed_data():
@@ -262,6 +486,26 @@ def sync_db_schema():
             # Sync Site table (ensure newest features are present in Prod)
             ensure_column("site", "description", "TEXT")
             ensure_column("site", "image_url", "VARCHAR(255)")
+
+            # Sync City table
+            ensure_column("cities", "version", "INTEGER NOT NULL DEFAULT 1")
+
+            # Sync Trip table
+            ensure_column("trips", "snapshot_digest", "VARCHAR(64)")
+
+            # Indexes added after the tables were first created
+            def ensure_index(index_name, table_name, columns):
+                try:
+                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})"))
+                    conn.commit()
+                except Exception as e:
+                    if is_postgres:
+                        conn.rollback()
+                    logger.error(f"❌ Failed to create index '{index_name}': {e}")
+
+            ensure_index("ix_site_city_name", "site", "city_id, name, id")
+            ensure_index("ix_trips_user_id_id", "trips", "user_id, id")
+            ensure_index("ix_trips_snapshot_digest", "trips", "snapshot_digest")
             
     except Exception as e:
         logger.error(f"❌ Schema sync connection failed: {e}")
@@ -296,6 +540,159 @@ def login_required(func):
         return func(*args, **kwargs)
     return wrapper
 
+def session_is_admin() -> bool:
+    user_id = session.get("user_id")
+    user = db.session.get(User, user_id) if user_id else None
+    return bool(user and user.is_admin)
+
+def encode_cursor(values) -> str:
+    """Opaque, URL-safe page cursor for a keyset tuple (datetimes as ISO strings)."""
+    raw = json.dumps(list(values), separators=(",", ":"), default=lambda v: v.isoformat()).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, types: tuple):
+    """
+    The keyset tuple of an encode_cursor() cursor, or None without one.
+    The client can send anything, so it must hold exactly one value of
+    each of types, in order (e.g. (str, int) for name + id), or
+    ValueError is raised before any of it reaches SQL.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Malformed page cursor") from e
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Malformed page cursor")
+    decoded = []
+    for value, kind in zip(values, types):
+        if kind is datetime and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        # Exact type: JSON true/false would pass isinstance(value, int)
+        elif type(value) is not kind:
+            raise ValueError("Malformed page cursor")
+        decoded.append(value)
+    return tuple(decoded)
+
+def _seek_condition(keys, values, descending):
+    # (k1, k2, ...) > (v1, v2, ...) expanded into OR/AND terms, since
+    # row-value comparisons are not portable across SQLite versions.
+    compare = operator.lt if descending else operator.gt
+    clauses = []
+    for i, (key, value) in enumerate(zip(keys, values)):
+        equal_prefix = [keys[j] == values[j] for j in range(i)]
+        clauses.append(db.and_(*equal_prefix, compare(key, value)))
+    return db.or_(*clauses)
+
+def keyset_page(query, keys, page_size, after=None, before=None, descending=False):
+    """
+    Seek pagination over a unique key tuple (last key must be the primary key).
+    `after` is the cursor of the last row of the previous page, `before` the
+    first row of the following page.  Every page costs one index range scan,
+    however deep it is.  Returns (rows, has_prev, has_next).
+    """
+    forward = before is None
+    cursor = after if forward else before
+    scan_descending = descending if forward else not descending
+
+    if cursor is not None and len(cursor) == len(keys):
+        query = query.filter(_seek_condition(keys, cursor, scan_descending))
+    else:
+        cursor = None
+    order = [key.desc() if scan_descending else key.asc() for key in keys]
+    rows = query.order_by(*order).limit(page_size + 1).all()
+
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if forward:
+        return rows, cursor is not None, more
+    rows.reverse()
+    return rows, more, cursor is not None
+
+
+class SingleFlightTimeout(Exception):
+    """A waiter gave up before the in-flight call for its key finished."""
+
+
+class _FlightCall:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller (the
+    leader) runs fn, later callers wait for and share its result, or get
+    its exception re-raised.  Nothing is cached once the call finishes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, _FlightCall] = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "timeouts": 0, "errors": 0}
+
+    def in_flight(self, key) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, fn, timeout: float = None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if leader:
+            self._run(key, call, fn)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        if not call.done.wait(timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise SingleFlightTimeout(f"{self.name}: timed out waiting for {key!r}")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def spawn(self, key, fn, name: str = None) -> _FlightCall:
+        """
+        Like do(), but a leader runs fn on a daemon thread and every caller
+        gets the call back at once, to wait on (call.done) or to ignore.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.stats["coalesced"] += 1
+                return call
+            call = self._calls[key] = _FlightCall()
+            self.stats["leaders"] += 1
+        threading.Thread(target=self._run, args=(key, call, fn), daemon=True, name=name).start()
+        return call
+
+    def _run(self, key, call: _FlightCall, fn):
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self.stats["errors"] += 1
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
 def haversine(lat1, lon1, lat2, lon2):
     lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
     dlat = lat2 - lat1
@@ -313,6 +710,374 @@ def fallback_segment(o, d):
     ]]
 
 
+# --------------------------------------------------
+# Metrics (Prometheus text format)
+# --------------------------------------------------
+
+class Histogram:
+    """
+    Cumulative-bucket histogram keyed by one label.  observe() is a bisect
+    plus three additions under a lock, cheap enough to leave on in
+    production.
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label value -> [bucket counts..., +Inf count, sum]
+        self._series: Dict[str, list] = {}
+
+    def observe(self, label_value: str, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for label_value, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._lock = threading.Lock()
+        self._values: Dict[str, float] = {}
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value: str) -> float:
+        return self._values.get(label_value, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f'{self.name}{{{self.label}="{k}"}} {v}' for k, v in items]
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "itinerary_stage_seconds", "Time spent per itinerary pipeline stage.", "stage"
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Cache lookups by cache and result (hit/miss).", "cache"
+)
+ROUTING_ADMISSIONS = Counter(
+    "routing_admissions_total", "Full-routing requests by admission result (admitted/shed).", "result"
+)
+DEGRADED_LEGS = Counter(
+    "routing_degraded_legs_total", "Route legs not routed on the graph, by reason (deadline/shed/error/outdated).", "reason"
+)
+DAY_ORDERINGS = Counter(
+    "day_orderings_total", "Days ordered, by whether the solver converged, used up its work budget or hit its time limit.",
+    "outcome"
+)
+AUTOCOMPLETE_SECONDS = Histogram(
+    "autocomplete_seconds", "Autocomplete lookups, by whether trigram matching ran (fuzzy) or prefixes sufficed (prefix).", "path",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25, 1, 5)
+)
+# name -> callable returning the current value; registered next to the state
+METRIC_GAUGES: Dict[str, Tuple[str, Any]] = {}
+METRIC_COUNTERS: Dict[str, Tuple[str, Any]] = {}
+
+
+def observe_stage(stage: str, started: float):
+    """Record time.perf_counter() - started for a pipeline stage."""
+    STAGE_SECONDS.observe(stage, time.perf_counter() - started)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(f"{cache}_{'hit' if hit else 'miss'}")
+
+
+def register_gauge(name: str, help_text: str, func):
+    METRIC_GAUGES[name] = (help_text, func)
+
+
+def register_counter(name: str, help_text: str, func):
+    """Like register_gauge(), for a total that only ever goes up."""
+    METRIC_COUNTERS[name] = (help_text, func)
+
+
+def render_metrics() -> str:
+    lines = (STAGE_SECONDS.render() + CACHE_REQUESTS.render() + ROUTING_ADMISSIONS.render() + DEGRADED_LEGS.render()
+             + DAY_ORDERINGS.render() + AUTOCOMPLETE_SECONDS.render())
+    for kind, registry in (("counter", METRIC_COUNTERS), ("gauge", METRIC_GAUGES)):
+        for name, (help_text, func) in sorted(registry.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+# --------------------------------------------------
+# Memory Accounting
+# --------------------------------------------------
+
+# Routing is off on Render because nobody knew what a city graph costs out
+# of the 512 MB.  Every graph load now records what it added, and a load
+# that is projected to cross MEMORY_CEILING_MB is logged (and shown on the
+# admin dashboard) before it starts.
+MEMORY_CEILING_MB = float(os.environ.get("MEMORY_CEILING_MB", 460))
+# Opt-in: tracemalloc slows a load down noticeably while it is tracing
+TRACEMALLOC_GRAPH_LOADS = os.environ.get("TRACEMALLOC_GRAPH_LOADS", "false").lower() == "true"
+TRACEMALLOC_TOP = 10
+
+# Projection defaults until real loads have been measured: resident MB per
+# MB of GraphML on disk (a 4.8 MB synthetic grid cost ~46 MB of RSS), and
+# per km² of a fresh download.
+GRAPH_MB_PER_FILE_MB = float(os.environ.get("GRAPH_MB_PER_FILE_MB", 10.0))
+GRAPH_MB_PER_KM2 = float(os.environ.get("GRAPH_MB_PER_KM2", 0.15))
+
+# city_key -> measurements of the load that produced GRAPH_CACHE[city_key]
+GRAPH_MEMORY: Dict[str, Dict[str, Any]] = {}
+MEMORY_WARNINGS: "deque[Dict[str, str]]" = deque(maxlen=20)
+_memory_observations = {"per_file_mb": [], "per_km2": []}
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def process_rss_mb() -> Optional[float]:
+    """Current resident set size of this process (Linux /proc), else None."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def deep_sizeof(root) -> int:
+    """
+    Approximate bytes reachable from root: containers, instance
+    attributes, NumPy buffers, BallTree arrays and Shapely coordinates.
+    Shared objects are counted once; classes and modules not at all.
+    """
+    skip = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+    seen = set()
+    stack = [root]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, skip):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+            continue
+        if isinstance(obj, np.ndarray):
+            if obj.base is not None:
+                stack.append(obj.base)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif type(obj).__module__.startswith("shapely"):
+            # Coordinates live in GEOS, outside the Python heap
+            import shapely
+            total += 16 * int(shapely.get_num_coordinates(obj))
+        elif hasattr(obj, "get_arrays"):
+            # sklearn BallTree keeps its data in typed memoryviews
+            stack.extend(a for a in obj.get_arrays() if isinstance(a, np.ndarray))
+        else:
+            if hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+            for slot in getattr(type(obj), "__slots__", ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return total
+
+
+def project_graph_mb(file_bytes: int = None, area_km2: float = None) -> Optional[float]:
+    """Expected resident cost of a graph load, from earlier loads where possible."""
+    if file_bytes:
+        observed = _memory_observations["per_file_mb"]
+        ratio = sum(observed) / len(observed) if observed else GRAPH_MB_PER_FILE_MB
+        return file_bytes / (1024 * 1024) * ratio
+    if area_km2:
+        observed = _memory_observations["per_km2"]
+        ratio = sum(observed) / len(observed) if observed else GRAPH_MB_PER_KM2
+        return area_km2 * ratio
+    return None
+
+
+def memory_warning(message: str):
+    logger.warning(f"⚠️ {message}")
+    MEMORY_WARNINGS.appendleft({"at": datetime.utcnow().isoformat(timespec="seconds") + "Z", "message": message})
+
+
+@contextmanager
+def measure_graph_load(city_key: str, source: str, file_bytes: int = None, area_km2: float = None):
+    """
+    Wraps one graph load.  The caller stores the loaded graph in
+    load["graph"]; on exit the RSS delta is recorded in
+    GRAPH_MEMORY[city_key], plus the deep size and top tracemalloc
+    allocators when TRACEMALLOC_GRAPH_LOADS is on.
+    """
+    global _tracemalloc_users
+    projected = project_graph_mb(file_bytes, area_km2)
+    rss_before = process_rss_mb()
+    if projected is not None and rss_before is not None and rss_before + projected > MEMORY_CEILING_MB:
+        memory_warning(
+            f"Loading the {city_key} graph ({source}) is projected to add {projected:.0f} MB "
+            f"to {rss_before:.0f} MB, over the {MEMORY_CEILING_MB:.0f} MB ceiling"
+        )
+
+    before_snapshot = None
+    if TRACEMALLOC_GRAPH_LOADS:
+        with _tracemalloc_lock:
+            if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+            _tracemalloc_users += 1
+        before_snapshot = tracemalloc.take_snapshot()
+
+    load: Dict[str, Any] = {}
+    started = time.perf_counter()
+    try:
+        yield load
+    finally:
+        top_allocators = []
+        if before_snapshot is not None:
+            after_snapshot = tracemalloc.take_snapshot()
+            for stat in after_snapshot.compare_to(before_snapshot, "lineno")[:TRACEMALLOC_TOP]:
+                frame = stat.traceback[0]
+                top_allocators.append({
+                    "where": f"{frame.filename}:{frame.lineno}",
+                    "size_mb": round(stat.size_diff / (1024 * 1024), 2),
+                    "count": stat.count_diff,
+                })
+            with _tracemalloc_lock:
+                _tracemalloc_users -= 1
+                if _tracemalloc_users == 0:
+                    tracemalloc.stop()
+
+    G = load.get("graph")
+    if G is None:
+        return
+    rss_after = process_rss_mb()
+    rss_delta = rss_after - rss_before if rss_after is not None and rss_before is not None else None
+    # Walking every node and edge of a city graph takes seconds, so the
+    # deep size is only taken alongside tracemalloc (or on demand from the
+    # admin memory panel, see memory_report).
+    deep_mb = deep_sizeof(G) / (1024 * 1024) if before_snapshot is not None else None
+    GRAPH_MEMORY[city_key] = {
+        "city": city_key,
+        "source": source,
+        "nodes": len(G.nodes),
+        "edges": len(G.edges),
+        "file_mb": round(file_bytes / (1024 * 1024), 2) if file_bytes else None,
+        "area_km2": round(area_km2, 1) if area_km2 else None,
+        "projected_mb": round(projected, 1) if projected is not None else None,
+        "rss_delta_mb": round(rss_delta, 1) if rss_delta is not None else None,
+        "deep_size_mb": round(deep_mb, 1) if deep_mb is not None else None,
+        "seconds": round(time.perf_counter() - started, 2),
+        "traced": before_snapshot is not None,
+        "loaded_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "top_allocators": top_allocators,
+    }
+
+    # Under tracemalloc the RSS delta mostly measures tracemalloc itself,
+    # so project with the deep size there and the RSS delta otherwise.
+    cost_mb = deep_mb if deep_mb is not None else rss_delta
+    if cost_mb and cost_mb > 0:
+        if file_bytes:
+            _memory_observations["per_file_mb"].append(cost_mb / (file_bytes / (1024 * 1024)))
+        if area_km2:
+            _memory_observations["per_km2"].append(cost_mb / area_km2)
+    deep_note = f"~{deep_mb:.0f} MB deep, " if deep_mb is not None else ""
+    logger.info(f"🧮 Graph {city_key} ({source}): {len(G.nodes)} nodes, {deep_note}RSS {rss_delta if rss_delta is not None else float('nan'):+.0f} MB")
+    if rss_after is not None and rss_after > MEMORY_CEILING_MB:
+        memory_warning(f"RSS is {rss_after:.0f} MB after loading the {city_key} graph, over the {MEMORY_CEILING_MB:.0f} MB ceiling")
+
+
+def graph_resident_mb(measurement: Dict[str, Any]) -> float:
+    """Best estimate of what a loaded graph costs: deep size if taken, else the RSS delta."""
+    if measurement.get("deep_size_mb") is not None:
+        return measurement["deep_size_mb"]
+    return max(measurement.get("rss_delta_mb") or 0.0, 0.0)
+
+
+def memory_report(deep: bool = False) -> Dict[str, Any]:
+    """
+    Everything the admin memory panel shows.  Cache sizes need a walk of
+    every entry, so they are only measured when deep is set (the panel's
+    "Measure sizes" link); otherwise just the entry counts are reported.
+    """
+    def size_mb(obj):
+        return round(deep_sizeof(obj) / (1024 * 1024), 2) if deep else None
+
+    if deep:
+        for key, G in list(GRAPH_CACHE.items()):
+            if key in GRAPH_MEMORY:
+                GRAPH_MEMORY[key]["deep_size_mb"] = round(deep_sizeof(G) / (1024 * 1024), 1)
+    # The index is patched in place: walk it only while nothing changes it
+    with _autocomplete_lock:
+        autocomplete_entries = len(AUTOCOMPLETE) if AUTOCOMPLETE else 0
+        autocomplete_mb = size_mb(AUTOCOMPLETE) if AUTOCOMPLETE else 0
+    caches = [
+        {"name": "Road graphs", "entries": len(GRAPH_CACHE),
+         "size_mb": round(sum(graph_resident_mb(m) for k, m in GRAPH_MEMORY.items() if k in GRAPH_CACHE), 1)},
+        {"name": "Site catalog (spatial index)", "entries": len(SPATIAL_INDEX),
+         "size_mb": size_mb(dict(SPATIAL_INDEX))},
+        {"name": "Autocomplete index", "entries": autocomplete_entries, "size_mb": autocomplete_mb},
+        {"name": "Day routes", "entries": len(DAY_ROUTE_CACHE),
+         "size_mb": size_mb(dict(DAY_ROUTE_CACHE))},
+        {"name": "Day orders", "entries": len(DAY_ORDER_CACHE),
+         "size_mb": size_mb(dict(DAY_ORDER_CACHE))},
+        {"name": "Route legs", "entries": len(LEG_CACHE),
+         "size_mb": size_mb(dict(LEG_CACHE))},
+        {"name": "Shared cache fallback (local)", "entries": len(SHARED_CACHE.local),
+         "size_mb": size_mb(dict(SHARED_CACHE.local))},
+        # Memory-mapped: the file size is an upper bound on what is resident
+        {"name": "Leg stores (mapped)", "entries": sum(1 for _, store in LEG_STORES.values() if store),
+         "size_mb": round(sum(store.nbytes() for _, store in LEG_STORES.values() if store) / (1024 * 1024), 2)},
+    ]
+    rss = process_rss_mb()
+    return {
+        "rss_mb": round(rss, 1) if rss is not None else None,
+        "ceiling_mb": MEMORY_CEILING_MB,
+        "tracemalloc": TRACEMALLOC_GRAPH_LOADS,
+        "deep": deep,
+        "caches": caches,
+        "graphs": sorted(GRAPH_MEMORY.values(), key=lambda m: m["city"]),
+        "warnings": list(MEMORY_WARNINGS),
+    }
+
+
+register_gauge("process_resident_memory_bytes", "Resident memory of this process.",
+               lambda: int((process_rss_mb() or 0) * 1024 * 1024))
+register_gauge("graph_cache_bytes", "Estimated size of the road graphs in memory.",
+               lambda: int(sum(graph_resident_mb(m) for k, m in GRAPH_MEMORY.items() if k in GRAPH_CACHE) * 1024 * 1024))
+
+
 GRAPH_CACHE = {}
 
 # CRITICAL SETTING: Disable graph download on Render Free Tier to prevent OOM
@@ -336,11 +1101,52 @@ if ENABLE_ROUTING_GRAPH:
 
 
 
-def get_city_graph(city_name: str, places: list = None, city_lat: float = None, city_lng: float = None):
+class GraphLoading(Exception):
+    """get_city_graph(wait=False): the graph is not in memory yet."""
+
+
+GRAPH_LOAD_TIMEOUT = float(os.environ.get("GRAPH_LOAD_TIMEOUT", 90))
+# Where downloaded road graphs are kept as GraphML, one file per city
+GRAPH_CACHE_DIR = os.environ.get("GRAPH_CACHE_DIR", "graph_cache")
+# A site closer than this to the edge of a graph's box is not covered
+GRAPH_COVERAGE_MARGIN_M = float(os.environ.get("GRAPH_COVERAGE_MARGIN_M", 1000))
+# Graphs older than this are rebuilt in the background (0: never)
+GRAPH_MAX_AGE_DAYS = float(os.environ.get("GRAPH_MAX_AGE_DAYS", 90))
+# After a rebuild that failed, or that still left sites uncovered (they may
+# lie past the 80 km download limit, or off the road network), no other
+# rebuild of that city starts for this long
+GRAPH_REBUILD_BACKOFF_SECONDS = float(os.environ.get("GRAPH_REBUILD_BACKOFF_SECONDS", 3600))
+GRAPH_KEEP_VERSIONS = 2
+# Padding beyond the outermost place, and the largest download radius
+GRAPH_BUFFER_M = 5000
+GRAPH_MAX_RADIUS_M = 80000
+# One load per city at a time; concurrent callers share it
+graph_flight = SingleFlight("graph")
+# city_key -> manifest of the artifact GRAPH_CACHE[city_key] was loaded from
+GRAPH_MANIFESTS: Dict[str, Dict[str, Any]] = {}
+# city_key -> (mtime, manifest) of the artifact on disk, shared by every worker
+_published_graph_manifests: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
+# city_key -> {"at", "ok", "improved"} of the last background rebuild
+GRAPH_REBUILDS: Dict[str, Dict[str, Any]] = {}
+
+
+def get_city_graph(city_name: str, places: list = None, city_lat: float = None, city_lng: float = None, wait: bool = True,
+                   timeout: float = None):
     """
     Download (or load from cache) a road-network graph that covers all
     the given places.  Uses a tight bounding-box download so the graph
     is as small as possible while still including every waypoint.
+
+    Concurrent callers for the same city share a single load.  With
+    wait=False a caller never blocks: if the graph is not in memory the
+    load is started in the background and GraphLoading is raised, so the
+    caller can fall back to straight lines.  With a timeout (seconds) the
+    caller waits at most that long for the load, which then carries on in
+    the background, before GraphLoading is raised.
+
+    A graph that does not cover the places (or is older than
+    GRAPH_MAX_AGE_DAYS) is still returned, and a larger one is built in
+    the background and swapped in when ready.
     """
     if not ENABLE_ROUTING_GRAPH:
         return None
@@ -348,27 +1154,302 @@ def get_city_graph(city_name: str, places: list = None, city_lat: float = None,
     city_key = city_name.lower()
 
     # 1. In-memory cache (fastest)
+    started = time.perf_counter()
+    G = GRAPH_CACHE.get(city_key)
+    if G is not None:
+        record_cache_lookup("graph", True)
+        observe_stage("graph_load_memory", started)
+        if graph_is_outdated(city_key):
+            _reload_published_graph(city_name)
+        else:
+            ensure_graph_coverage(city_name, places, city_lat, city_lng)
+        return G
+    record_cache_lookup("graph", False)
+
+    load = lambda: _load_city_graph(city_name, places, city_lat, city_lng)  # noqa: E731
+
+    if not wait or timeout is not None:
+        call = graph_flight.spawn(city_key, lambda: _log_graph_errors(city_key, load), name=f"GraphLoad-{city_key}")
+        if not wait or not call.done.wait(min(timeout, GRAPH_LOAD_TIMEOUT)):
+            raise GraphLoading(f"Graph for {city_name} is loading")
+        if call.error is not None:
+            raise call.error
+        G = call.result
+    else:
+        G = graph_flight.do(city_key, load, timeout=GRAPH_LOAD_TIMEOUT)
+    ensure_graph_coverage(city_name, places, city_lat, city_lng)
+    return G
+
+
+def graph_cache_path(city_key: str, version: int = None) -> str:
+    """Versioned artifact path; without a version, the pre-manifest file name."""
+    if version is None:
+        return os.path.join(GRAPH_CACHE_DIR, f"{city_key}.graphml")
+    return os.path.join(GRAPH_CACHE_DIR, f"{city_key}.v{version}.graphml")
+
+
+def graph_manifest_path(city_key: str) -> str:
+    return os.path.join(GRAPH_CACHE_DIR, f"{city_key}.json")
+
+
+def read_graph_manifest(city_key: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(graph_manifest_path(city_key), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def published_graph_manifest(city_key: str) -> Optional[Dict[str, Any]]:
+    """The city's manifest on disk, re-read only when the file changes."""
+    try:
+        mtime = os.path.getmtime(graph_manifest_path(city_key))
+    except OSError:
+        return None
+    cached = _published_graph_manifests.get(city_key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    manifest = read_graph_manifest(city_key)
+    _published_graph_manifests[city_key] = (mtime, manifest)
+    return manifest
+
+
+def graph_is_outdated(city_key: str) -> bool:
+    """This worker routes on an older graph than the one published on disk."""
+    loaded = GRAPH_MANIFESTS.get(city_key)
+    published = published_graph_manifest(city_key)
+    return bool(loaded and published and published["version"] != loaded["version"])
+
+
+def _write_atomic(path: str, write):
+    # Write to a temp file and rename, so a crash mid-write can never leave
+    # a truncated file behind for the next load to choke on.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def graph_bbox(G) -> List[float]:
+    """[south, west, north, east] of the graph's nodes."""
+    ys = [data["y"] for _, data in G.nodes(data=True)]
+    xs = [data["x"] for _, data in G.nodes(data=True)]
+    return [min(ys), min(xs), max(ys), max(xs)]
+
+
+def requested_bbox(center: Optional[List[float]], radius_m: Optional[float]) -> Optional[List[float]]:
+    """[south, west, north, east] of the square graph_from_point fetches around center."""
+    if not center or not radius_m:
+        return None
+    dlat = radius_m / 111320
+    dlng = dlat / max(math.cos(math.radians(center[0])), 0.01)
+    return [center[0] - dlat, center[1] - dlng, center[0] + dlat, center[1] + dlng]
+
+
+def graph_covers(manifest: Dict[str, Any], places: list) -> bool:
+    """
+    Every place lies inside the box that was downloaded, at least the
+    margin from its edge.  The requested box, not the nodes' hull: a site
+    in a corner with no roads is as covered as the download can make it.
+    """
+    south, west, north, east = manifest.get("requested_bbox") or manifest["bbox"]
+    dlat = GRAPH_COVERAGE_MARGIN_M / 111320
+    for p in places or []:
+        dlng = dlat / max(math.cos(math.radians(p["lat"])), 0.01)
+        if not (south + dlat <= p["lat"] <= north - dlat and west + dlng <= p["lng"] <= east - dlng):
+            return False
+    return True
+
+
+def graph_is_stale(manifest: Dict[str, Any]) -> bool:
+    if not GRAPH_MAX_AGE_DAYS:
+        return False
+    built_at = datetime.fromisoformat(manifest["built_at"].rstrip("Z"))
+    return (datetime.utcnow() - built_at).total_seconds() > GRAPH_MAX_AGE_DAYS * 86400
+
+
+def ensure_graph_coverage(city_name: str, places: list = None, city_lat: float = None, city_lng: float = None):
+    """Start a background rebuild if the graph in use misses places or is stale."""
+    city_key = city_name.lower()
+    manifest = GRAPH_MANIFESTS.get(city_key)
+    if manifest is None:
+        return
+    if graph_covers(manifest, places) and not graph_is_stale(manifest):
+        return
+    rebuild_key = f"rebuild:{city_key}"
+    if graph_flight.in_flight(rebuild_key):
+        return
+    last = GRAPH_REBUILDS.get(city_key)
+    if last and not (last["ok"] and last["improved"]) and time.time() - last["at"] < GRAPH_REBUILD_BACKOFF_SECONDS:
+        return
+    logger.info(f"🔁 Graph v{manifest['version']} for {city_name} is stale or misses sites; rebuilding in background.")
+    threading.Thread(
+        target=_load_graph_quietly,
+        args=(rebuild_key, lambda: _rebuild_city_graph(city_name, places, city_lat, city_lng)),
+        daemon=True, name=f"GraphRebuild-{city_key}"
+    ).start()
+
+
+def _rebuild_city_graph(city_name: str, places: list = None, city_lat: float = None, city_lng: float = None):
+    """Download a graph covering the old box plus the new places, then hot-swap it."""
+    city_key = city_name.lower()
+    previous = GRAPH_MANIFESTS.get(city_key) or read_graph_manifest(city_key)
+    area = rebuild_area(previous, places) if previous else None
+    try:
+        G, manifest = _download_graph_artifact(city_name, places, city_lat, city_lng, previous, area)
+    except Exception:
+        GRAPH_REBUILDS[city_key] = {"at": time.time(), "ok": False, "improved": False}
+        raise
+    _publish_graph(city_key, G, manifest)
+    improved = graph_covers(manifest, places) and not graph_is_stale(manifest)
+    GRAPH_REBUILDS[city_key] = {"at": time.time(), "ok": True, "improved": improved}
+    if not improved:
+        logger.warning(f"Graph v{manifest['version']} for {city_name} still misses sites; "
+                       f"no rebuild for {GRAPH_REBUILD_BACKOFF_SECONDS:.0f}s.")
+    return G
+
+
+def rebuild_area(previous: Dict[str, Any], places: list) -> Optional[Tuple[Tuple[float, float], int]]:
+    """
+    (center, radius_m) for rebuilding the previous graph: the same square
+    when every place still fits, so a rebuild for staleness downloads the
+    same area; otherwise the same center with the radius grown just enough
+    for the places outside.  The old square stays inside the new one, so
+    no route gets worse.  None when the previous box is unknown.
+    """
+    if previous.get("center") and previous.get("radius_m"):
+        (center_lat, center_lng), radius = previous["center"], previous["radius_m"]
+    elif previous.get("bbox"):
+        # Pre-manifest graph: the square around its nodes' box
+        south, west, north, east = previous["bbox"]
+        center_lat, center_lng = (south + north) / 2, (west + east) / 2
+        radius = max((north - south) / 2 * 111320,
+                     (east - west) / 2 * 111320 * math.cos(math.radians(center_lat)))
+    else:
+        return None
+
+    needed = radius
+    for p in places or []:
+        if graph_covers(previous, [p]):
+            continue
+        dy = abs(p["lat"] - center_lat) * 111320
+        dx = abs(p["lng"] - center_lng) * 111320 * math.cos(math.radians(center_lat))
+        needed = max(needed, max(dx, dy) + GRAPH_COVERAGE_MARGIN_M + GRAPH_BUFFER_M)
+    return (center_lat, center_lng), int(min(math.ceil(needed), max(radius, GRAPH_MAX_RADIUS_M)))
+
+
+def _reload_published_graph(city_name: str):
+    """Swap in, in the background, the newer graph another worker has published."""
+    city_key = city_name.lower()
+    reload_key = f"reload:{city_key}"
+    if graph_flight.in_flight(reload_key):
+        return
+    logger.info(f"🔁 A newer graph for {city_name} was published; loading it in background.")
+    threading.Thread(
+        target=_load_graph_quietly, args=(reload_key, lambda: _load_published_graph(city_key)),
+        daemon=True, name=f"GraphReload-{city_key}"
+    ).start()
+
+
+def _load_published_graph(city_key: str):
+    manifest = read_graph_manifest(city_key)
+    graph_path = os.path.join(GRAPH_CACHE_DIR, manifest["file"])
+    with measure_graph_load(city_key, "disk", file_bytes=os.path.getsize(graph_path)) as load:
+        G = load["graph"] = ox.load_graphml(graph_path)
+    _publish_graph(city_key, G, manifest)
+    return G
+
+
+def _log_graph_errors(city_key, load):
+    try:
+        return load()
+    except Exception as e:
+        logger.error(f"Background graph load failed for {city_key}: {e}")
+        raise
+
+
+def _load_graph_quietly(city_key, load):
+    try:
+        graph_flight.do(city_key, load, timeout=GRAPH_LOAD_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Background graph load failed for {city_key}: {e}")
+
+
+def _load_city_graph(city_name: str, places: list = None, city_lat: float = None, city_lng: float = None):
+    """Runs under graph_flight: at most one per city at any time."""
+    city_key = city_name.lower()
+
+    # A load that finished just before this one started
     if city_key in GRAPH_CACHE:
         return GRAPH_CACHE[city_key]
 
-    # 2. File cache
-    cache_dir = "graph_cache"
-    os.makedirs(cache_dir, exist_ok=True)
-    graph_path = os.path.join(cache_dir, f"{city_key}.graphml")
+    # 2. File cache: the artifact named by the manifest, or a graph
+    #    saved before manifests existed
+    os.makedirs(GRAPH_CACHE_DIR, exist_ok=True)
+    manifest = read_graph_manifest(city_key)
+    graph_path = os.path.join(GRAPH_CACHE_DIR, manifest["file"]) if manifest else graph_cache_path(city_key)
 
+    started = time.perf_counter()
     if os.path.exists(graph_path):
         logger.info(f"Loading graph for {city_name} from disk cache...")
-        G = ox.load_graphml(graph_path)
-        GRAPH_CACHE[city_key] = G
+        with measure_graph_load(city_key, "disk", file_bytes=os.path.getsize(graph_path)) as load:
+            G = load["graph"] = ox.load_graphml(graph_path)
+        if manifest is None:
+            manifest = _legacy_manifest(city_key, G, graph_path)
+        _publish_graph(city_key, G, manifest)
+        observe_stage("graph_load_disk", started)
         return G
 
-    # 3. Fresh download — compute center+radius from places bounding box
-    #    Uses graph_from_point (more compatible than graph_from_bbox across OSMnx versions).
-    logger.info(f"Downloading road graph for {city_name}...")
+    # 3. Fresh download
+    G, manifest = _download_graph_artifact(city_name, places, city_lat, city_lng)
+    _publish_graph(city_key, G, manifest)
+    observe_stage("graph_load_download", started)
+    return G
+
+
+def _legacy_manifest(city_key: str, G, graph_path: str) -> Dict[str, Any]:
+    """Describe a pre-manifest <city>.graphml by what it actually contains."""
+    manifest = {
+        "city": city_key,
+        "version": 0,
+        "file": os.path.basename(graph_path),
+        "bbox": graph_bbox(G),
+        "center": None,
+        "radius_m": None,
+        "site_count": None,
+        "nodes": len(G.nodes),
+        "edges": len(G.edges),
+        "built_at": datetime.utcfromtimestamp(os.path.getmtime(graph_path)).isoformat(timespec="seconds") + "Z",
+    }
+    _write_atomic(graph_manifest_path(city_key), lambda p: _dump_json(manifest, p))
+    return manifest
 
-    BUFFER_M = 5000   # 5 km padding beyond the outermost place
 
-    if places and len(places) >= 1:
+def _dump_json(data, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+
+def _download_graph_artifact(city_name: str, places: list = None, city_lat: float = None, city_lng: float = None,
+                             previous: Dict[str, Any] = None,
+                             area: Tuple[Tuple[float, float], int] = None) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Download a graph covering the places and save it as the next artifact
+    version: the GraphML first, then the manifest that points at it.
+    Compute center+radius from the places' bounding box, unless area
+    gives them (see rebuild_area()); uses graph_from_point (more
+    compatible than graph_from_bbox across OSMnx versions).
+    """
+    city_key = city_name.lower()
+    logger.info(f"Downloading road graph for {city_name}...")
+
+    if area is not None:
+        point, radius = area
+        logger.info(f"Point-based download for {city_name}: centre ({point[0]:.4f},{point[1]:.4f}), radius={radius}m")
+    elif places and len(places) >= 1:
         lats = [p["lat"] for p in places]
         lngs = [p["lng"] for p in places]
         center_lat = (max(lats) + min(lats)) / 2
@@ -380,23 +1461,72 @@ def get_city_graph(city_name: str, places: list = None, city_lat: float = None,
             max(lats), max(lngs)
         ) * 1000
 
-        radius = int(half_diag_m + BUFFER_M)
-        radius = min(max(radius, 8000), 80000)   # clamp: 8 km – 80 km
+        radius = int(half_diag_m + GRAPH_BUFFER_M)
+        radius = min(max(radius, 8000), GRAPH_MAX_RADIUS_M)   # clamp: 8 km – 80 km
 
         logger.info(f"Point-based download for {city_name}: centre ({center_lat:.4f},{center_lng:.4f}), radius={radius}m")
-        G = ox.graph_from_point((center_lat, center_lng), dist=radius, network_type="drive")
+        point = (center_lat, center_lng)
     elif city_lat is not None and city_lng is not None:
         logger.info(f"Point-based download for {city_name} (15 km fallback radius)")
-        G = ox.graph_from_point((city_lat, city_lng), dist=15000, network_type="drive")
+        point, radius = (city_lat, city_lng), 15000
     else:
         logger.info(f"Place-based download for {city_name}")
-        G = ox.graph_from_place(city_name, network_type="drive")
+        point, radius = None, None
+
+    # graph_from_point fetches the square of side 2 * dist around the point
+    area_km2 = (2 * radius / 1000) ** 2 if radius else None
+    with measure_graph_load(city_key, "download", area_km2=area_km2) as load:
+        if point:
+            G = ox.graph_from_point(point, dist=radius, network_type="drive")
+        else:
+            G = ox.graph_from_place(city_name, network_type="drive")
+        G = load["graph"] = ox.utils_graph.get_largest_component(G, strongly=True)
+
+    version = (previous or read_graph_manifest(city_key) or {}).get("version", 0) + 1
+    graph_path = graph_cache_path(city_key, version)
+    _write_atomic(graph_path, lambda p: ox.save_graphml(G, p))
+    manifest = {
+        "city": city_key,
+        "version": version,
+        "file": os.path.basename(graph_path),
+        "bbox": graph_bbox(G),
+        "requested_bbox": requested_bbox(point, radius),
+        "center": list(point) if point else None,
+        "radius_m": radius,
+        "site_count": len(places or []),
+        "nodes": len(G.nodes),
+        "edges": len(G.edges),
+        "built_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+    }
+    _write_atomic(graph_manifest_path(city_key), lambda p: _dump_json(manifest, p))
+    logger.info(f"Graph v{version} for {city_name} saved ({len(G.nodes)} nodes).")
+    return G, manifest
 
-    G = ox.utils_graph.get_largest_component(G, strongly=True)
-    ox.save_graphml(G, graph_path)
+
+def _publish_graph(city_key: str, G, manifest: Dict[str, Any]):
+    """
+    Swap G in as the city's graph.  A single dict assignment: requests
+    that already hold the old graph finish on it, later ones get the new
+    one, and the old graph is freed when the last of them lets go.
+    """
+    GRAPH_MANIFESTS[city_key] = manifest
     GRAPH_CACHE[city_key] = G
-    logger.info(f"Graph for {city_name} saved ({len(G.nodes)} nodes).")
-    return G
+
+    # Keep the newest GRAPH_KEEP_VERSIONS artifacts on disk
+    prefix = f"{city_key}.v"
+    versions = []
+    for filename in os.listdir(GRAPH_CACHE_DIR):
+        if filename.startswith(prefix) and filename.endswith(".graphml"):
+            try:
+                versions.append((int(filename[len(prefix):-len(".graphml")]), filename))
+            except ValueError:
+                continue
+    for version, filename in sorted(versions)[:-GRAPH_KEEP_VERSIONS]:
+        if version < manifest["version"]:
+            os.remove(os.path.join(GRAPH_CACHE_DIR, filename))
+    legacy_path = graph_cache_path(city_key)
+    if manifest["version"] > 0 and os.path.exists(legacy_path):
+        os.remove(legacy_path)
 
 
 def _preload_graphs_background():
@@ -414,16 +1544,27 @@ def _preload_graphs_background():
                 city_key = city.name.lower()
                 if city_key in GRAPH_CACHE:
                     continue
-                graph_path = os.path.join("graph_cache", f"{city_key}.graphml")
-                if os.path.exists(graph_path):
+                # Fetch all sites for this city to get the real bbox
+                sites = Site.query.filter_by(city_id=city.id).all()
+                place_list = [{"lat": s.latitude, "lng": s.longitude} for s in sites if s.latitude and s.longitude]
+                manifest = read_graph_manifest(city_key)
+                if manifest and graph_covers(manifest, place_list) and not graph_is_stale(manifest):
+                    logger.info(f"[BG] Graph v{manifest['version']} on disk covers {city.name}, skipping.")
+                    continue
+                if manifest is None and os.path.exists(graph_cache_path(city_key)):
                     logger.info(f"[BG] Graph already on disk for {city.name}, skipping.")
                     continue
                 try:
-                    # Fetch all sites for this city to get the real bbox
-                    sites = Site.query.filter_by(city_id=city.id).all()
-                    place_list = [{"lat": s.latitude, "lng": s.longitude} for s in sites if s.latitude and s.longitude]
-                    logger.info(f"[BG] Pre-downloading graph for {city.name} ({len(place_list)} sites)...")
-                    get_city_graph(city.name, places=place_list, city_lat=city.lat, city_lng=city.lng)
+                    if manifest:
+                        logger.info(f"[BG] Rebuilding graph v{manifest['version']} for {city.name} ({len(place_list)} sites)...")
+                        graph_flight.do(
+                            f"rebuild:{city_key}",
+                            lambda: _rebuild_city_graph(city.name, place_list, city.lat, city.lng),
+                            timeout=None
+                        )
+                    else:
+                        logger.info(f"[BG] Pre-downloading graph for {city.name} ({len(place_list)} sites)...")
+                        get_city_graph(city.name, places=place_list, city_lat=city.lat, city_lng=city.lng)
                     logger.info(f"[BG] Graph ready for {city.name}.")
                 except Exception as e:
                     logger.error(f"[BG] Failed to pre-download graph for {city.name}: {e}")
@@ -431,328 +1572,2860 @@ def _preload_graphs_background():
         logger.error(f"[BG] Pre-load thread error: {e}")
 
 # Start background graph pre-loader only on the main process (not the Werkzeug reloader child)
-if ENABLE_ROUTING_GRAPH and os.environ.get("WERKZEUG_RUN_MAIN") != "true":
-    import threading
+# GRAPH_PRELOAD=false turns it off, e.g. for offline scripts that import the app.
+GRAPH_PRELOAD = os.environ.get("GRAPH_PRELOAD", "true").lower() == "true"
+if ENABLE_ROUTING_GRAPH and GRAPH_PRELOAD and os.environ.get("WERKZEUG_RUN_MAIN") != "true":
     threading.Thread(target=_preload_graphs_background, daemon=True, name="GraphPreloader").start()
     logger.info("🗺 Background graph pre-loader started.")
 
 # --------------------------------------------------
-# Routing Engine
+# Routing Budget (Deadlines & Admission)
 # --------------------------------------------------
 
-def calculate_route(places: List[Dict[str, Any]], city_name: str, city_lat: float = None, city_lng: float = None) -> Tuple[List[List[float]], List[str]]:
+# Latency budget for the road routing of one request.  Routing checks it
+# and degrades instead of running on: a graph not in memory by then is
+# not waited for, and legs still to route come from the leg cache, the
+# leg store or straight lines.  The itinerary is then marked partial.
+ROUTING_DEADLINE_SECONDS = float(os.environ.get("ROUTING_DEADLINE_SECONDS", 20))
+# Requests routing on the graph at once (0: no limit).  Requests beyond it
+# are routed in lightweight mode right away instead of queueing.
+ROUTING_MAX_CONCURRENT = int(os.environ.get("ROUTING_MAX_CONCURRENT", 4))
+_routing_slots = threading.BoundedSemaphore(max(ROUTING_MAX_CONCURRENT, 1))
+_routing_in_flight = [0]
+
+
+class RoutingBudget:
+    """Deadline for one request's routing, and what was degraded to meet it."""
+
+    def __init__(self, seconds: float = None, lightweight: bool = False):
+        self.expires_at = time.monotonic() + (ROUTING_DEADLINE_SECONDS if seconds is None else seconds)
+        # Shed by admission control: never touch the graph
+        self.lightweight = lightweight
+        # reason -> legs
+        self.degraded: Dict[str, int] = {}
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def degrade(self, reason: str, legs: int = 1):
+        if legs > 0:
+            self.degraded[reason] = self.degraded.get(reason, 0) + legs
+            DEGRADED_LEGS.inc(reason, legs)
+
+    @property
+    def degraded_legs(self) -> int:
+        return sum(self.degraded.values())
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.degraded)
+
+
+@contextmanager
+def routing_budget(needed: bool = True, seconds: float = None):
     """
-    Returns:
-    - full_route: List[[lat, lng]]  (single continuous polyline)
-    - instructions: List[str]
+    A RoutingBudget for a request that routes on the graph, or None when
+    it does not (lazy itineraries).  Takes one of ROUTING_MAX_CONCURRENT
+    slots without blocking; if none is free the budget is lightweight.
     """
-    logger.info(f"Starting routing for {city_name} with {len(places)} places")
+    if not needed:
+        yield None
+        return
+    if not ENABLE_ROUTING_GRAPH or ROUTING_MAX_CONCURRENT <= 0:
+        yield RoutingBudget(seconds)
+        return
+
+    admitted = _routing_slots.acquire(blocking=False)
+    ROUTING_ADMISSIONS.inc("admitted" if admitted else "shed")
+    if not admitted:
+        logger.warning("🚦 Routing capacity full, request shed to lightweight mode.")
+        yield RoutingBudget(seconds, lightweight=True)
+        return
+    _routing_in_flight[0] += 1
     try:
-        G = get_city_graph(city_name, places=places, city_lat=city_lat, city_lng=city_lng)
-        if G is not None:
-             logger.info(f"Graph successfully loaded for {city_name}.")
-        else:
-             logger.warning(f"Graph is None for {city_name}.")
-    except Exception as e:
-        logger.error(f"Failed to load graph: {e}")
-        G = None
+        yield RoutingBudget(seconds)
+    finally:
+        _routing_in_flight[0] -= 1
+        _routing_slots.release()
 
-    if G is None:
-        # Fallback: Straight lines (Lightweight Mode)
-        logger.info("Using Haversine straight-line fallback for overall route.")
-        full_route = []
-        instructions = []
-        for i in range(len(places) - 1):
-            o, d = places[i], places[i+1]
-            pt_o = [o["lat"], o["lng"]]
-            pt_d = [d["lat"], d["lng"]]
-            if not full_route or full_route[-1] != pt_o:
-                full_route.append(pt_o)
-            full_route.append(pt_d)
-            instructions.append(f"Travel to {d['name']} (Direct)")
-        logger.info(f"Fallback complete. Continuous route points: {len(full_route)}")
-        return full_route, instructions
 
-    full_route: List[List[float]] = []
-    instructions: List[str] = []
+register_gauge("routing_in_flight", "Requests currently routing on a road graph.", lambda: _routing_in_flight[0])
 
-    for i in range(len(places) - 1):
-        o = places[i]
-        d = places[i + 1]
 
-        try:
-            orig_node = ox.distance.nearest_nodes(G, o["lng"], o["lat"])
-            dest_node = ox.distance.nearest_nodes(G, d["lng"], d["lat"])
+# Road legs routed on a graph, so later routes (and degraded ones) can reuse
+# them: (city_key, graph version, from id, from lat/lng, to id, to lat/lng)
+# -> (polyline, instruction).  Keyed by coordinates, so a moved site
+# never hits a stale leg; old entries just age out.
+LEG_CACHE_SIZE = int(os.environ.get("LEG_CACHE_SIZE", 4096))
+LEG_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_leg_cache_lock = threading.Lock()
 
-            path = nx.shortest_path(G, orig_node, dest_node, weight="length")
 
-            # Extract geometry from edges
-            segment_coords = []
-            
-            # If path is just one node (start == end), skip
-            if len(path) < 2:
-                continue
+def _leg_cache_key(city_key: str, o: Dict[str, Any], d: Dict[str, Any]) -> tuple:
+    version = GRAPH_MANIFESTS.get(city_key, {}).get("version")
+    return (city_key, version, o.get("id"), o["lat"], o["lng"], d.get("id"), d["lat"], d["lng"])
 
-            for u, v in zip(path[:-1], path[1:]):
-                edge_data = G.get_edge_data(u, v)
-                
-                if edge_data:
-                    # MultiDiGraph yields a dict of edges between u and v keyed by edge key
-                    if isinstance(edge_data, dict):
-                        data = min(edge_data.values(), key=lambda d: d.get('length', float('inf')))
-                    else:
-                        data = edge_data
 
-                    if "geometry" in data:
-                        for x, y in data["geometry"].coords:
-                            pt = [y, x] # Convert (lng, lat) to [lat, lng]
-                            if not segment_coords or segment_coords[-1] != pt:
-                                segment_coords.append(pt)
-                    else:
-                        # Fallback to straight line between nodes if no geometry
-                        pt_u = [G.nodes[u]["y"], G.nodes[u]["x"]]
-                        pt_v = [G.nodes[v]["y"], G.nodes[v]["x"]]
-                        if not segment_coords or segment_coords[-1] != pt_u:
-                            segment_coords.append(pt_u)
-                        if not segment_coords or segment_coords[-1] != pt_v:
-                            segment_coords.append(pt_v)
-            
-            if not segment_coords:
-                 # Fallback if loop didn't run
-                 for n in path:
-                     pt = [G.nodes[n]["y"], G.nodes[n]["x"]]
-                     if not segment_coords or segment_coords[-1] != pt:
-                         segment_coords.append(pt)
-
-            # Append to full route, avoiding duplicate points at junctions
-            if full_route and segment_coords:
-                if full_route[-1] == segment_coords[0]:
-                    full_route.extend(segment_coords[1:])
-                else:
-                    full_route.extend(segment_coords)
-            else:
-                full_route.extend(segment_coords)
+def _shared_leg_key(key: tuple) -> str:
+    return "leg:" + ":".join(str(part) for part in key)
 
-            instructions.append(f"Travel from {o['name']} to {d['name']}")
 
-        except Exception as e:
-            logger.error(f"Routing failed between {o['name']} and {d['name']}: {e}. Triggering fallback for this segment.")
-            # Fallback: Straight line for this segment
-            pt_o = [o["lat"], o["lng"]]
-            pt_d = [d["lat"], d["lng"]]
-            if not full_route or full_route[-1] != pt_o:
-                full_route.append(pt_o)
-            full_route.append(pt_d)
-            instructions.append(f"Travel to {d['name']} (Direct)")
+def cached_leg(city_key: str, o: Dict[str, Any], d: Dict[str, Any]):
+    """This process's copy of a leg, else the shared cache tier's."""
+    key = _leg_cache_key(city_key, o, d)
+    with _leg_cache_lock:
+        leg = LEG_CACHE.get(key)
+        if leg is not None:
+            LEG_CACHE.move_to_end(key)
+    record_cache_lookup("leg", leg is not None)
+    if leg is None and SHARED_CACHE.backend is not None:
+        shared = SHARED_CACHE.get(_shared_leg_key(key), local=False)
+        record_cache_lookup("leg_shared", shared is not None)
+        if shared is not None:
+            leg = (shared[0], shared[1])
+            _remember_leg(key, leg)
+    return leg
+
+
+def cache_leg(city_key: str, o: Dict[str, Any], d: Dict[str, Any], leg: tuple):
+    key = _leg_cache_key(city_key, o, d)
+    _remember_leg(key, leg)
+    if SHARED_CACHE.backend is not None:
+        SHARED_CACHE.set(_shared_leg_key(key), list(leg), local=False)
+
+
+def _remember_leg(key: tuple, leg: tuple):
+    with _leg_cache_lock:
+        LEG_CACHE[key] = leg
+        while len(LEG_CACHE) > LEG_CACHE_SIZE:
+            LEG_CACHE.popitem(last=False)
 
-    logger.info(f"Routing complete. Total route points generated: {len(full_route)}")
-    return full_route, instructions
 
 # --------------------------------------------------
-# Itinerary Generator (DB-driven)
+# Routing Engine
+# --------------------------------------------------
+
+def calculate_route(places: List[Dict[str, Any]], city_name: str, city_lat: float = None, city_lng: float = None,
+                    wait_for_graph: bool = True, budget: RoutingBudget = None) -> Tuple[List[List[float]], List[str]]:
+    """
+    Returns:
+    - full_route: List[[lat, lng]]  (single continuous polyline)
+    - instructions: List[str]
+
+    wait_for_graph=False uses straight lines instead of waiting for a
+    graph that is not in memory yet.  A budget bounds the wait for the
+    graph and the routing on it; whatever it cuts short is recorded on
+    the budget.
+    """
+    logger.info(f"Starting routing for {city_name} with {len(places)} places")
+    G = None
+    degraded_reason = None
+    if budget is not None and budget.lightweight:
+        degraded_reason = "shed"
+    else:
+        try:
+            G = get_city_graph(city_name, places=places, city_lat=city_lat, city_lng=city_lng, wait=wait_for_graph,
+                               timeout=budget.remaining() if budget is not None else None)
+            if G is not None:
+                 logger.info(f"Graph successfully loaded for {city_name}.")
+            else:
+                 logger.warning(f"Graph is None for {city_name}.")
+        except GraphLoading:
+            logger.info(f"Graph for {city_name} still loading, using fallback.")
+            if budget is not None:
+                degraded_reason = "deadline"
+        except Exception as e:
+            logger.error(f"Failed to load graph: {e}")
+            degraded_reason = "error"
+
+    if G is not None and budget is not None and graph_is_outdated(city_name.lower()):
+        # The ETags and cache keys name the published graph, not this one
+        budget.degrade("outdated", len(places) - 1)
+
+    if G is None:
+        if budget is not None and degraded_reason:
+            budget.degrade(degraded_reason, len(places) - 1)
+        # Lightweight Mode: cached or precomputed road legs where there are
+        # any, straight lines for the rest
+        return route_without_graph(city_name, places)
+
+    return route_on_graph(G, places, budget=budget, city_key=city_name.lower())
+
+
+def route_on_graph(G, places: List[Dict[str, Any]], budget: RoutingBudget = None,
+                   city_key: str = None) -> Tuple[List[List[float]], List[str]]:
+    """
+    Road geometry through the ordered places on an already loaded graph.
+    A segment that cannot be routed falls back to a straight line, which
+    is recorded on the budget (reason "error").  With a city_key, legs go
+    through the leg cache; legs still to route when the budget runs out
+    are taken from fallback_leg() instead.
+    """
+    full_route: List[List[float]] = []
+    instructions: List[str] = []
+    store = None
+
+    for o, d in zip(places, places[1:]):
+        leg = cached_leg(city_key, o, d) if city_key else None
+        if leg is None and budget is not None and budget.expired():
+            if store is None and city_key:
+                store = get_leg_store(city_key) or False
+            leg = fallback_leg(o, d, store or None)
+            budget.degrade("deadline")
+        elif leg is None:
+            leg = graph_leg(G, o, d)
+            if (leg[1] or "").endswith("(Direct)"):
+                # Routing the leg failed: a straight line is not a complete route
+                if budget is not None:
+                    budget.degrade("error")
+            elif city_key:
+                cache_leg(city_key, o, d, leg)
+        if leg[1] is None:
+            # Start and end snap to the same node
+            continue
+        append_segment(full_route, leg[0])
+        instructions.append(leg[1])
+
+    logger.info(f"Routing complete. Total route points generated: {len(full_route)}")
+    return full_route, instructions
+
+
+def graph_leg(G, o: Dict[str, Any], d: Dict[str, Any]) -> Tuple[List[List[float]], Optional[str]]:
+    """(polyline, instruction) from o to d on G; ([], None) when both snap to one node."""
+    try:
+        started = time.perf_counter()
+        orig_node = ox.distance.nearest_nodes(G, o["lng"], o["lat"])
+        dest_node = ox.distance.nearest_nodes(G, d["lng"], d["lat"])
+        observe_stage("snapping", started)
+
+        started = time.perf_counter()
+        path = nx.shortest_path(G, orig_node, dest_node, weight="length")
+        observe_stage("shortest_path", started)
+
+        # If path is just one node (start == end), skip
+        if len(path) < 2:
+            return [], None
+
+        started = time.perf_counter()
+        segment_coords = path_geometry(G, path)
+        observe_stage("geometry", started)
+        return segment_coords, f"Travel from {o['name']} to {d['name']}"
+
+    except Exception as e:
+        logger.error(f"Routing failed between {o['name']} and {d['name']}: {e}. Triggering fallback for this segment.")
+        # Fallback: Straight line for this segment
+        return [[o["lat"], o["lng"]], [d["lat"], d["lng"]]], f"Travel to {d['name']} (Direct)"
+
+
+def fallback_leg(o: Dict[str, Any], d: Dict[str, Any], store: "LegStore" = None) -> Tuple[List[List[float]], str]:
+    """A leg without the graph: from the leg store if it has one, else a straight line."""
+    leg = store.leg(o, d) if store is not None else None
+    if store is not None:
+        record_cache_lookup("leg_store", leg is not None)
+    if leg is not None:
+        return leg[0], f"Travel from {o['name']} to {d['name']}"
+    return [[o["lat"], o["lng"]], [d["lat"], d["lng"]]], f"Travel to {d['name']} (Direct)"
+
+
+def route_without_graph(city_name: str, places: List[Dict[str, Any]]) -> Tuple[List[List[float]], List[str]]:
+    """Same shape as route_on_graph(): cached legs, then the leg store, then straight lines."""
+    city_key = city_name.lower()
+    store = get_leg_store(city_key)
+    full_route: List[List[float]] = []
+    instructions: List[str] = []
+    started = time.perf_counter()
+    for o, d in zip(places, places[1:]):
+        leg = cached_leg(city_key, o, d) or fallback_leg(o, d, store)
+        if leg[1] is None:
+            continue
+        append_segment(full_route, leg[0])
+        instructions.append(leg[1])
+    observe_stage("leg_lookup", started)
+    logger.info(f"Fallback complete. Continuous route points: {len(full_route)}")
+    return full_route, instructions
+
+
+def append_segment(full_route: List[List[float]], segment: List[List[float]]):
+    """Extend the route, avoiding a duplicate point where the segments join."""
+    if full_route and segment and full_route[-1] == segment[0]:
+        full_route.extend(segment[1:])
+    else:
+        full_route.extend(segment)
+
+
+def path_geometry(G, path: list) -> List[List[float]]:
+    """[lat, lng] polyline along a node path, using edge geometry where present."""
+    segment_coords = []
+
+    for u, v in zip(path[:-1], path[1:]):
+        edge_data = G.get_edge_data(u, v)
+
+        if edge_data:
+            # MultiDiGraph yields a dict of edges between u and v keyed by edge key
+            if isinstance(edge_data, dict):
+                data = min(edge_data.values(), key=lambda d: d.get('length', float('inf')))
+            else:
+                data = edge_data
+
+            if "geometry" in data:
+                for x, y in data["geometry"].coords:
+                    pt = [y, x] # Convert (lng, lat) to [lat, lng]
+                    if not segment_coords or segment_coords[-1] != pt:
+                        segment_coords.append(pt)
+            else:
+                # Fallback to straight line between nodes if no geometry
+                pt_u = [G.nodes[u]["y"], G.nodes[u]["x"]]
+                pt_v = [G.nodes[v]["y"], G.nodes[v]["x"]]
+                if not segment_coords or segment_coords[-1] != pt_u:
+                    segment_coords.append(pt_u)
+                if not segment_coords or segment_coords[-1] != pt_v:
+                    segment_coords.append(pt_v)
+
+    if not segment_coords:
+         # Fallback if loop didn't run
+         for n in path:
+             pt = [G.nodes[n]["y"], G.nodes[n]["x"]]
+             if not segment_coords or segment_coords[-1] != pt:
+                 segment_coords.append(pt)
+    return segment_coords
+
+# --------------------------------------------------
+# Leg Store (Precomputed Road Legs)
+# --------------------------------------------------
+
+# Built offline by build_leg_store.py: road polylines between each site and
+# its nearest neighbours, as memory-mapped .npy arrays.  Lets lightweight
+# mode (no graph in memory) still draw road routes.
+LEG_STORE_DIR = os.environ.get("LEG_STORE_DIR", "leg_store")
+LEG_STORE_FILES = ("keys", "offsets", "coords", "distances")
+# city_key -> (manifest mtime, LegStore or None)
+LEG_STORES: Dict[str, Tuple[float, Optional["LegStore"]]] = {}
+_leg_store_lock = threading.Lock()
+
+
+def leg_key(from_id: int, to_id: int) -> int:
+    return (int(from_id) << 32) | int(to_id)
+
+
+class LegStore:
+    """
+    Directed legs between site pairs of one city:
+      keys       int64 [P]     leg_key(from, to), sorted
+      offsets    int64 [P + 1] leg i is coords[offsets[i]:offsets[i + 1]]
+      coords     float32 [N, 2] lat, lng
+      distances  float32 [P]   road metres
+    Arrays are opened with mmap_mode="r", so the pages are shared between
+    workers and only the legs actually read become resident.
+    """
+
+    def __init__(self, path: str, manifest: Dict[str, Any]):
+        self.path = path
+        self.manifest = manifest
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in LEG_STORE_FILES}
+        self.keys = arrays["keys"]
+        self.offsets = arrays["offsets"]
+        self.coords = arrays["coords"]
+        self.distances = arrays["distances"]
+        # Legs are only valid while both ends stay where they were built
+        self.sites = {int(k): tuple(v) for k, v in manifest["sites"].items()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nbytes(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.path, f"{name}.npy")) for name in LEG_STORE_FILES)
+
+    def _find(self, from_id: int, to_id: int) -> Optional[int]:
+        key = leg_key(from_id, to_id)
+        i = int(np.searchsorted(self.keys, key))
+        return i if i < len(self.keys) and int(self.keys[i]) == key else None
+
+    def _matches(self, place: Dict[str, Any]) -> bool:
+        built = self.sites.get(place.get("id"))
+        return built is not None and abs(built[0] - place["lat"]) < 1e-6 and abs(built[1] - place["lng"]) < 1e-6
+
+    def leg(self, origin: Dict[str, Any], dest: Dict[str, Any]) -> Optional[Tuple[List[List[float]], float]]:
+        """([lat, lng] polyline, metres) from origin to dest, or None if not stored."""
+        if not (self._matches(origin) and self._matches(dest)):
+            return None
+        i = self._find(origin["id"], dest["id"])
+        reverse = False
+        if i is None:
+            # A pair stored one way only: the reverse street path is a
+            # close enough stand-in (one-way streets aside)
+            i = self._find(dest["id"], origin["id"])
+            reverse = True
+        if i is None:
+            return None
+        points = self.coords[int(self.offsets[i]):int(self.offsets[i + 1])].astype(float).tolist()
+        if reverse:
+            points.reverse()
+        return points, float(self.distances[i])
+
+
+def leg_store_manifest_path(city_key: str) -> str:
+    return os.path.join(LEG_STORE_DIR, city_key, "manifest.json")
+
+
+def get_leg_store(city_name: str) -> Optional[LegStore]:
+    """The city's leg store, reopened whenever a new build replaces its manifest."""
+    city_key = city_name.lower()
+    manifest_path = leg_store_manifest_path(city_key)
+    try:
+        mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        return None
+    cached = LEG_STORES.get(city_key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with _leg_store_lock:
+        cached = LEG_STORES.get(city_key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        store = None
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            store = LegStore(os.path.join(LEG_STORE_DIR, city_key, manifest["build"]), manifest)
+            logger.info(f"🛣 Leg store for {city_name}: {len(store)} legs ({store.nbytes() / 1024:.0f} KB mapped).")
+        except Exception as e:
+            logger.error(f"Could not open leg store for {city_name}: {e}")
+        LEG_STORES[city_key] = (mtime, store)
+        return store
+
+
+# --------------------------------------------------
+# Spatial Index
+# --------------------------------------------------
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def site_to_dict(s: "Site") -> Dict[str, Any]:
+    return {
+        "id": s.id,
+        "name": s.name,
+        "lat": s.latitude,
+        "lng": s.longitude,
+        "category": s.category,
+        "opening_time": s.opening_time,
+        "closing_time": s.closing_time,
+        "ticket_price": s.ticket_price,
+        "best_time_to_visit": s.best_time_to_visit,
+        "visit_duration": s.visit_duration,
+        "description": s.description,
+        "image_url": s.image_url
+    }
+
+
+class CitySpatialIndex:
+    """
+    Haversine BallTree over one city's sites.  Radius and k-nearest queries
+    are O(log n); bounding boxes are a vectorised mask over the coordinate
+    arrays.  Query results are fresh dict copies, so callers may mutate them.
+    """
+
+    def __init__(self, sites: List[Dict[str, Any]], distances: np.ndarray = None):
+        self.sites = sites
+        self.lats = np.array([s["lat"] for s in sites], dtype=float)
+        self.lngs = np.array([s["lng"] for s in sites], dtype=float)
+        self.tree = BallTree(np.radians(np.column_stack([self.lats, self.lngs])), metric="haversine") if sites else None
+        self.positions = {s["id"]: i for i, s in enumerate(sites)}
+        self._distances = distances
+
+    def __len__(self):
+        return len(self.sites)
+
+    def distance_matrix(self) -> Optional[np.ndarray]:
+        """
+        equirect_km() between every pair of sites, built on first use and
+        carried over (patched) by patched().  None above SITE_MATRIX_MAX_SITES.
+        """
+        if self._distances is None and 0 < len(self.sites) <= SITE_MATRIX_MAX_SITES:
+            self._distances = equirect_np(
+                self.lats[:, None], self.lngs[:, None], self.lats[None, :], self.lngs[None, :]
+            ).astype(np.float32)
+        return self._distances
+
+    def distances_for(self, places: List[Dict[str, Any]]) -> Optional[List[List[float]]]:
+        """The matrix restricted to places, in their order; None if any is not indexed as is."""
+        matrix = self.distance_matrix()
+        rows = [self.positions.get(p.get("id")) for p in places]
+        if matrix is None or any(
+            i is None or self.lats[i] != p["lat"] or self.lngs[i] != p["lng"] for i, p in zip(rows, places)
+        ):
+            return None
+        return matrix[np.ix_(rows, rows)].tolist()
+
+    def patched(self, changes: List[Dict[str, Any]], fresh: Dict[int, Dict[str, Any]]) -> "CitySpatialIndex":
+        """
+        A new index with `changes` (from catalog_changes()) applied, given
+        the current rows of every site they touch (`fresh`, by id; missing
+        means gone).  A built distance matrix keeps its unchanged rows and
+        columns; only those of added or moved sites are computed.
+        """
+        touched = {c["site_id"] for c in changes if c["site_id"] is not None}
+        kept = [s for s in self.sites if s["id"] not in touched]
+        sites = sorted(kept + list(fresh.values()), key=lambda s: s["id"])
+        if self._distances is None or not (0 < len(sites) <= SITE_MATRIX_MAX_SITES):
+            return CitySpatialIndex(sites)
+
+        lats = np.array([s["lat"] for s in sites], dtype=float)
+        lngs = np.array([s["lng"] for s in sites], dtype=float)
+        distances = np.empty((len(sites), len(sites)), dtype=np.float32)
+        new_kept = [i for i, s in enumerate(sites) if s["id"] not in touched]
+        old_kept = [self.positions[sites[i]["id"]] for i in new_kept]
+        distances[np.ix_(new_kept, new_kept)] = self._distances[np.ix_(old_kept, old_kept)]
+        redo = [i for i, s in enumerate(sites) if s["id"] in touched]
+        if redo:
+            rows = equirect_np(lats[redo][:, None], lngs[redo][:, None], lats[None, :], lngs[None, :])
+            distances[redo, :] = rows
+            distances[:, redo] = rows.T
+        return CitySpatialIndex(sites, distances)
+
+    def _results(self, indices, distances_km, limit=None) -> List[Tuple[Dict[str, Any], float]]:
+        if limit is not None:
+            indices, distances_km = indices[:limit], distances_km[:limit]
+        return [(dict(self.sites[i]), float(d)) for i, d in zip(indices, distances_km)]
+
+    def within_radius(self, lat: float, lng: float, radius_km: float, limit: int = None):
+        """Sites within radius_km of (lat, lng), nearest first, as (site, distance_km)."""
+        if self.tree is None:
+            return []
+        ind, dist = self.tree.query_radius(
+            np.radians([[lat, lng]]), r=radius_km / EARTH_RADIUS_KM,
+            return_distance=True, sort_results=True
+        )
+        return self._results(ind[0], dist[0] * EARTH_RADIUS_KM, limit)
+
+    def nearest(self, lat: float, lng: float, k: int):
+        if self.tree is None:
+            return []
+        k = min(k, len(self.sites))
+        dist, ind = self.tree.query(np.radians([[lat, lng]]), k=k)
+        return self._results(ind[0], dist[0] * EARTH_RADIUS_KM)
+
+    def within_bbox(self, min_lat, min_lng, max_lat, max_lng, lat=None, lng=None, limit: int = None):
+        """Sites inside the box, sorted by distance from (lat, lng) (default: box centre)."""
+        if not self.sites:
+            return []
+        if lat is None or lng is None:
+            lat, lng = (min_lat + max_lat) / 2, (min_lng + max_lng) / 2
+        mask = (self.lats >= min_lat) & (self.lats <= max_lat) & (self.lngs >= min_lng) & (self.lngs <= max_lng)
+        indices = np.nonzero(mask)[0]
+        distances = haversine_np(lat, lng, self.lats[indices], self.lngs[indices])
+        order = np.argsort(distances, kind="stable")
+        return self._results(indices[order], distances[order], limit)
+
+
+def equirect_np(lat1, lon1, lat2, lon2):
+    """Vectorised equirect_km(); any argument may be a NumPy array."""
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    x = (lon2 - lon1) * np.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return EARTH_RADIUS_KM * np.sqrt(x * x + y * y)
+
+
+def haversine_np(lat1, lon1, lat2, lon2):
+    """Vectorised haversine (km); any argument may be a NumPy array."""
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+# Above this many sites a city gets no site-to-site distance matrix (float32,
+# 4 bytes per pair: 1000 sites is 4 MB, and a patch briefly holds two)
+SITE_MATRIX_MAX_SITES = int(os.environ.get("SITE_MATRIX_MAX_SITES", 1000))
+# Catching up over more changes than this reloads the city instead
+SPATIAL_INDEX_MAX_PATCH = 500
+
+# city_id -> (dataset version, index)
+SPATIAL_INDEX: Dict[int, Tuple[int, CitySpatialIndex]] = {}
+# Indexes retired by a local write, kept as the base for patching
+_retired_spatial_indexes: Dict[int, Tuple[int, CitySpatialIndex]] = {}
+_spatial_index_lock = threading.Lock()
+
+
+def get_spatial_index(city_id: int, version: int = None) -> CitySpatialIndex:
+    """
+    Cached index for a city.  Passing the city's current version updates
+    an index built from older data (e.g. after a write in another worker):
+    by replaying the change log when it reaches back far enough, else by
+    reloading every site.
+    """
+    cached = SPATIAL_INDEX.get(city_id)
+    if cached is not None and (version is None or cached[0] == version):
+        return cached[1]
+    with _spatial_index_lock:
+        cached = SPATIAL_INDEX.get(city_id)
+        if cached is None or (version is not None and cached[0] != version):
+            if version is None:
+                version = db.session.query(City.version).filter_by(id=city_id).scalar()
+            # Always take the retired index out, so it never outlives the
+            # index that replaces it (with a second copy of the matrix)
+            retired = _retired_spatial_indexes.pop(city_id, None)
+            base = cached or retired
+            index = _patch_spatial_index(city_id, base, version) if base else None
+            if index is None:
+                sites = Site.query.filter_by(city_id=city_id).order_by(Site.id).all()
+                index = CitySpatialIndex([site_to_dict(s) for s in sites])
+                logger.info(f"Built spatial index for city {city_id} v{version} ({len(index)} sites).")
+            cached = (version, index)
+            SPATIAL_INDEX[city_id] = cached
+    return cached[1]
+
+
+def _patch_spatial_index(city_id: int, base: Tuple[int, CitySpatialIndex], version: int) -> Optional[CitySpatialIndex]:
+    base_version, index = base
+    if base_version > version:
+        return None
+    changes = catalog_changes(city_id, base_version, version)
+    if changes is None or len(changes) > SPATIAL_INDEX_MAX_PATCH:
+        return None
+    touched = {c["site_id"] for c in changes if c["site_id"] is not None}
+    fresh = {
+        s.id: site_to_dict(s) for s in
+        Site.query.filter(Site.city_id == city_id, Site.id.in_(touched))
+    } if touched else {}
+    patched = index.patched(changes, fresh)
+    logger.info(f"Patched spatial index for city {city_id} v{base_version} -> v{version} "
+                f"({len(changes)} change(s), {len(patched)} sites).")
+    return patched
+
+
+@on_city_change
+def _drop_spatial_index(city_id):
+    with _spatial_index_lock:
+        cached = SPATIAL_INDEX.pop(city_id, None)
+        if cached is not None:
+            _retired_spatial_indexes[city_id] = cached
+
+
+# --------------------------------------------------
+# Autocomplete (City & Site Names)
+# --------------------------------------------------
+
+# Suggestions per request: default and maximum
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+# Trigram matches fill in behind the prefix matches from this many
+# characters on, for names sharing this much of the query's trigrams
+AUTOCOMPLETE_FUZZY_MIN_CHARS = 3
+AUTOCOMPLETE_FUZZY_MIN_SCORE = 0.5
+# Queries made only of very common trigrams ("temple") get no trigram
+# matches: there would be more candidates than this to count
+AUTOCOMPLETE_MAX_CANDIDATES = 2000
+# Writes in other workers are noticed by comparing city versions this
+# often; writes in this one are picked up by the next lookup
+AUTOCOMPLETE_CHECK_SECONDS = float(os.environ.get("AUTOCOMPLETE_CHECK_SECONDS", 5))
+# Catching a city up over more changes than this reloads its sites
+AUTOCOMPLETE_MAX_PATCH = 500
+# Names added since the last build, beyond which the index is rebuilt
+AUTOCOMPLETE_MAX_DELTA = 2000
+
+_SEARCH_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize_search_text(text: Optional[str]) -> str:
+    """Lower case without accents; anything but letters and digits becomes one space."""
+    text = text or ""
+    if not text.isascii():
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return _SEARCH_SEPARATORS.sub(" ", text.lower()).strip()
+
+
+def trigram_codes(text: str) -> np.ndarray:
+    """Distinct trigrams of text, each packed into an int64 (21 bits per code point)."""
+    cps = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    return np.unique((cps[:-2] << 42) | (cps[1:-1] << 21) | cps[2:])
+
+
+def _trigram_table(texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Posting lists of every trigram of " text " for each text: sorted codes,
+    offsets into the postings, and the text numbers (ascending per code).
+    """
+    if not texts:
+        return np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    # One pass over all texts at once; NUL separates them
+    cps = np.frombuffer("\0".join(f" {t} " for t in texts).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    owners = np.repeat(np.arange(len(texts), dtype=np.int64), [len(t) + 3 for t in texts])[:len(cps) - 2]
+    codes = (cps[:-2] << 42) | (cps[1:-1] << 21) | cps[2:]
+    valid = (cps[:-2] != 0) & (cps[1:-1] != 0) & (cps[2:] != 0)
+    grams, inverse = np.unique(codes[valid], return_inverse=True)
+    pairs = np.unique(inverse.astype(np.int64) * len(texts) + owners[valid])
+    offsets = np.searchsorted(pairs // len(texts), np.arange(len(grams) + 1))
+    return grams, offsets, (pairs % len(texts)).astype(np.int32)
+
+
+class AutocompleteIndex:
+    """
+    Prefix and trigram index over city names, site names and categories.
+
+    Built in bulk into sorted NumPy arrays: per tier, normalized keys
+    (their first KEY_BYTES of UTF-8) with the entry each belongs to, so a
+    prefix lookup is a binary search plus a walk over the matches it
+    wants.  Site names are also keyed from every later word ("mahal" finds
+    "Hawa Mahal"), and each tier has a second ordering grouped by city for
+    lookups within one city.  Trigram posting lists back the typo and
+    mid-word matches that fill up short results.
+
+    Entries are (type, id, name, city_id, category) tuples.  Writes go to a
+    small delta segment (sorted lists) and a removal mask; once
+    needs_rebuild() the live entries are built into new arrays.
+    """
+
+    # Tiers in the order their matches are suggested
+    TIERS = ("city", "name", "word", "category")
+    KEY_BYTES = 20
+
+    def __init__(self, entries: List[tuple], versions: Dict[int, int]):
+        self.versions = dict(versions)
+        self.size = len(entries)
+        self.names = [e[2] for e in entries]
+        self.categories = [e[4] for e in entries]
+        self.is_city = np.array([e[0] == "city" for e in entries], dtype=bool)
+        self.refs = np.array([e[1] for e in entries], dtype=np.int64)
+        self.entry_city = np.array([-1 if e[3] is None else e[3] for e in entries], dtype=np.int64)
+        self.alive = np.ones(self.size, dtype=bool)
+        self.removed = 0
+
+        self.city_slots = {ref: n for n, ref in enumerate(self.refs.tolist()) if self.is_city[n]}
+        site_numbers = np.flatnonzero(~self.is_city)
+        self.site_slots = np.full(int(self.refs[site_numbers].max(initial=0)) + 1, -1, dtype=np.int32)
+        self.site_slots[self.refs[site_numbers]] = site_numbers
+
+        texts = [normalize_search_text(name) for name in self.names]
+        tier_keys = {tier: ([], []) for tier in self.TIERS}
+        for number, entry in enumerate(entries):
+            for tier, key in self._keys_for(entry[0], texts[number], entry[4]):
+                keys, numbers = tier_keys[tier]
+                keys.append(key.encode()[:self.KEY_BYTES])
+                numbers.append(number)
+        self.keys, self.numbers, self.city_order, self.city_bounds = {}, {}, {}, {}
+        for tier, (keys, numbers) in tier_keys.items():
+            keys = np.array(keys, dtype=f"S{self.KEY_BYTES}")
+            order = np.argsort(keys, kind="stable")
+            self.keys[tier] = keys[order]
+            self.numbers[tier] = np.array(numbers, dtype=np.int32)[order]
+            # Positions again, grouped by city and in key order within each
+            cities = self.entry_city[self.numbers[tier]]
+            self.city_order[tier] = np.argsort(cities, kind="stable").astype(np.int32)
+            ids, starts = np.unique(cities[self.city_order[tier]], return_index=True)
+            ends = np.append(starts[1:], len(cities))
+            self.city_bounds[tier] = dict(zip(ids.tolist(), zip(starts.tolist(), ends.tolist())))
+        self.gram_codes, self.gram_offsets, self.gram_postings = _trigram_table(texts)
+
+        # Entries added since the build (None once removed), their sorted
+        # (key, number) pairs per tier and their trigrams
+        self.delta: List[Optional[tuple]] = []
+        self.delta_keys: Dict[str, List[Tuple[bytes, int]]] = {tier: [] for tier in self.TIERS}
+        self.delta_grams: Dict[int, List[int]] = {}
+
+    def __len__(self):
+        return self.size + len(self.delta) - self.removed
+
+    @staticmethod
+    def _keys_for(kind: str, text: str, category: Optional[str]) -> List[Tuple[str, str]]:
+        words = text.split()
+        keys = [("city" if kind == "city" else "name" if i == 0 else "word", " ".join(words[i:]))
+                for i in range(len(words))]
+        words = normalize_search_text(category).split()
+        keys += [("category", " ".join(words[i:])) for i in range(len(words))]
+        return keys
+
+    def entry(self, number: int) -> Optional[tuple]:
+        if number >= self.size:
+            return self.delta[number - self.size]
+        if not self.alive[number]:
+            return None
+        city_id = int(self.entry_city[number])
+        return ("city" if self.is_city[number] else "site", int(self.refs[number]), self.names[number],
+                None if city_id < 0 else city_id, self.categories[number])
+
+    def live_entries(self) -> List[tuple]:
+        entries = [
+            ("city" if is_city else "site", ref, name, None if city_id < 0 else city_id, category)
+            for is_city, ref, name, city_id, category, alive in zip(
+                self.is_city.tolist(), self.refs.tolist(), self.names, self.entry_city.tolist(),
+                self.categories, self.alive.tolist())
+            if alive
+        ]
+        return entries + [entry for entry in self.delta if entry is not None]
+
+    def needs_rebuild(self) -> bool:
+        return len(self.delta) > AUTOCOMPLETE_MAX_DELTA or self.removed > max(1000, len(self) // 4)
+
+    def _slot(self, kind: str, ref_id: int) -> Optional[int]:
+        if kind == "city":
+            return self.city_slots.get(ref_id)
+        if 0 <= ref_id < len(self.site_slots) and self.site_slots[ref_id] >= 0:
+            return int(self.site_slots[ref_id])
+        return None
+
+    def _set_slot(self, kind: str, ref_id: int, number: Optional[int]):
+        if kind == "city":
+            if number is None:
+                self.city_slots.pop(ref_id, None)
+            else:
+                self.city_slots[ref_id] = number
+            return
+        if ref_id >= len(self.site_slots):
+            grown = np.full(max(ref_id + 1, 2 * len(self.site_slots)), -1, dtype=np.int32)
+            grown[:len(self.site_slots)] = self.site_slots
+            self.site_slots = grown
+        self.site_slots[ref_id] = -1 if number is None else number
+
+    def add(self, entry: tuple):
+        """Index one entry, replacing the one for the same city or site."""
+        self.remove(entry[0], entry[1])
+        number = self.size + len(self.delta)
+        self.delta.append(entry)
+        self._set_slot(entry[0], entry[1], number)
+        text = normalize_search_text(entry[2])
+        for tier, key in self._keys_for(entry[0], text, entry[4]):
+            bisect.insort(self.delta_keys[tier], (key.encode()[:self.KEY_BYTES], number))
+        for code in trigram_codes(f" {text} ").tolist():
+            self.delta_grams.setdefault(code, []).append(number)
+
+    def remove(self, kind: str, ref_id: int):
+        number = self._slot(kind, ref_id)
+        if number is None:
+            return
+        self._set_slot(kind, ref_id, None)
+        if number < self.size:
+            self.alive[number] = False
+        else:
+            self.delta[number - self.size] = None
+        self.removed += 1
+
+    def drop_city(self, city_id: int):
+        """Remove a city and all of its sites."""
+        numbers = np.flatnonzero(self.alive & (self.entry_city == city_id)).tolist()
+        numbers += [self.size + i for i, entry in enumerate(self.delta) if entry is not None and entry[3] == city_id]
+        for number in numbers:
+            self.remove(*self.entry(number)[:2])
+        self.versions.pop(city_id, None)
+
+    def city_name(self, city_id: int) -> Optional[str]:
+        number = self._slot("city", city_id)
+        return self.entry(number)[2] if number is not None else None
+
+    def site_city(self, site_id: int) -> Optional[int]:
+        number = self._slot("site", site_id)
+        return self.entry(number)[3] if number is not None else None
+
+    def search(self, query: str, limit: int = AUTOCOMPLETE_LIMIT, kind: str = None,
+               city_id: int = None) -> List[Tuple[tuple, str]]:
+        """
+        Up to `limit` (entry, tier) pairs for what has been typed so far:
+        prefix matches tier by tier (cities, site names, later words of site
+        names, categories), alphabetically within a tier, then trigram
+        matches (tier "fuzzy"), most trigrams shared first.
+        """
+        text = normalize_search_text(query)
+        if not text or limit <= 0:
+            return []
+        probe = text.encode()[:self.KEY_BYTES]
+        # Keys are truncated: a longer query is checked against the names
+        truncated = len(text.encode()) > self.KEY_BYTES
+        seen = set()
+        results = []
+        for tier in self.TIERS:
+            if kind is not None and (tier == "city") != (kind == "city"):
+                continue
+            matches = heapq.merge(self._main_matches(tier, probe, city_id), self._delta_matches(tier, probe, city_id))
+            for _, number in matches:
+                if number in seen or truncated and not self._matches(number, tier, text):
+                    continue
+                seen.add(number)
+                results.append((self.entry(number), tier))
+                if len(results) >= limit:
+                    return results
+
+        if len(text) >= AUTOCOMPLETE_FUZZY_MIN_CHARS:
+            for number in self._fuzzy_candidates(text, kind, city_id):
+                entry = self.entry(number)
+                if (number in seen or entry is None or (kind is not None and entry[0] != kind)
+                        or (city_id is not None and entry[3] != city_id)):
+                    continue
+                results.append((entry, "fuzzy"))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def _matches(self, number: int, tier: str, text: str) -> bool:
+        entry = self.entry(number)
+        words = normalize_search_text(entry[4] if tier == "category" else entry[2])
+        return words.startswith(text) if tier == "name" else f" {text}" in f" {words}"
+
+    def _main_matches(self, tier: str, probe: bytes, city_id: Optional[int]):
+        """(key, entry number) of live built entries whose key starts with probe, in key order."""
+        keys, numbers = self.keys[tier], self.numbers[tier]
+        if city_id is None:
+            order, start, end = None, 0, len(keys)
+            key_at = keys.__getitem__
+        else:
+            order = self.city_order[tier]
+            start, end = self.city_bounds[tier].get(city_id, (0, 0))
+            key_at = lambda j: keys[order[j]]  # noqa: E731
+        lo = bisect.bisect_left(range(end), probe, lo=start, key=key_at)
+        if len(probe) < self.KEY_BYTES:
+            # UTF-8 never contains 0xff: sorts after every key with this prefix
+            hi = bisect.bisect_left(range(end), probe + b"\xff", lo=lo, key=key_at)
+        else:
+            hi = bisect.bisect_right(range(end), probe, lo=lo, key=key_at)
+        # Most lookups stop after the first few matches: walk in growing chunks
+        step = 16
+        while lo < hi:
+            stop = min(hi, lo + step)
+            positions = np.arange(lo, stop) if order is None else order[lo:stop]
+            owners = numbers[positions]
+            live = self.alive[owners]
+            for position, number in zip(positions[live].tolist(), owners[live].tolist()):
+                yield keys[position], number
+            lo, step = stop, min(step * 4, 4096)
+
+    def _delta_matches(self, tier: str, probe: bytes, city_id: Optional[int]):
+        keys = self.delta_keys[tier]
+        for i in range(bisect.bisect_left(keys, (probe,)), len(keys)):
+            key, number = keys[i]
+            if not key.startswith(probe):
+                break
+            entry = self.delta[number - self.size]
+            if entry is not None and (city_id is None or entry[3] == city_id):
+                yield key, number
+
+    def _fuzzy_candidates(self, text: str, kind: str = None, city_id: int = None) -> List[int]:
+        """
+        Entry numbers sharing enough of the query's trigrams, most shared
+        first.  Built entries are filtered here; added ones (numbers from
+        self.size on) are left to the caller.
+        """
+        # No trailing pad: the last word may not be finished yet
+        codes = trigram_codes(f" {text}")
+        need = max(2, math.ceil(len(codes) * AUTOCOMPLETE_FUZZY_MIN_SCORE))
+        if len(codes) < need:
+            return []
+        if len(self.gram_codes):
+            at = np.minimum(np.searchsorted(self.gram_codes, codes), len(self.gram_codes) - 1)
+            found = self.gram_codes[at] == codes
+        else:
+            at, found = np.zeros(len(codes), dtype=np.int64), np.zeros(len(codes), dtype=bool)
+        lists = []
+        for code, i, hit in zip(codes.tolist(), at.tolist(), found.tolist()):
+            postings = self.gram_postings[self.gram_offsets[i]:self.gram_offsets[i + 1]] if hit else self.gram_postings[:0]
+            if code in self.delta_grams:
+                postings = np.concatenate([postings, np.array(self.delta_grams[code], dtype=np.int32)])
+            lists.append(postings)
+        # A name with `need` of the trigrams has at least one of the rarest
+        # len - need + 1: only those are read in full
+        lists.sort(key=len)
+        seeds = lists[:len(lists) - need + 1]
+        if sum(len(p) for p in seeds) > AUTOCOMPLETE_MAX_CANDIDATES:
+            return []
+        candidates = np.unique(np.concatenate(seeds))
+        shared = np.zeros(len(candidates), dtype=np.int32)
+        for postings in lists:
+            if len(postings) and len(candidates):
+                hit = postings[np.minimum(np.searchsorted(postings, candidates), len(postings) - 1)]
+                shared += hit == candidates
+        keep = shared >= need
+        built = candidates < self.size
+        numbers = candidates[built]
+        wanted = self.alive[numbers]
+        if kind is not None:
+            wanted &= self.is_city[numbers] == (kind == "city")
+        if city_id is not None:
+            wanted &= self.entry_city[numbers] == city_id
+        keep[built] &= wanted
+        candidates, shared = candidates[keep], shared[keep]
+        return candidates[np.lexsort((candidates, -shared))].tolist()
+
+
+AUTOCOMPLETE: Optional[AutocompleteIndex] = None
+# Held to search AUTOCOMPLETE or change it in place, both quick.  Building
+# or catching up runs under _autocomplete_build_lock only, so searches
+# carry on against the current index meanwhile.
+_autocomplete_lock = threading.Lock()
+_autocomplete_build_lock = threading.Lock()
+# Cities written by this worker since the last refresh
+_autocomplete_dirty = set()
+_autocomplete_checked_at = 0.0
+
+
+def _site_search_rows():
+    return db.session.query(Site.id, Site.name, Site.city_id, Site.category)
+
+
+def _site_entry(row) -> tuple:
+    return ("site", row.id, row.name, row.city_id, row.category)
+
+
+def _city_entry(city_id: int, name: str) -> tuple:
+    return ("city", city_id, name, city_id, None)
+
+
+def _build_autocomplete_index() -> AutocompleteIndex:
+    started = time.perf_counter()
+    cities = db.session.query(City.id, City.name, City.version).all()
+    entries = [_city_entry(c.id, c.name) for c in cities]
+    entries += [_site_entry(row) for row in _site_search_rows()]
+    index = AutocompleteIndex(entries, {c.id: c.version for c in cities})
+    logger.info(f"🔎 Built autocomplete index: {len(index)} names in {time.perf_counter() - started:.2f}s.")
+    return index
+
+
+def _refresh_autocomplete_index(index: AutocompleteIndex) -> AutocompleteIndex:
+    """
+    Bring the index up to the catalog's city versions: replay the change
+    log for cities that changed, reload the ones it does not cover, drop
+    deleted ones.  Returns the index, or a rebuilt one once the changes
+    have piled up (see AutocompleteIndex.needs_rebuild).
+
+    Runs under _autocomplete_build_lock, so nothing else changes the
+    index: the database is read and any rebuild done without
+    _autocomplete_lock, which is only taken for the in-place changes.
+    """
+    cities = {c.id: c for c in db.session.query(City.id, City.name, City.version)}
+    _autocomplete_dirty.clear()
+
+    reloads, patches = {}, {}
+    for city_id, city in cities.items():
+        since = index.versions.get(city_id)
+        if since == city.version:
+            continue
+        changes = catalog_changes(city_id, since, city.version) if since is not None and since < city.version else None
+        if changes is None or len(changes) > AUTOCOMPLETE_MAX_PATCH:
+            reloads[city_id] = [_site_entry(row) for row in _site_search_rows().filter(Site.city_id == city_id)]
+        else:
+            touched = {c["site_id"] for c in changes if c["site_id"] is not None}
+            patches[city_id] = (touched, {
+                row.id: _site_entry(row) for row in _site_search_rows().filter(Site.id.in_(touched))
+            } if touched else {})
+    pending = [entry for entries in reloads.values() for entry in entries]
+
+    with _autocomplete_lock:
+        for city_id in (set(index.versions) - set(cities)) | set(reloads):
+            index.drop_city(city_id)
+        for city_id, (touched, fresh) in patches.items():
+            for site_id in touched:
+                entry = fresh.get(site_id)
+                if entry is not None and entry[3] == city_id:
+                    index.add(entry)
+                elif index.site_city(site_id) == city_id:
+                    # Deleted, or moved to a city that re-adds it itself
+                    index.remove("site", site_id)
+        for city_id in set(reloads) | set(patches):
+            index.add(_city_entry(city_id, cities[city_id].name))
+            index.versions[city_id] = cities[city_id].version
+        rebuild = len(index.delta) + len(pending) > AUTOCOMPLETE_MAX_DELTA or index.needs_rebuild()
+        if not rebuild:
+            for entry in pending:
+                index.add(entry)
+
+    if rebuild:
+        started = time.perf_counter()
+        index = AutocompleteIndex(index.live_entries() + pending, index.versions)
+        logger.info(f"🔎 Rebuilt autocomplete index: {len(index)} names in {time.perf_counter() - started:.2f}s.")
+    return index
+
+
+def _current_autocomplete_index() -> AutocompleteIndex:
+    """AUTOCOMPLETE, built or caught up first when it is missing or due for a check."""
+    global AUTOCOMPLETE, _autocomplete_checked_at
+    index = AUTOCOMPLETE
+    due = bool(_autocomplete_dirty) or time.monotonic() - _autocomplete_checked_at >= AUTOCOMPLETE_CHECK_SECONDS
+    if index is not None and not due:
+        return index
+    # One thread builds or catches up; while it does, the others keep
+    # answering from the index they have (there is none to wait for only
+    # on the first build)
+    if not _autocomplete_build_lock.acquire(blocking=index is None):
+        return index
+    try:
+        now = time.monotonic()
+        index = AUTOCOMPLETE
+        if index is None:
+            index = _build_autocomplete_index()
+        elif _autocomplete_dirty or now - _autocomplete_checked_at >= AUTOCOMPLETE_CHECK_SECONDS:
+            index = _refresh_autocomplete_index(index)
+        with _autocomplete_lock:
+            AUTOCOMPLETE = index
+        _autocomplete_checked_at = now
+        return index
+    finally:
+        _autocomplete_build_lock.release()
+
+
+def autocomplete(query: str, limit: int = AUTOCOMPLETE_LIMIT, kind: str = None,
+                 city_id: int = None) -> List[Dict[str, Any]]:
+    """Suggestions for a partly typed city or site name (see AutocompleteIndex.search)."""
+    index = _current_autocomplete_index()
+    with _autocomplete_lock:
+        results = []
+        for entry, tier in index.search(query, limit, kind, city_id):
+            entry_type, ref_id, name, entry_city_id, category = entry
+            results.append({
+                "type": entry_type,
+                "id": ref_id,
+                "name": name,
+                "city_id": entry_city_id,
+                "city": index.city_name(entry_city_id),
+                "category": category,
+                "match": "prefix" if tier in ("city", "name") else tier,
+            })
+    return results
+
+
+@on_city_change
+def _mark_autocomplete_dirty(city_id):
+    _autocomplete_dirty.add(city_id)
+
+
+# --------------------------------------------------
+# Itinerary Generator (DB-driven)
 # --------------------------------------------------
 
 def get_time_priority():
     hour = datetime.now().hour
 
-    if 6 <= hour < 12:
-        return "Morning"
-    elif 12 <= hour < 17:
-        return "Afternoon"
-    elif 17 <= hour < 21:
-        return "Evening"
+    if 6 <= hour < 12:
+        return "Morning"
+    elif 12 <= hour < 17:
+        return "Afternoon"
+    elif 17 <= hour < 21:
+        return "Evening"
+    else:
+        # Late night treated as evening preference
+        return "Evening"
+
+def time_score(site_time, current_time):
+    if not site_time:
+        return 2
+    if site_time.lower() == current_time.lower():
+        return 0
+    if site_time.lower() == "any":
+        return 1
+    return 2
+
+def generate_procedural_itinerary(city_name, days, radius_km: float = None, center: Tuple[float, float] = None, with_routes: bool = True,
+                                  budget: RoutingBudget = None):
+    """
+    If radius_km is given, only sites within that distance of center
+    (default: the city centre) are candidates, via the spatial index.
+    With with_routes=False no road geometry is computed: each day carries
+    a route_url for /api/cities/<id>/day-route instead.  If the routing
+    budget cuts any route short, the itinerary (and each day affected)
+    is marked "partial".  Complete itineraries are kept in the shared
+    cache tier, so any worker can answer the same request again.
+    """
+
+    if not city_name:
+        return None
+
+    city_name = city_name.strip().lower()
+
+    started = time.perf_counter()
+    city = City.query.filter(
+        db.func.lower(City.name) == city_name
+    ).first()
+
+    if not city:
+        return None
+
+    cache_key = itinerary_cache_key(city, days, radius_km, center, with_routes)
+    cached = SHARED_CACHE.get(cache_key)
+    record_cache_lookup("itinerary", cached is not None)
+    if cached is not None:
+        observe_stage("db_fetch", started)
+        return cached
+
+    index = get_spatial_index(city.id, city.version)
+    if radius_km is not None:
+        lat, lng = center if center else (city.lat, city.lng)
+        sites_data = [site for site, _ in index.within_radius(lat, lng, radius_km)]
+        if not sites_data:
+            return None
+    else:
+        sites = Site.query.filter_by(city_id=city.id).all()
+        if not sites:
+            return None
+
+        sites_data: List[Dict[str, Any]] = [site_to_dict(s) for s in sites]
+    observe_stage("db_fetch", started)
+
+    if days <= 0:
+        days = 1
+
+    # Generate Itinerary for each day
+    itinerary = []
+
+    planned, ordering_stats = plan_days(sites_data, days, city.version, index.distances_for)
+    for d, day_places in enumerate(planned):
+        logger.info(f"Day {d+1} Optimized: {[p['name'] for p in day_places]}")
+        itinerary.append(summarize_day(d, day_places, city, with_routes, budget))
+        if ordering_stats[d].get("timed_out"):
+            itinerary[-1]["partial"] = True
+
+    result = {
+        "city": {
+            "id": city.id,
+            "name": city.name,
+            "lat": city.lat,
+            "lng": city.lng,
+            "version": city.version
+        },
+        "days": itinerary
+    }
+    # An ordering cut short by the time limit depends on machine speed, so
+    # it is as unrepeatable as a degraded route
+    degraded = dict(budget.degraded) if budget is not None else {}
+    timed_out = sum(1 for stats in ordering_stats if stats.get("timed_out"))
+    if timed_out:
+        degraded["ordering"] = timed_out
+    if degraded:
+        result["partial"] = True
+        result["degraded"] = degraded
+    else:
+        SHARED_CACHE.set(cache_key, result)
+    return result
+
+
+def geometry_version(city: "City") -> tuple:
+    """
+    What road geometry is routed on besides the catalog: the graph version
+    and the leg store build.  Routes cached or validated without it would
+    outlive a new build (or the first one).  Both come from the artifacts
+    on disk, so every worker agrees whether or not it has loaded them; a
+    worker still on an older graph marks its routes partial instead.
+    """
+    city_key = city.name.lower()
+    manifest = published_graph_manifest(city_key)
+    store = get_leg_store(city_key)
+    return (manifest["version"] if manifest else None, store.manifest["build"] if store else None)
+
+
+def itinerary_cache_key(city: "City", days: int, radius_km: float = None, center=None, with_routes: bool = True) -> str:
+    # Lazy itineraries carry day route URLs, which are versioned by it too
+    geometry = geometry_version(city)
+    center = list(center) if center else None
+    return (f"itinerary:{ITINERARY_ENGINE_VERSION}:{city.id}:{city.version}:{days}:{radius_km}:{center}:"
+            f"{with_routes}:{geometry}")
+
+
+def summarize_day(index: int, day_places: List[Dict[str, Any]], city: "City", with_routes: bool = True,
+                  budget: RoutingBudget = None) -> Dict[str, Any]:
+    day_summary = {
+        "day": f"Day {index+1}",
+        "places": day_places,
+        "site_ids": [p["id"] for p in day_places],
+        "distance_km": round(path_length_km([[p["lat"], p["lng"]] for p in day_places]), 3)
+    }
+
+    if with_routes:
+        degraded_before = budget.degraded_legs if budget is not None else 0
+        day_summary["route"], day_summary["instructions"] = build_day_route(day_places, city, budget)
+        if budget is not None and budget.degraded_legs > degraded_before:
+            day_summary["partial"] = True
+    else:
+        day_summary["route_url"] = day_route_url(city, day_places)
+    return day_summary
+
+
+def plan_days(sites_data: List[Dict[str, Any]], days: int, version: int = None,
+              distances=None) -> Tuple[List[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """
+    Split the candidate sites into at most `days` geographic clusters and
+    order each one into a short walking route.  Pure: no database or
+    graph access, so it can be benchmarked on synthetic sites.  version
+    (the city's dataset version) lets exact day orders be memoized;
+    distances is passed on to solve_day_order().  Returns the days and
+    solve_day_order()'s stats for each.
+    """
+    planned = []
+    ordering_stats = []
+    for day_places_unsorted in cluster_sites(sites_data, days):
+        if not day_places_unsorted:
+            continue
+        ordering_started = time.perf_counter()
+        day_places, stats = solve_day_order(day_places_unsorted, version=version, distances=distances)
+        planned.append(day_places)
+        ordering_stats.append(stats)
+        observe_stage("day_ordering", ordering_started)
+        if stats.get("timed_out"):
+            DAY_ORDERINGS.inc("timed_out")
+            logger.warning(f"⏱ Day ordering of {stats['sites']} sites hit the {stats['budget_ms']:g} ms time limit "
+                           f"after {stats['evaluations']} of {stats['max_evaluations']} move evaluations.")
+        elif not stats["converged"]:
+            DAY_ORDERINGS.inc("budget_expired")
+            logger.info(f"⏱ Day ordering of {stats['sites']} sites used its {stats['max_evaluations']} move evaluations "
+                        f"after {stats['passes']} passes ({stats.get('improvement_pct', 0)}% shorter than greedy).")
+        else:
+            DAY_ORDERINGS.inc("converged")
+    return planned, ordering_stats
+
+
+def cluster_sites(sites_data: List[Dict[str, Any]], days: int) -> List[List[Dict[str, Any]]]:
+    # Cap: can't plan more days than available places (KMeans requires n_clusters ≤ n_samples)
+    num_days = min(max(days, 1), len(sites_data))
+
+    # Map cluster index to list of sites
+    day_clusters = [[] for _ in range(num_days)]
+
+    if num_days > 1:
+        # K-Means Clustering to group by days
+        coordinates = np.array([[s["lat"], s["lng"]] for s in sites_data])
+        started = time.perf_counter()
+        kmeans = KMeans(n_clusters=num_days, random_state=42, n_init=10)
+        labels = kmeans.fit_predict(coordinates)
+        observe_stage("kmeans", started)
+
+        for idx, label in enumerate(labels):
+            day_clusters[label].append(sites_data[idx])
+    elif num_days == 1:
+        # Just one day (or one cluster)
+        day_clusters[0] = list(sites_data)
+    return day_clusters
+
+
+def equirect_km(p1, p2):
+    """Approximate distance in km (Equirectangular approximation)."""
+    lat1, lon1 = math.radians(p1["lat"]), math.radians(p1["lng"])
+    lat2, lon2 = math.radians(p2["lat"]), math.radians(p2["lng"])
+    x = (lon2 - lon1) * math.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return EARTH_RADIUS_KM * math.sqrt(x*x + y*y)
+
+
+# Work budget for improving one day's visiting order, in candidate moves
+# evaluated (~50 ms here).  Small days reach a local optimum long before
+# it runs out; large ones stop at the best tour found so far.  Counting
+# moves rather than milliseconds keeps the order, and so the cached
+# itineraries and their ETags, the same on every machine and under load.
+DAY_ORDERING_MAX_EVALUATIONS = int(os.environ.get("DAY_ORDERING_MAX_EVALUATIONS", 250000))
+# Wall-clock safety net on a slow or overloaded machine.  An order it cuts
+# short is not repeatable, so its itinerary is marked partial.
+DAY_ORDERING_BUDGET_MS = float(os.environ.get("DAY_ORDERING_BUDGET_MS", 500))
+# Longest run of consecutive stops an or-opt move relocates
+OR_OPT_MAX_SEGMENT = 3
+# Days up to this many sites are ordered exactly (Held-Karp); its tables
+# grow as 2^(n-1) * (n-1), so 16 sites is already ~4 MB and ~50 ms
+HELD_KARP_MAX_SITES = min(int(os.environ.get("HELD_KARP_MAX_SITES", 12)), 16)
+DAY_ORDER_CACHE_SIZE = int(os.environ.get("DAY_ORDER_CACHE_SIZE", 1024))
+# (dataset version, sorted site ids) -> site ids in visiting order
+DAY_ORDER_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_day_order_lock = threading.Lock()
+
+
+def order_day_places(day_places_unsorted: List[Dict[str, Any]], budget_ms: float = None,
+                     version: int = None, distances=None, max_evaluations: int = None) -> List[Dict[str, Any]]:
+    """Visiting order for one day; see solve_day_order()."""
+    return solve_day_order(day_places_unsorted, budget_ms, version, distances, max_evaluations)[0]
+
+
+class _SearchBudget:
+    """How much local search one day's ordering may still do."""
+
+    def __init__(self, max_evaluations: int, expires_at: float):
+        self.max_evaluations = max_evaluations
+        self.expires_at = expires_at
+        self.evaluations = 0
+        self.exhausted = False
+        self.timed_out = False
+
+    def spend(self, evaluations: int) -> bool:
+        """Charge a batch of move evaluations; False once either limit is reached."""
+        if self.evaluations + evaluations > self.max_evaluations:
+            self.exhausted = True
+            return False
+        if time.perf_counter() >= self.expires_at:
+            self.exhausted = self.timed_out = True
+            return False
+        self.evaluations += evaluations
+        return True
+
+
+def solve_day_order(day_places_unsorted: List[Dict[str, Any]], budget_ms: float = None,
+                    version: int = None, distances=None,
+                    max_evaluations: int = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Open-tour TSP from the northernmost site:
+    - up to HELD_KARP_MAX_SITES sites: the shortest order, exactly
+      (held_karp_path()), memoized by dataset version and site ids when
+      a version is given
+    - larger days, anytime heuristic:
+      1. Start with the northernmost point (simple heuristic)
+      2. Use Greedy Nearest Neighbor to build initial path
+      3. Improve with 2-opt (remove crossings) and or-opt (move runs of
+         up to OR_OPT_MAX_SEGMENT stops) until no move helps or
+         max_evaluations moves (default DAY_ORDERING_MAX_EVALUATIONS)
+         have been tried
+    Returns the tour and stats on how it was found.  "converged" says
+    whether it reached a local optimum.  If budget_ms (default
+    DAY_ORDERING_BUDGET_MS) runs out first, "timed_out" is set: that
+    tour depends on machine speed.  distances(places) may supply the
+    distance matrix (e.g. CitySpatialIndex.distances_for) or return None.
+    """
+    started = time.perf_counter()
+    budget_ms = DAY_ORDERING_BUDGET_MS if budget_ms is None else budget_ms
+    max_evaluations = DAY_ORDERING_MAX_EVALUATIONS if max_evaluations is None else max_evaluations
+
+    # 1. Start North
+    remaining = sorted(day_places_unsorted, key=lambda x: x["lat"], reverse=True)
+    n = len(remaining)
+    stats = {"sites": n, "method": "heuristic", "optimal": False, "budget_ms": budget_ms,
+             "max_evaluations": max_evaluations, "evaluations": 0, "passes": 0,
+             "moves": {"2opt": 0, "or_opt": 0}, "converged": True, "timed_out": False}
+    if n < 3:
+        stats.update(method="trivial", optimal=True, initial_km=round(route_dist(remaining), 3),
+                     final_km=round(route_dist(remaining), 3), elapsed_ms=round((time.perf_counter() - started) * 1000, 3))
+        return remaining, stats
+
+    dist = (distances(remaining) if distances else None) or equirect_matrix(remaining)
+    if n <= HELD_KARP_MAX_SITES:
+        return _exact_day_order(remaining, dist, version, stats, started)
+
+    # 2. Greedy Nearest Neighbor, over indices into `remaining`
+    tour = [0]
+    unvisited = set(range(1, n))
+    while unvisited:
+        row = dist[tour[-1]]
+        nearest = min(unvisited, key=lambda j: (row[j], j))
+        tour.append(nearest)
+        unvisited.remove(nearest)
+    initial_km = tour_length(tour, dist)
+
+    # 3. Local search; each pass keeps the first improving move it finds
+    search = _SearchBudget(max_evaluations, started + budget_ms / 1000)
+    improved = True
+    while improved:
+        if search.exhausted:
+            stats["converged"] = False
+            break
+        stats["passes"] += 1
+        improved = _two_opt_pass(tour, dist, search)
+        if improved:
+            stats["moves"]["2opt"] += 1
+            continue
+        improved = _or_opt_pass(tour, dist, search)
+        if improved:
+            stats["moves"]["or_opt"] += 1
+        elif search.exhausted:
+            # The passes gave up part way, not for want of a better move
+            stats["converged"] = False
+
+    final_km = tour_length(tour, dist)
+    stats.update(
+        evaluations=search.evaluations,
+        timed_out=search.timed_out,
+        initial_km=round(initial_km, 3),
+        final_km=round(final_km, 3),
+        improvement_pct=round((1 - final_km / initial_km) * 100, 2) if initial_km else 0.0,
+        elapsed_ms=round((time.perf_counter() - started) * 1000, 3),
+    )
+    return [remaining[i] for i in tour], stats
+
+
+# Ignore "improvements" smaller than floating-point noise
+_MIN_GAIN_KM = 1e-9
+
+
+def _exact_day_order(remaining: List[Dict[str, Any]], dist: List[List[float]], version: Optional[int],
+                     stats: Dict[str, Any], started: float) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    by_id = {p["id"]: p for p in remaining}
+    key = (version, tuple(sorted(by_id))) if version is not None and len(by_id) == len(remaining) else None
+    order = None
+    if key is not None:
+        with _day_order_lock:
+            order = DAY_ORDER_CACHE.get(key)
+            if order is not None:
+                DAY_ORDER_CACHE.move_to_end(key)
+        record_cache_lookup("day_order", order is not None)
+
+    stats.update(method="held_karp", optimal=True, cached=order is not None)
+    if order is not None:
+        tour = [by_id[i] for i in order]
+    else:
+        tour = [remaining[i] for i in held_karp_path(np.asarray(dist))]
+        if key is not None:
+            with _day_order_lock:
+                DAY_ORDER_CACHE[key] = tuple(p["id"] for p in tour)
+                while len(DAY_ORDER_CACHE) > DAY_ORDER_CACHE_SIZE:
+                    DAY_ORDER_CACHE.popitem(last=False)
+    stats.update(final_km=round(route_dist(tour), 3), elapsed_ms=round((time.perf_counter() - started) * 1000, 3))
+    return tour, stats
+
+
+def held_karp_path(dist: np.ndarray) -> List[int]:
+    """
+    Shortest open path that starts at node 0 and visits every node, by
+    Held-Karp dynamic programming.  best[mask, j] is the shortest path
+    from 0 through the nodes in mask (bit b is node b + 1) ending at
+    node j + 1; each subset size is filled in one vectorized step per end
+    node.  Ties go to the lowest index, so the result is deterministic.
+    """
+    m = len(dist) - 1
+    inner = dist[1:, 1:]
+    full = (1 << m) - 1
+    best = np.full((1 << m, m), np.inf)
+    parent = np.full((1 << m, m), -1, dtype=np.int8)
+    singles = 1 << np.arange(m)
+    best[singles, np.arange(m)] = dist[0, 1:]
+
+    masks = np.arange(1 << m)
+    sizes = np.zeros(1 << m, dtype=np.int8)
+    for b in range(m):
+        sizes += (masks >> b) & 1
+    for size in range(2, m + 1):
+        layer = masks[sizes == size]
+        for j in range(m):
+            ending = layer[(layer >> j) & 1 == 1]
+            # Best way to reach each i in the subset without j, then i -> j;
+            # i == j and i outside the subset are inf already
+            candidates = best[ending ^ (1 << j)] + inner[:, j]
+            parent[ending, j] = candidates.argmin(axis=1)
+            best[ending, j] = candidates[np.arange(len(ending)), parent[ending, j]]
+
+    path = []
+    mask, j = full, int(best[full].argmin())
+    while j >= 0:
+        path.append(j + 1)
+        mask, j = mask ^ (1 << j), int(parent[mask, j])
+    return [0] + path[::-1]
+
+
+def _two_opt_pass(tour: List[int], dist, search: _SearchBudget) -> bool:
+    """Reverse tour[i..j] in place if that shortens the open tour."""
+    n = len(tour)
+    for i in range(1, n - 1):
+        if not search.spend(n - i - 1):
+            return False
+        a, b = tour[i - 1], tour[i]
+        for j in range(i + 1, n):
+            c = tour[j]
+            delta = dist[a][c] - dist[a][b]
+            if j + 1 < n:
+                d = tour[j + 1]
+                delta += dist[b][d] - dist[c][d]
+            if delta < -_MIN_GAIN_KM:
+                tour[i:j + 1] = tour[i:j + 1][::-1]
+                return True
+    return False
+
+
+def _or_opt_pass(tour: List[int], dist, search: _SearchBudget) -> bool:
+    """Move a run of stops (either way round) elsewhere if that shortens the tour."""
+    n = len(tour)
+    for length in range(1, min(OR_OPT_MAX_SEGMENT, n - 2) + 1):
+        for i in range(1, n - length + 1):
+            if not search.spend(2 * (n - length)):
+                return False
+            first, last = tour[i], tour[i + length - 1]
+            prev = tour[i - 1]
+            nxt = tour[i + length] if i + length < n else None
+            removed = dist[prev][first] - (dist[prev][nxt] if nxt is not None else 0.0)
+            if nxt is not None:
+                removed += dist[last][nxt]
+            # Insert between tour[p] and tour[p + 1], outside the run
+            for p in range(n):
+                if i - 1 <= p <= i + length - 1:
+                    continue
+                u = tour[p]
+                v = tour[p + 1] if p + 1 < n else None
+                for head, tail in ((first, last), (last, first)):
+                    added = dist[u][head] + (dist[tail][v] - dist[u][v] if v is not None else 0.0)
+                    if added - removed < -_MIN_GAIN_KM:
+                        run = tour[i:i + length]
+                        if head != first:
+                            run.reverse()
+                        rest = tour[:i] + tour[i + length:]
+                        at = rest.index(u) + 1
+                        tour[:] = rest[:at] + run + rest[at:]
+                        return True
+    return False
+
+
+def equirect_matrix(places: List[Dict[str, Any]]) -> List[List[float]]:
+    """Pairwise equirect_km() as nested lists (fast to index from Python loops)."""
+    lat = np.array([p["lat"] for p in places], dtype=float)
+    lng = np.array([p["lng"] for p in places], dtype=float)
+    return equirect_np(lat[:, None], lng[:, None], lat[None, :], lng[None, :]).tolist()
+
+
+def tour_length(tour: List[int], dist) -> float:
+    return sum(dist[a][b] for a, b in zip(tour, tour[1:]))
+
+
+def route_dist(r):
+    d = 0
+    for i in range(len(r)-1):
+        d += equirect_km(r[i], r[i+1])
+    return d
+
+
+def build_day_route(day_places: List[Dict[str, Any]], city: "City", budget: RoutingBudget = None) -> Tuple[List[List[float]], List[str]]:
+    """Road geometry for one day's ordered places, never failing outright."""
+    route = []
+    instructions = []
+
+    try:
+        # Pass city lat/lng to route calculator
+        route, instructions = calculate_route(day_places, city.name, city.lat, city.lng, budget=budget)
+    except Exception as e:
+        logger.error(f"Error calculating route for {city.name}: {e}")
+
+    # Fallback if routing completely failed (e.g. graph load error)
+    if not route and len(day_places) > 1:
+        route = [[p["lat"], p["lng"]] for p in day_places]
+        instructions = [f"Visit {p['name']}" for p in day_places]
+    return route, instructions
+
+
+def path_length_km(points: List[List[float]]) -> float:
+    if len(points) < 2:
+        return 0.0
+    pts = np.asarray(points, dtype=float)
+    return float(haversine_np(pts[:-1, 0], pts[:-1, 1], pts[1:, 0], pts[1:, 1]).sum())
+
+
+def day_route_version(city: "City") -> str:
+    """
+    The dataset version plus the road geometry version: changes whenever
+    the sites can have moved or routes can come out differently (a new
+    graph or leg store), so the geometry behind a versioned URL never does.
+    """
+    graph_version, store_build = geometry_version(city)
+    return f"{city.version}-{graph_version or 0}-{store_build or 0}"
+
+
+def day_route_url(city: "City", day_places: List[Dict[str, Any]]) -> str:
+    # Built by hand (not url_for) so itineraries can be generated outside a
+    # request, e.g. by benchmarks.
+    site_ids = ",".join(str(p["id"]) for p in day_places)
+    return f"/api/cities/{city.id}/day-route?v={day_route_version(city)}&sites={site_ids}"
+
+
+# --------------------------------------------------
+# Lazy Day Geometry
+# --------------------------------------------------
+
+DAY_ROUTE_CACHE_SIZE = int(os.environ.get("DAY_ROUTE_CACHE_SIZE", 256))
+# (city_id, version, geometry version, site ids) -> (route, instructions, distance_km)
+DAY_ROUTE_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_day_route_lock = threading.Lock()
+
+
+def get_day_route(city: "City", site_ids: List[int], budget: RoutingBudget = None):
+    """
+    Road geometry for one day, computed on first request and then served
+    from a bounded LRU.  Returns None if any site is not in the city.
+    Routes the budget cut short are returned but not cached.
+    """
+    key = (city.id, city.version, geometry_version(city), tuple(site_ids))
+    with _day_route_lock:
+        cached = DAY_ROUTE_CACHE.get(key)
+        if cached is not None:
+            DAY_ROUTE_CACHE.move_to_end(key)
+    record_cache_lookup("day_route", cached is not None)
+    if cached is not None:
+        return cached
+
+    sites = {s.id: s for s in Site.query.filter(Site.city_id == city.id, Site.id.in_(site_ids))}
+    if len(sites) != len(set(site_ids)):
+        return None
+    day_places = [site_to_dict(sites[i]) for i in site_ids]
+
+    route, instructions = build_day_route(day_places, city, budget)
+    result = (route, instructions, round(path_length_km(route), 3))
+    if budget is not None and budget.partial:
+        return result
+
+    with _day_route_lock:
+        DAY_ROUTE_CACHE[key] = result
+        while len(DAY_ROUTE_CACHE) > DAY_ROUTE_CACHE_SIZE:
+            DAY_ROUTE_CACHE.popitem(last=False)
+    return result
+
+
+def encode_polyline(points: List[List[float]], precision: int = 5) -> str:
+    """Google encoded polyline of [[lat, lng], ...]."""
+    factor = 10 ** precision
+    result = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        lat_i, lng_i = int(round(lat * factor)), int(round(lng * factor))
+        for delta in (lat_i - prev_lat, lng_i - prev_lng):
+            value = ~(delta << 1) if delta < 0 else (delta << 1)
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        prev_lat, prev_lng = lat_i, lng_i
+    return "".join(result)
+
+# --------------------------------------------------
+# Incremental Re-planning
+# --------------------------------------------------
+
+REPLAN_MAX_EDITS = 100
+
+
+class ReplanError(ValueError):
+    """An edit that cannot be applied to the plan; reported as a 400."""
+
+
+class PlannedDay:
+    """One day of a plan being edited: its site ids and where it came from."""
+
+    def __init__(self, site_ids: List[int], origin: Optional[int] = None, dirty: bool = False):
+        self.site_ids = site_ids
+        self.origin = origin     # index in the previous plan, None for a new day
+        self.dirty = dirty       # membership changed: re-order and re-route
+        self.manual = False      # order set by a positional move: keep it
+
+    def touch(self, manual: bool = False):
+        self.dirty = True
+        self.manual = manual
+
+
+def _centroid(site_ids: List[int], catalog: Dict[int, Dict[str, Any]]) -> Dict[str, float]:
+    return {
+        "lat": sum(catalog[i]["lat"] for i in site_ids) / len(site_ids),
+        "lng": sum(catalog[i]["lng"] for i in site_ids) / len(site_ids),
+    }
+
+
+def _nearest_day(site: Dict[str, Any], days: List[PlannedDay], catalog) -> PlannedDay:
+    candidates = [d for d in days if d.site_ids]
+    if not candidates:
+        return days[0]
+    return min(candidates, key=lambda d: equirect_km(site, _centroid(d.site_ids, catalog)))
+
+
+def _split_day(days: List[PlannedDay], pinned: set, catalog) -> bool:
+    """Split the largest day in two with KMeans; pinned sites stay put."""
+    for day in sorted(days, key=lambda d: len(d.site_ids), reverse=True):
+        if len(day.site_ids) < 2:
+            return False
+        coords = np.array([[catalog[i]["lat"], catalog[i]["lng"]] for i in day.site_ids])
+        labels = KMeans(n_clusters=2, random_state=42, n_init=10).fit_predict(coords)
+        keep_label = next((l for i, l in zip(day.site_ids, labels) if i in pinned), labels[0])
+        keep = [i for i, l in zip(day.site_ids, labels) if l == keep_label or i in pinned]
+        split = [i for i in day.site_ids if i not in keep]
+        if not split:
+            continue
+        day.site_ids = keep
+        day.touch()
+        days.insert(days.index(day) + 1, PlannedDay(split, dirty=True))
+        return True
+    return False
+
+
+def _merge_day(days: List[PlannedDay], pinned: set, catalog):
+    """Dissolve the smallest unpinned day into the days nearest each of its sites."""
+    unpinned = [d for d in days if not pinned.intersection(d.site_ids)]
+    victim = min(unpinned or days, key=lambda d: len(d.site_ids))
+    days.remove(victim)
+    for site_id in victim.site_ids:
+        target = _nearest_day(catalog[site_id], days, catalog)
+        target.site_ids.append(site_id)
+        target.touch()
+
+
+def _find_day(days: List[PlannedDay], site_id: int) -> PlannedDay:
+    for day in days:
+        if site_id in day.site_ids:
+            return day
+    raise ReplanError(f"Site {site_id} is not in the plan")
+
+
+def _day_at(days: List[PlannedDay], index) -> PlannedDay:
+    try:
+        index = int(index)
+    except (TypeError, ValueError):
+        raise ReplanError("day must be a day index")
+    if not 0 <= index < len(days):
+        raise ReplanError(f"No day {index} in a {len(days)}-day plan")
+    return days[index]
+
+
+def _site_id(edit: Dict[str, Any], catalog) -> int:
+    try:
+        site_id = int(edit.get("site_id"))
+    except (TypeError, ValueError):
+        raise ReplanError("site_id required")
+    if site_id not in catalog:
+        raise ReplanError(f"Site {site_id} is not in this city")
+    return site_id
+
+
+def apply_edit(days: List[PlannedDay], pinned: set, edit: Dict[str, Any], catalog):
+    """
+    Ops: add {site_id, day?}, remove {site_id}, pin {site_id, day?},
+    unpin {site_id}, move {site_id, day, position?}, set_days {days}.
+    Only the days whose membership changes are marked dirty.
+    """
+    op = edit.get("op")
+
+    if op == "set_days":
+        try:
+            target = int(edit.get("days"))
+        except (TypeError, ValueError):
+            raise ReplanError("set_days needs days")
+        total = sum(len(d.site_ids) for d in days)
+        target = max(1, min(target, total))
+        while len(days) < target and _split_day(days, pinned, catalog):
+            pass
+        while len(days) > target:
+            _merge_day(days, pinned, catalog)
+        return
+
+    site_id = _site_id(edit, catalog)
+
+    if op == "add":
+        if any(site_id in d.site_ids for d in days):
+            raise ReplanError(f"Site {site_id} is already in the plan")
+        if not days:
+            days.append(PlannedDay([], dirty=True))
+        day = _day_at(days, edit["day"]) if edit.get("day") is not None else _nearest_day(catalog[site_id], days, catalog)
+        day.site_ids.append(site_id)
+        day.touch()
+    elif op == "remove":
+        day = _find_day(days, site_id)
+        day.site_ids.remove(site_id)
+        day.touch()
+        pinned.discard(site_id)
+    elif op in ("pin", "move"):
+        source = _find_day(days, site_id)
+        if op == "move" and edit.get("day") is None:
+            raise ReplanError("move needs day")
+        target = _day_at(days, edit["day"]) if edit.get("day") is not None else source
+        position = edit.get("position") if op == "move" else None
+        if target is not source or position is not None:
+            source.site_ids.remove(site_id)
+            source.touch(manual=source.manual)
+            if position is None:
+                target.site_ids.append(site_id)
+                target.touch()
+            else:
+                target.site_ids.insert(max(0, int(position)), site_id)
+                target.touch(manual=True)
+        if op == "pin":
+            pinned.add(site_id)
+    elif op == "unpin":
+        pinned.discard(site_id)
+    else:
+        raise ReplanError(f"Unknown op: {op}")
+
+
+def replan_itinerary(city: "City", plan: List[List[int]], edits: List[Dict[str, Any]], pinned=None,
+                     version: int = None, with_routes: bool = True, budget: RoutingBudget = None) -> Dict[str, Any]:
+    """
+    Apply edits to a previous plan (ordered site ids per day) and rebuild
+    only the days whose membership changed; the others keep their order,
+    and the client keeps the geometry it already has.  A plan made against
+    an older dataset version is rebuilt in full, since sites may have moved.
+    """
+    started = time.perf_counter()
+    spatial = get_spatial_index(city.id, city.version)
+    catalog = {site["id"]: site for site in spatial.sites}
+    stale = version is not None and int(version) != city.version
+
+    days = []
+    seen = set()
+    for index, day_ids in enumerate(plan):
+        ids = [int(i) for i in day_ids]
+        kept = [i for i in ids if i in catalog and i not in seen]
+        seen.update(kept)
+        # Sites deleted since the plan was made drop out of their day
+        days.append(PlannedDay(kept, origin=index, dirty=stale or len(kept) != len(ids)))
+    pinned = {int(i) for i in (pinned or []) if int(i) in seen}
+
+    for edit in edits:
+        apply_edit(days, pinned, edit, catalog)
+
+    days = [d for d in days if d.site_ids]
+    kept_origins = {d.origin for d in days if d.origin is not None}
+
+    result_days = []
+    recomputed = 0
+    for index, day in enumerate(days):
+        if day.dirty or day.origin is None:
+            if not day.manual:
+                ordered = order_day_places([catalog[i] for i in day.site_ids], version=city.version,
+                                           distances=spatial.distances_for)
+                day.site_ids = [p["id"] for p in ordered]
+            summary = summarize_day(index, [dict(catalog[i]) for i in day.site_ids], city, with_routes, budget)
+            summary.update({"index": index, "from": day.origin, "changed": True})
+            recomputed += 1
+        else:
+            summary = {"index": index, "from": day.origin, "changed": False, "day": f"Day {index+1}"}
+        result_days.append(summary)
+    observe_stage("replan", started)
+
+    result = {
+        "city": {
+            "id": city.id,
+            "name": city.name,
+            "lat": city.lat,
+            "lng": city.lng,
+            "version": city.version
+        },
+        "plan": [d.site_ids for d in days],
+        "pinned": sorted(pinned),
+        "days": result_days,
+        "removed": [i for i in range(len(plan)) if i not in kept_origins],
+        "stale": stale,
+        "stats": {
+            "recomputed_days": recomputed,
+            "reused_days": len(days) - recomputed,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        },
+    }
+    if budget is not None and budget.partial:
+        result["partial"] = True
+        result["degraded"] = dict(budget.degraded)
+    return result
+
+
+# --------------------------------------------------
+# Bulk Site Import
+# --------------------------------------------------
+
+SITE_IMPORT_BATCH = int(os.environ.get("SITE_IMPORT_BATCH", 500))
+SITE_IMPORT_MAX_ERRORS = 1000
+
+# Optional text columns and their maximum lengths (mirrors the Site model)
+SITE_IMPORT_FIELDS = {
+    "category": 100,
+    "opening_time": 50,
+    "closing_time": 50,
+    "visit_duration": 50,
+    "best_time_to_visit": 100,
+    "ticket_price": 50,
+    "description": None,
+    "image_url": 255,
+}
+
+
+def detect_import_format(filename: str = None, explicit: str = None) -> str:
+    fmt = (explicit or "").strip().lower()
+    if not fmt and filename:
+        fmt = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if fmt == "jsonl":
+        fmt = "ndjson"
+    if fmt not in ("csv", "json", "ndjson"):
+        raise ValueError("Unsupported import format (use csv, json or ndjson)")
+    return fmt
+
+
+def _iter_json_array(reader, chunk_size: int = 1 << 16):
+    """
+    Incrementally decode a top-level JSON array of objects without loading
+    the whole document.  A top-level object in the initial_data.json shape
+    ({"City": [sites...]}) is also accepted, but is loaded in one go.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    started = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            if buf[pos] == "," and not started:
+                raise ValueError("Expected a JSON array")
+            pos += 1
+
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            chunk = reader.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+
+        if not started:
+            if buf[pos] == "{":
+                buf += reader.read()
+                data = json.loads(buf[pos:])
+                for city_name, sites in data.items():
+                    for site in sites:
+                        yield dict(site, city=city_name)
+                return
+            if buf[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+
+        if buf[pos] == "]":
+            return
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = reader.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        pos = end
+        yield obj
+
+
+def iter_import_rows(stream, fmt: str):
+    """Yields (row_number, row_or_error) from a binary stream, one row at a time."""
+    reader = codecs.getreader("utf-8-sig")(stream)
+
+    if fmt == "csv":
+        # Row numbers are file line numbers (header is line 1).
+        for n, row in enumerate(csv.DictReader(reader), start=2):
+            yield n, {k.strip(): v for k, v in row.items() if k}
+    elif fmt == "ndjson":
+        for n, line in enumerate(reader, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield n, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield n, ValueError(f"Invalid JSON: {e.msg}")
+    else:
+        n = 0
+        try:
+            for n, obj in enumerate(_iter_json_array(reader), start=1):
+                yield n, obj
+        except (ValueError, json.JSONDecodeError) as e:
+            yield n + 1, ValueError(f"Invalid JSON: {e}")
+
+
+def validate_site_row(row: Dict[str, Any], city_ids: Dict[str, int], default_city_id: int = None) -> Dict[str, Any]:
+    """Returns cleaned Site fields for one import row, or raises ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError("Row is not an object")
+
+    city_id = default_city_id
+    city_name = str(row.get("city") or "").strip()
+    if city_name:
+        city_id = city_ids.get(city_name.lower())
+        if city_id is None:
+            raise ValueError(f"Unknown city '{city_name}'")
+    if city_id is None:
+        raise ValueError("Missing city")
+
+    name = str(row.get("name") or "").strip()
+    if not name:
+        raise ValueError("Missing name")
+    if len(name) > 150:
+        raise ValueError("Name longer than 150 characters")
+
+    try:
+        lat = float(row.get("latitude", row.get("lat")))
+        lng = float(row.get("longitude", row.get("lng")))
+    except (TypeError, ValueError):
+        raise ValueError("Latitude/longitude must be numbers")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180) or math.isnan(lat) or math.isnan(lng):
+        raise ValueError("Latitude/longitude out of range")
+
+    clean = {"city_id": city_id, "name": name, "latitude": lat, "longitude": lng}
+    for field, max_len in SITE_IMPORT_FIELDS.items():
+        value = row.get(field)
+        value = str(value).strip() if value is not None else ""
+        if max_len and len(value) > max_len:
+            raise ValueError(f"{field} longer than {max_len} characters")
+        clean[field] = value or None
+    return clean
+
+
+def _upsert_site_batch(batch: List[Tuple[int, Dict[str, Any]]], report: Dict[str, Any]):
+    """Insert or update one batch of validated rows (keyed by city + name)."""
+    # Counted into the report only once the batch has committed; a failed
+    # batch counts every row as failed instead
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "duplicates": 0}
+    by_city: Dict[int, Dict[str, Tuple[int, Dict[str, Any]]]] = {}
+    for n, clean in batch:
+        # Later rows for the same site win, as with row-by-row upserts
+        rows = by_city.setdefault(clean["city_id"], {})
+        if clean["name"] in rows:
+            counts["duplicates"] += 1
+        rows[clean["name"]] = (n, clean)
+
+    try:
+        for city_id, rows in by_city.items():
+            existing = {
+                site.name: site for site in
+                Site.query.filter(Site.city_id == city_id, Site.name.in_(list(rows)))
+            }
+            for name, (n, clean) in rows.items():
+                site = existing.get(name)
+                if site is None:
+                    db.session.add(Site(**clean))
+                    counts["inserted"] += 1
+                    continue
+                changed = False
+                for field, value in clean.items():
+                    if value is not None and getattr(site, field) != value:
+                        setattr(site, field, value)
+                        changed = True
+                counts["updated" if changed else "unchanged"] += 1
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"❌ Import batch failed: {e}")
+        for n, _ in batch:
+            _record_import_error(report, n, f"Batch failed: {e}")
+        return
+    for key, value in counts.items():
+        report[key] += value
+    report["affected_city_ids"].update(by_city)
+
+
+def _record_import_error(report, row_number, message):
+    report["failed"] += 1
+    if len(report["errors"]) < SITE_IMPORT_MAX_ERRORS:
+        report["errors"].append({"row": row_number, "error": message})
+
+
+def import_sites(stream, fmt: str, default_city_id: int = None, batch_size: int = SITE_IMPORT_BATCH) -> Dict[str, Any]:
+    """
+    Stream sites from a CSV / JSON / NDJSON file into the catalog.
+    Rows are validated one at a time, upserted in batches of batch_size
+    and caches are invalidated once per affected city at the end.
+    Must be called inside an app context.
+    """
+    city_ids = {name.lower(): cid for cid, name in db.session.query(City.id, City.name)}
+    report = {
+        "processed": 0, "inserted": 0, "updated": 0, "unchanged": 0, "duplicates": 0, "failed": 0,
+        "errors": [], "affected_city_ids": set(),
+    }
+
+    batch = []
+    for n, row in iter_import_rows(stream, fmt):
+        report["processed"] += 1
+        if isinstance(row, Exception):
+            _record_import_error(report, n, str(row))
+            continue
+        try:
+            batch.append((n, validate_site_row(row, city_ids, default_city_id)))
+        except ValueError as e:
+            _record_import_error(report, n, str(e))
+            continue
+        if len(batch) >= batch_size:
+            _upsert_site_batch(batch, report)
+            batch = []
+    if batch:
+        _upsert_site_batch(batch, report)
+
+    invalidate_city_caches(*report["affected_city_ids"])
+    report["affected_city_ids"] = sorted(report["affected_city_ids"])
+    logger.info(
+        f"📦 Import finished: {report['inserted']} inserted, {report['updated']} updated, "
+        f"{report['failed']} failed across {len(report['affected_city_ids'])} city(ies)."
+    )
+    return report
+
+
+# --------------------------------------------------
+# Static Asset Fingerprinting
+# --------------------------------------------------
+
+# filename -> (mtime, fingerprint)
+STATIC_FINGERPRINTS: Dict[str, Tuple[float, str]] = {}
+CSS_IMPORT_RE = re.compile(r"""@import\s+url\(\s*['"]?([^'")?]+)['"]?\s*\)""")
+
+
+def static_fingerprint(filename: str):
+    """
+    Short content hash of a static file (None if it does not exist).
+    A stylesheet's hash also covers the files it @imports, so changing an
+    imported file changes the URL of the sheet that pulls it in.
+    """
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = STATIC_FINGERPRINTS.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.md5(content)
+    if filename.endswith(".css"):
+        base = os.path.dirname(filename)
+        for imported in CSS_IMPORT_RE.findall(content.decode("utf-8", "ignore")):
+            digest.update((static_fingerprint(os.path.normpath(os.path.join(base, imported))) or "").encode())
+    fingerprint = digest.hexdigest()[:12]
+    STATIC_FINGERPRINTS[filename] = (mtime, fingerprint)
+    return fingerprint
+
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        fingerprint = static_fingerprint(values["filename"])
+        if fingerprint:
+            values["v"] = fingerprint
+
+
+@app.after_request
+def cache_fingerprinted_static(response):
+    """Fingerprinted URLs never change content, so they can be cached forever."""
+    if request.endpoint != "static" or response.status_code != 200 or not request.args.get("v"):
+        return response
+    filename = request.view_args.get("filename", "")
+    fingerprint = static_fingerprint(filename)
+    if request.args["v"] != fingerprint:
+        return response
+
+    if filename.endswith(".css"):
+        # Point @imports at their own fingerprinted URLs
+        response.direct_passthrough = False
+        base = os.path.dirname(filename)
+        css = response.get_data(as_text=True)
+
+        def versioned(match):
+            target = match.group(1)
+            imported_fp = static_fingerprint(os.path.normpath(os.path.join(base, target)))
+            return f"@import url('{target}?v={imported_fp}')" if imported_fp else match.group(0)
+
+        response.set_data(CSS_IMPORT_RE.sub(versioned, css))
+
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+# --------------------------------------------------
+# Response Encoding (Compression & MessagePack)
+# --------------------------------------------------
+
+# Both are optional: without them responses fall back to JSON / gzip.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_MIMETYPE = "application/msgpack"
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 4   # fast dynamic-content setting, still beats gzip -6
+COMPRESSIBLE_MIMETYPES = {
+    "application/json", MSGPACK_MIMETYPE, "text/html", "text/css",
+    "text/javascript", "application/javascript",
+}
+
+
+def wants_msgpack() -> bool:
+    if msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE])
+    return best == MSGPACK_MIMETYPE
+
+
+def representation_etag(etag: str) -> str:
+    """Each representation (JSON / MessagePack) needs its own validator."""
+    return f"{etag}-mp" if wants_msgpack() else etag
+
+
+def encode_msgpack(payload) -> bytes:
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL)
+
+
+def api_response(payload: Dict[str, Any], status: int = 200):
+    """JSON, or MessagePack when the client asks for it in Accept."""
+    started = time.perf_counter()
+    if wants_msgpack():
+        response = app.response_class(encode_msgpack(payload), status=status, mimetype=MSGPACK_MIMETYPE)
     else:
-        # Late night treated as evening preference
-        return "Evening"
+        response = jsonify(payload)
+        response.status_code = status
+    observe_stage("serialization", started)
+    response.vary.add("Accept")
+    return response
+
+
+def negotiate_content_encoding() -> Optional[str]:
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_content_encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(compress_body(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    # The validator describes the uncompressed content, so weaken it
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
 
-def time_score(site_time, current_time):
-    if not site_time:
-        return 2
-    if site_time.lower() == current_time.lower():
-        return 0
-    if site_time.lower() == "any":
-        return 1
-    return 2
 
-def generate_procedural_itinerary(city_name, days):
+# --------------------------------------------------
+# Shared Cache Tier
+# --------------------------------------------------
 
-    if not city_name:
+# Itinerary results and road legs, shared between workers and hosts so one
+# process's routing serves them all.  SHARED_CACHE_URL picks the backend:
+#   redis://host:6379/0      Redis, pooled connections (needs the redis package)
+#   sqlite:///path/cache.db  one file shared by the processes of a host; tests
+#   (unset)                  process-local only
+# On backend errors the tier uses a process-local LRU until the backend has
+# been left alone for SHARED_CACHE_RETRY_SECONDS.
+try:
+    import redis
+except ImportError:
+    redis = None
+
+SHARED_CACHE_URL = os.environ.get("SHARED_CACHE_URL", "")
+SHARED_CACHE_TTL = int(os.environ.get("SHARED_CACHE_TTL", 24 * 3600))
+SHARED_CACHE_TIMEOUT = float(os.environ.get("SHARED_CACHE_TIMEOUT", 0.25))
+SHARED_CACHE_POOL_SIZE = int(os.environ.get("SHARED_CACHE_POOL_SIZE", 10))
+SHARED_CACHE_RETRY_SECONDS = float(os.environ.get("SHARED_CACHE_RETRY_SECONDS", 30))
+# Whole itineraries with road geometry can be ~100 KB each
+SHARED_CACHE_LOCAL_SIZE = int(os.environ.get("SHARED_CACHE_LOCAL_SIZE", 128))
+SHARED_CACHE_PREFIX = "itinerary-planner:"
+# Values are compressed above this size; the first byte says how they were encoded
+SHARED_CACHE_COMPRESS_BYTES = 512
+
+
+def encode_cache_value(value) -> bytes:
+    if msgpack is not None:
+        tag, data = b"m", msgpack.packb(value, use_bin_type=True)
+    else:
+        tag, data = b"j", json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if len(data) > SHARED_CACHE_COMPRESS_BYTES:
+        tag, data = tag.upper(), zlib.compress(data, 1)
+    return tag + data
+
+
+def decode_cache_value(data: bytes):
+    tag, body = data[:1], data[1:]
+    if tag.isupper():
+        tag, body = tag.lower(), zlib.decompress(body)
+    if tag == b"m":
+        if msgpack is None:
+            raise ValueError("msgpack-encoded cache value but msgpack is not installed")
+        return msgpack.unpackb(body, raw=False)
+    if tag == b"j":
+        return json.loads(body)
+    raise ValueError(f"Unknown cache value encoding {tag!r}")
+
+
+class RedisCacheBackend:
+    def __init__(self, url: str):
+        if redis is None:
+            raise RuntimeError("SHARED_CACHE_URL is a redis:// URL but the redis package is not installed")
+        pool = redis.ConnectionPool.from_url(
+            url, max_connections=SHARED_CACHE_POOL_SIZE,
+            socket_timeout=SHARED_CACHE_TIMEOUT, socket_connect_timeout=SHARED_CACHE_TIMEOUT,
+        )
+        self.client = redis.Redis(connection_pool=pool)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, data: bytes, ttl: int):
+        self.client.set(key, data, ex=ttl)
+
+
+class SqliteCacheBackend:
+    """One table in a SQLite file (WAL), one connection per thread."""
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=SHARED_CACHE_TIMEOUT, check_same_thread=False)
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._conn().execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def set(self, key: str, data: bytes, ttl: int):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                     (key, sqlite3.Binary(data), time.time() + ttl))
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        conn.commit()
+
+
+def open_cache_backend(url: str):
+    if not url:
         return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCacheBackend(url)
+    if url.startswith("sqlite:///"):
+        return SqliteCacheBackend(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported SHARED_CACHE_URL: {url}")
 
-    city_name = city_name.strip().lower()
 
-    city = City.query.filter(
-        db.func.lower(City.name) == city_name
-    ).first()
+class SharedCache:
+    """
+    get()/set() of JSON-like values against the shared backend, or against
+    a process-local LRU when there is no backend or it is failing.
+    """
 
-    if not city:
-        return None
+    def __init__(self, backend, local_size: int = SHARED_CACHE_LOCAL_SIZE):
+        self.backend = backend
+        self.local: "OrderedDict[str, Any]" = OrderedDict()
+        self.local_size = local_size
+        self._lock = threading.Lock()
+        self._down_until = 0.0
+        self.stats = {"hits": 0, "misses": 0, "errors": 0, "local_hits": 0, "local_misses": 0}
+
+    @property
+    def backend_name(self) -> str:
+        return type(self.backend).__name__ if self.backend is not None else "local"
+
+    def _backend_up(self) -> bool:
+        return self.backend is not None and time.monotonic() >= self._down_until
+
+    def _backend_failed(self, e: Exception):
+        with self._lock:
+            self.stats["errors"] += 1
+            first = time.monotonic() >= self._down_until
+            self._down_until = time.monotonic() + SHARED_CACHE_RETRY_SECONDS
+        if first:
+            logger.warning(f"⚠️ Shared cache unavailable ({e}); using process-local cache "
+                           f"for {SHARED_CACHE_RETRY_SECONDS:.0f}s.")
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, key: str, local: bool = True):
+        """local=False: callers with their own process-local cache skip the fallback LRU."""
+        if self._backend_up():
+            try:
+                data = self.backend.get(SHARED_CACHE_PREFIX + key)
+                self._count("hits" if data is not None else "misses")
+                return decode_cache_value(data) if data is not None else None
+            except Exception as e:
+                self._backend_failed(e)
+        if not local:
+            return None
+        with self._lock:
+            value = self.local.get(key)
+            if value is not None:
+                self.local.move_to_end(key)
+            self.stats["local_hits" if value is not None else "local_misses"] += 1
+        return value
+
+    def set(self, key: str, value, ttl: int = SHARED_CACHE_TTL, local: bool = True):
+        if self._backend_up():
+            try:
+                self.backend.set(SHARED_CACHE_PREFIX + key, encode_cache_value(value), ttl)
+                return
+            except Exception as e:
+                self._backend_failed(e)
+        if not local:
+            return
+        with self._lock:
+            self.local[key] = value
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+
+try:
+    SHARED_CACHE = SharedCache(open_cache_backend(SHARED_CACHE_URL))
+    if SHARED_CACHE.backend is not None:
+        logger.info(f"🗄 Shared cache: {SHARED_CACHE.backend_name}.")
+except Exception as e:
+    logger.error(f"Could not open shared cache {SHARED_CACHE_URL!r}: {e}; using process-local cache.")
+    SHARED_CACHE = SharedCache(None)
 
-    sites = Site.query.filter_by(city_id=city.id).all()
-    if not sites:
-        return None
 
-    sites_data: List[Dict[str, Any]] = [
-        {
-            "id": s.id,
-            "name": s.name,
-            "lat": s.latitude,
-            "lng": s.longitude,
-            "category": s.category,
-            "opening_time": s.opening_time,
-            "closing_time": s.closing_time,
-            "ticket_price": s.ticket_price,
-            "best_time_to_visit": s.best_time_to_visit,
-            "visit_duration": s.visit_duration,
-            "description": s.description,
-            "image_url": s.image_url
-        } for s in sites
-    ]
+# --------------------------------------------------
+# Trip Recording (Write-Behind Buffer)
+# --------------------------------------------------
 
-    if days <= 0:
-        days = 1
+# Durability mode for trip history:
+#   "async" - trips are buffered in memory and committed in batches by a
+#             background writer (a crash can lose up to one buffer of trips)
+#   "sync"  - trips are committed inside the request (previous behaviour)
+TRIP_WRITE_MODE = os.environ.get("TRIP_WRITE_MODE", "async").lower()
+TRIP_BUFFER_SIZE = int(os.environ.get("TRIP_BUFFER_SIZE", 1000))
+TRIP_FLUSH_BATCH = int(os.environ.get("TRIP_FLUSH_BATCH", 100))
+TRIP_FLUSH_INTERVAL = float(os.environ.get("TRIP_FLUSH_INTERVAL", 2.0))
 
-    # Cap: can't plan more days than available places (KMeans requires n_clusters ≤ n_samples)
-    # The natural limit is applied below via num_days = min(days, len(sites_data))
 
-    # Clustering Logic
-    coordinates = np.array([[s["lat"], s["lng"]] for s in sites_data])
-    
-    # K-Means Clustering to group by days
-    # If sites < days, reduce days to len(sites) - handled below naturally
-    
-    num_days = min(days, len(sites_data))
-    
-    # Map cluster index to list of sites
-    day_clusters = {i: [] for i in range(num_days)}
-    
-    if num_days > 1:
-        kmeans = KMeans(n_clusters=num_days, random_state=42, n_init=10)
-        labels = kmeans.fit_predict(coordinates)
-        
-        for idx, label in enumerate(labels):
-            day_clusters[label].append(sites_data[idx])
-    else:
-        # Just one day (or one cluster)
-        day_clusters[0] = sites_data
+class TripWriter:
+    """
+    Bounded in-process buffer for Trip inserts.
+    Requests only enqueue; a daemon thread drains the queue and commits
+    batches, so planning latency never includes a database commit.
+    When the buffer is full the trip is written synchronously instead of
+    being dropped.
+    """
 
-    # Generate Itinerary for each day
-    itinerary = []
-    
-    # Sort clusters by something? Maybe distance from city center?
-    # For now, just iterate 0..k
-    
-    for d in range(num_days):
-        day_places_unsorted = day_clusters[d]
-        
-        if not day_places_unsorted:
-            continue
-            
-        # Optimization: Sort using Nearest Neighbor Heuristic (TSP)
-        # Start with the place closest to top-left or city center?
-        # Let's just pick the first in list as start, or the one with min latitude (most north?)
-        
-        # Optimization: TSP with 2-Opt Layout
-        # 1. Start with the northernmost point (simple heuristic)
-        # 2. Use Greedy Nearest Neighbor to build initial path
-        # 3. Refine with 2-Opt to remove crossovers
+    def __init__(self, maxsize: int, batch_size: int, interval: float):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def record(self, city, days, user_id, itinerary=None):
+        entry = {
+            "city": city,
+            "days": days,
+            "user_id": user_id,
+            "created_at": datetime.utcnow(),
+            # Encoded by the writer, off the request path. The dict is
+            # never mutated after generation, so sharing it is safe.
+            "itinerary": itinerary,
+        }
+
+        if TRIP_WRITE_MODE == "sync" or self._stopping.is_set():
+            self._write([entry])
+            return
+
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            logger.warning("⚠️  Trip buffer full, writing trip synchronously.")
+            self._write([entry])
+
+    def _ensure_started(self):
+        # Started lazily so the thread is created inside the gunicorn worker,
+        # not in a process that is about to fork.
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name="TripWriter")
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._drain(timeout=self.interval)
+            if batch:
+                self._write(batch)
+
+    def _drain(self, timeout=None) -> list:
+        batch = []
+        try:
+            if timeout is None:
+                batch.append(self.queue.get_nowait())
+            else:
+                batch.append(self.queue.get(timeout=timeout))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list):
+        # A fresh app context gives the writer its own scoped session, so it
+        # never shares (or commits) a request's session.
+        snapshots = {}
+        trips = []
+        for entry in batch:
+            entry = dict(entry)
+            itinerary = entry.pop("itinerary", None)
+            if itinerary is not None:
+                digest, data = encode_snapshot(itinerary)
+                snapshots[digest] = data
+                entry["snapshot_digest"] = digest
+            trips.append(entry)
+
+        started = time.perf_counter()
+        with app.app_context():
+            # Two attempts: another worker may insert the same snapshot
+            # between our existence check and our commit.
+            for attempt in range(2):
+                try:
+                    if snapshots:
+                        existing = {
+                            row.digest for row in db.session.query(ItinerarySnapshot.digest)
+                            .filter(ItinerarySnapshot.digest.in_(list(snapshots)))
+                        }
+                        db.session.add_all([
+                            ItinerarySnapshot(digest=d, data=data)
+                            for d, data in snapshots.items() if d not in existing
+                        ])
+                    db.session.add_all([Trip(**entry) for entry in trips])
+                    db.session.commit()
+                    observe_stage("trip_insert", started)
+                    logger.info(f"Recorded {len(trips)} trip(s).")
+                    return
+                except Exception as e:
+                    db.session.rollback()
+                    if attempt == 1:
+                        logger.error(f"❌ Failed to record {len(trips)} trip(s): {e}")
 
-        if not day_places_unsorted:
-            continue
-            
-        # Helper: Approximate distance in km (Equirectangular approximation)
-        def get_dist(p1, p2):
-            R = 6371  # Earth radius in km
-            lat1, lon1 = math.radians(p1["lat"]), math.radians(p1["lng"])
-            lat2, lon2 = math.radians(p2["lat"]), math.radians(p2["lng"])
-            x = (lon2 - lon1) * math.cos((lat1 + lat2) / 2)
-            y = lat2 - lat1
-            return R * math.sqrt(x*x + y*y)
-
-        # 1. Start North
-        day_places_unsorted.sort(key=lambda x: x["lat"], reverse=True)
-        current = day_places_unsorted.pop(0)
-        day_places = [current]
-
-        # 2. Greedy Nearest Neighbor
-        while day_places_unsorted:
-            nearest = min(day_places_unsorted, key=lambda p: get_dist(current, p))
-            day_places.append(nearest)
-            day_places_unsorted.remove(nearest)
-            current = nearest
-
-        # 3. 2-Opt Optimization (Refining the route)
-        # Swaps edges to remove crossings
-        def optimize_2opt(route):
-            best_route = route
-            # Calculate total distance of a route
-            def route_dist(r):
-                d = 0
-                for i in range(len(r)-1):
-                    d += get_dist(r[i], r[i+1])
-                return d
-            
-            improved = True
-            best_dist = route_dist(route)
-            
-            # Limit iterations for performance
-            for _ in range(50): 
-                improved = False
-                for i in range(1, len(route) - 2):
-                    for j in range(i + 1, len(route)):
-                        if j - i == 1: continue
-                        
-                        # New route with swapped segment
-                        new_route = route[:]
-                        new_route[i:j] = route[j-1:i-1:-1] # Reverse segment
-                        
-                        new_dist = route_dist(new_route)
-                        if new_dist < best_dist:
-                            best_route = new_route
-                            best_dist = new_dist
-                            improved = True
-                            route = best_route
-                if not improved:
-                    break
-            return best_route
+    def flush(self):
+        """Write everything currently buffered (blocking)."""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self._write(batch)
 
-        if len(day_places) > 3:
-            day_places = optimize_2opt(day_places)
+    def close(self, timeout: float = 5.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
 
-        logger.info(f"Day {d+1} Optimized: {[p['name'] for p in day_places]}")
 
-        # Route Generation
-        route = []
-        instructions = []
-        
+trip_writer = TripWriter(TRIP_BUFFER_SIZE, TRIP_FLUSH_BATCH, TRIP_FLUSH_INTERVAL)
+atexit.register(trip_writer.close)
+register_gauge("trip_buffer_depth", "Trips waiting in the write-behind buffer.", trip_writer.queue.qsize)
+
+# --------------------------------------------------
+# Traffic Capture
+# --------------------------------------------------
+
+# When set, every /api/db-route request is appended to this NDJSON file
+# for benchmarks/replay.py.  Only itinerary parameters are kept: no user,
+# session, IP or headers, and coordinates are rounded to ~1 km.
+CAPTURE_TRAFFIC_PATH = os.environ.get("CAPTURE_TRAFFIC_PATH")
+CAPTURE_FIELDS = ("city", "days", "lazy", "record", "radius_km", "lat", "lng")
+_capture_lock = threading.Lock()
+
+
+def capture_request(endpoint: str, data):
+    if not CAPTURE_TRAFFIC_PATH or not isinstance(data, dict):
+        return
+    params = {k: data[k] for k in CAPTURE_FIELDS if k in data}
+    for k in ("lat", "lng"):
+        if isinstance(params.get(k), (int, float)):
+            params[k] = round(params[k], 2)
+    line = json.dumps({"ts": round(time.time(), 3), "endpoint": endpoint, "params": params}, separators=(",", ":"))
+    try:
+        with _capture_lock, open(CAPTURE_TRAFFIC_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logger.error(f"Traffic capture failed: {e}")
+
+
+# --------------------------------------------------
+# Itinerary Request Coalescing
+# --------------------------------------------------
+
+ITINERARY_COALESCE_TIMEOUT = float(os.environ.get("ITINERARY_COALESCE_TIMEOUT", 60))
+itinerary_flight = SingleFlight("itinerary")
+
+
+def coalesced_itinerary(city_name, days, radius_km=None, center=None, with_routes=True):
+    """
+    generate_procedural_itinerary, shared between identical concurrent
+    requests.  The returned dict is shared too and must not be mutated.
+    Only the leader takes a routing budget (and so a routing slot):
+    requests waiting on its result do no routing of their own.
+    """
+    def generate():
+        with routing_budget(needed=with_routes) as budget:
+            return generate_procedural_itinerary(city_name, days, radius_km=radius_km, center=center,
+                                                 with_routes=with_routes, budget=budget)
+
+    key = (city_name.strip().lower(), days, radius_km, center, with_routes)
+    return itinerary_flight.do(key, generate, timeout=ITINERARY_COALESCE_TIMEOUT)
+
+
+# --------------------------------------------------
+# On-Demand Request Profiling (Admins)
+# --------------------------------------------------
+
+PROFILE_DIR = os.path.join(INSTANCE_DIR, "profiles")
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 50))
+PROFILE_MAX_BYTES = int(os.environ.get("PROFILE_MAX_BYTES", 50 * 1024 * 1024))
+PROFILE_NAME_RE = re.compile(r"^[\w.-]+$")
+
+
+def profile_if_requested(func):
+    """
+    Decorator: run the view under cProfile when an admin sends
+    "X-Profile: 1" or "?profile=1".  Without the switch the only cost is
+    two dictionary lookups; the admin check happens only when it is set.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not (request.headers.get("X-Profile") or request.args.get("profile")):
+            return func(*args, **kwargs)
+        user = db.session.get(User, session.get("user_id")) if session.get("user_id") else None
+        if not user or not user.is_admin:
+            return func(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        response = profiler.runcall(func, *args, **kwargs)
+        elapsed = time.perf_counter() - started
+
         try:
-             # Pass city lat/lng to route calculator
-             route, instructions = calculate_route(day_places, city.name, city.lat, city.lng)
+            name = save_profile(profiler, elapsed)
+            response = app.make_response(response)
+            response.headers["X-Profile-Id"] = name
         except Exception as e:
-             logger.error(f"Error calculating route for day {d+1}: {e}")
-
-        # Fallback if routing completely failed (e.g. graph load error)
-        if not route and len(day_places) > 1:
-            route = [[p["lat"], p["lng"]] for p in day_places]
-            instructions = [f"Visit {p['name']}" for p in day_places]
-
-        itinerary.append({
-            "day": f"Day {d+1}",
-            "places": day_places,
-            "route": route,
-            "instructions": instructions
+            logger.error(f"❌ Failed to save profile: {e}")
+        return response
+    return wrapper
+
+
+def save_profile(profiler: "cProfile.Profile", elapsed: float) -> str:
+    """Store <name>.prof (raw pstats) and <name>.txt (summary); returns name."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    params = request.get_json(silent=True) or request.args
+    label = re.sub(r"[^\w-]+", "-", f"{params.get('city', 'unknown')}-{params.get('days', '')}d").strip("-")
+    name = f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}-{label}"
+
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}.prof"))
+
+    out = io.StringIO()
+    out.write(f"{request.method} {request.full_path}\n")
+    out.write(f"Params: {dict(params)}\nWall time: {elapsed * 1000:.1f} ms\n\n")
+    stats = pstats.Stats(profiler, stream=out).strip_dirs()
+    out.write("=== Top functions by cumulative time ===\n")
+    stats.sort_stats("cumulative").print_stats(30)
+    out.write("=== Top functions by own time ===\n")
+    stats.sort_stats("tottime").print_stats(20)
+    out.write("=== Call tree (callees of the top cumulative functions) ===\n")
+    stats.sort_stats("cumulative").print_callees(15)
+    with open(os.path.join(PROFILE_DIR, f"{name}.txt"), "w", encoding="utf-8") as f:
+        f.write(out.getvalue())
+
+    prune_profiles()
+    logger.info(f"📈 Saved request profile {name} ({elapsed * 1000:.1f} ms).")
+    return name
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """Stored profiles, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in os.listdir(PROFILE_DIR):
+        if not filename.endswith(".txt"):
+            continue
+        name = filename[:-4]
+        paths = [os.path.join(PROFILE_DIR, f"{name}{ext}") for ext in (".txt", ".prof")]
+        profiles.append({
+            "name": name,
+            "bytes": sum(os.path.getsize(p) for p in paths if os.path.exists(p)),
+            "modified": os.path.getmtime(paths[0]),
         })
+    profiles.sort(key=lambda p: p["name"], reverse=True)
+    return profiles
 
 
+def prune_profiles():
+    """Keep the store within PROFILE_MAX_FILES profiles and PROFILE_MAX_BYTES."""
+    profiles = list_profiles()
+    total = sum(p["bytes"] for p in profiles)
+    while profiles and (len(profiles) > PROFILE_MAX_FILES or total > PROFILE_MAX_BYTES):
+        oldest = profiles.pop()
+        total -= oldest["bytes"]
+        for ext in (".txt", ".prof"):
+            path = os.path.join(PROFILE_DIR, f"{oldest['name']}{ext}")
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# --------------------------------------------------
+# Metrics Endpoint
+# --------------------------------------------------
+
+# Scrapers send "Authorization: Bearer <METRICS_TOKEN>"; without it only a
+# logged-in admin can read /metrics
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+_in_flight_lock = threading.Lock()
+_in_flight_requests = 0
+
+
+@app.before_request
+def _count_request_start():
+    global _in_flight_requests
+    with _in_flight_lock:
+        _in_flight_requests += 1
+
+
+@app.teardown_request
+def _count_request_end(exc=None):
+    global _in_flight_requests
+    with _in_flight_lock:
+        _in_flight_requests -= 1
+
+
+register_gauge("http_requests_in_flight", "Requests currently being handled by this process.", lambda: _in_flight_requests)
+register_gauge("graph_cache_cities", "City road graphs held in memory.", lambda: len(GRAPH_CACHE))
+register_gauge("day_route_cache_entries", "Day geometries held in the LRU.", lambda: len(DAY_ROUTE_CACHE))
+register_gauge("spatial_index_cities", "Cities with a built spatial index.", lambda: len(SPATIAL_INDEX))
+for _stat in ("leaders", "coalesced", "timeouts", "errors"):
+    register_counter(
+        f"itinerary_singleflight_{_stat}_total", f"Itinerary single-flight {_stat} since start.",
+        lambda _stat=_stat: itinerary_flight.stats[_stat]
+    )
+    register_counter(
+        f"graph_singleflight_{_stat}_total", f"Graph load single-flight {_stat} since start.",
+        lambda _stat=_stat: graph_flight.stats[_stat]
+    )
+
+
+@app.route("/metrics")
+def metrics():
+    # Internal cache and graph state: for the scraper (bearer token) or admins
+    token_ok = METRICS_TOKEN and request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+    if not token_ok and not session_is_admin():
+        return "Unauthorized", 401
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
 
-    return {
-        "city": {
-            "name": city.name,
-            "lat": city.lat,
-            "lng": city.lng
-        },
-        "days": itinerary
-    }
 
 # --------------------------------------------------
 # Routes
@@ -789,14 +4462,25 @@ def logout():
 def planner():
     return render_template("index.html")
 
+HISTORY_PAGE_SIZE = 10
+
 @app.route("/history")
 @login_required
 def history():
-    trips = Trip.query.filter_by(user_id=session.get("user_id")) \
-                .order_by(Trip.id.desc()) \
-                .limit(10) \
-                .all()
-    return render_template("history.html", trips=trips)
+    try:
+        after = decode_cursor(request.args.get("after"), (int,))
+        before = decode_cursor(request.args.get("before"), (int,))
+    except ValueError:
+        return "Invalid page cursor", 400
+    trips, has_newer, has_older = keyset_page(
+        Trip.query.filter_by(user_id=session.get("user_id")),
+        [Trip.id], HISTORY_PAGE_SIZE, after=after, before=before, descending=True
+    )
+    return render_template(
+        "history.html", trips=trips,
+        newer_cursor=encode_cursor([trips[0].id]) if trips and has_newer else None,
+        older_cursor=encode_cursor([trips[-1].id]) if trips and has_older else None
+    )
 
 @app.route("/api/delete-trip/<int:trip_id>", methods=["DELETE"])
 @login_required
@@ -814,13 +4498,388 @@ def delete_trip(trip_id):
         logger.error(f"Error deleting trip {trip_id}: {e}")
         return jsonify({"status": "error", "message": "Server error"}), 500
 
+@app.route("/api/trips/<int:trip_id>/itinerary")
+@login_required
+def trip_itinerary(trip_id):
+    """Read-only replay of a stored trip: returns its snapshot, no recomputation."""
+    trip = db.session.get(Trip, trip_id)
+    if not trip or trip.user_id != session.get("user_id"):
+        return jsonify({"status": "error", "message": "Trip not found or unauthorized"}), 404
+    if not trip.snapshot_digest:
+        return jsonify({"status": "error", "message": "No snapshot stored for this trip"}), 404
+
+    etag = representation_etag(trip.snapshot_digest)
+    if request.if_none_match.contains_weak(etag):
+        return "", 304
+
+    snapshot = db.session.get(ItinerarySnapshot, trip.snapshot_digest)
+    if not snapshot:
+        return jsonify({"status": "error", "message": "No snapshot stored for this trip"}), 404
+
+    itinerary = decode_snapshot(snapshot.data)
+    response = api_response({
+        "status": "success",
+        "trip": {"id": trip.id, "city": trip.city, "days": trip.days},
+        "city": itinerary["city"],
+        "days": itinerary["days"]
+    })
+    # Snapshots are immutable, so the digest is a strong validator.
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
+
+@app.route("/api/sites/near")
+@login_required
+def sites_near():
+    """
+    Sites near a point, nearest first.
+      ?lat=&lng=&radius_km=        radius search (default 2 km)
+      ?bbox=minLat,minLng,maxLat,maxLng  bounding-box search
+    Optional: city (default: every city), limit (default 50, max 500).
+    """
+    lat = request.args.get("lat", type=float)
+    lng = request.args.get("lng", type=float)
+    radius_km = request.args.get("radius_km", 2.0, type=float)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    city_name = request.args.get("city", "").strip().lower()
+
+    bbox = None
+    if request.args.get("bbox"):
+        try:
+            bbox = [float(v) for v in request.args["bbox"].split(",")]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            return jsonify({"status": "error", "message": "bbox must be minLat,minLng,maxLat,maxLng"}), 400
+    elif lat is None or lng is None:
+        return jsonify({"status": "error", "message": "lat and lng (or bbox) required"}), 400
+    elif radius_km <= 0:
+        return jsonify({"status": "error", "message": "radius_km must be positive"}), 400
+
+    query = City.query
+    if city_name:
+        query = query.filter(db.func.lower(City.name) == city_name)
+    cities = query.all()
+    if city_name and not cities:
+        return jsonify({"status": "error", "message": "City not found"}), 404
+
+    results = []
+    for city in cities:
+        index = get_spatial_index(city.id, city.version)
+        if bbox:
+            matches = index.within_bbox(*bbox, lat=lat, lng=lng, limit=limit)
+        else:
+            matches = index.within_radius(lat, lng, radius_km, limit=limit)
+        for site, distance in matches:
+            site["city"] = city.name
+            site["distance_km"] = round(distance, 4)
+            results.append(site)
+
+    results.sort(key=lambda s: s["distance_km"])
+    results = results[:limit]
+    return jsonify({"status": "success", "count": len(results), "sites": results})
+
+@app.route("/api/autocomplete")
+@login_required
+def autocomplete_api():
+    """
+    City and site names matching what has been typed so far.
+      ?q=                  the text typed (required)
+    Optional: type (city or site; default both), city_id (that city and
+    its sites only), limit (default 10, max 50).
+    """
+    query = request.args.get("q", "").strip()
+    kind = request.args.get("type") or None
+    city_id = request.args.get("city_id", type=int)
+    limit = min(max(request.args.get("limit", AUTOCOMPLETE_LIMIT, type=int), 1), AUTOCOMPLETE_MAX_LIMIT)
+    if not query:
+        return jsonify({"status": "error", "message": "q required"}), 400
+    if kind not in (None, "city", "site"):
+        return jsonify({"status": "error", "message": "type must be city or site"}), 400
+
+    started = time.perf_counter()
+    results = autocomplete(query, limit, kind, city_id)
+    # Trigram matching ran unless prefix matches alone filled the request
+    fuzzy = len(normalize_search_text(query)) >= AUTOCOMPLETE_FUZZY_MIN_CHARS and (
+        len(results) < limit or results[-1]["match"] == "fuzzy"
+    )
+    AUTOCOMPLETE_SECONDS.observe("fuzzy" if fuzzy else "prefix", time.perf_counter() - started)
+    return jsonify({"status": "success", "query": query, "count": len(results), "results": results})
+
+# Bump when a change to the generator alters its output for the same data,
+# so previously issued ETags stop matching.
+ITINERARY_ENGINE_VERSION = 3
+
+
+def parse_itinerary_params(data) -> Tuple[str, int, float, Tuple[float, float]]:
+    """
+    (city, days, radius_km, center) from a JSON body or query args.
+    radius_km/center are the optional candidate filter: only sites within
+    radius_km of lat/lng (or of the city centre).
+    """
+    city = (data.get("city") or "").strip()
+    days = int(data.get("days", 3))
+    radius_km = data.get("radius_km")
+    radius_km = float(radius_km) if radius_km not in (None, "") else None
+    center = None
+    if data.get("lat") not in (None, "") and data.get("lng") not in (None, ""):
+        center = (float(data["lat"]), float(data["lng"]))
+    return city, days, radius_km, center
+
+
+def parse_flag(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+def catalog_url(city: Dict[str, Any]) -> str:
+    return f"/api/cities/{city['id']}/catalog?v={city['version']}"
+
+
+def itinerary_payload(itinerary: Dict[str, Any], compact: bool = False) -> Dict[str, Any]:
+    """
+    Response body for an itinerary.  compact=True drops each day's full
+    place dicts: clients join site_ids against the (long-cached) city
+    catalog at catalog_url instead.
+    """
+    if not compact:
+        payload = {"status": "success", "city": itinerary["city"], "days": itinerary["days"]}
+    else:
+        payload = {
+            "status": "success",
+            "city": {**itinerary["city"], "catalog_url": catalog_url(itinerary["city"])},
+            "days": [{k: v for k, v in day.items() if k != "places"} for day in itinerary["days"]],
+        }
+    if itinerary.get("partial"):
+        payload["partial"] = True
+        payload["degraded"] = itinerary["degraded"]
+    return payload
+
+
+def itinerary_etag(city: "City", days: int, radius_km: float = None, center=None, lazy: bool = False,
+                   compact: bool = False) -> str:
+    """Strong validator: the output is deterministic for these inputs."""
+    # Routes, and the day route URLs of lazy itineraries, follow road builds
+    key = (f"{ITINERARY_ENGINE_VERSION}:{city.id}:{city.version}:{days}:{radius_km}:{center}:{lazy}:{compact}:"
+           f"{geometry_version(city)}")
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+@app.route("/api/itinerary")
+@login_required
+@profile_if_requested
+def get_itinerary():
+    """
+    Cacheable GET form of /api/db-route (does not record a trip).
+    Answers 304 when If-None-Match carries the current ETag, before any
+    itinerary work is done.
+    """
+    try:
+        city_name, days, radius_km, center = parse_itinerary_params(request.args)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid parameters"}), 400
+    if not city_name:
+        return jsonify({"status": "error", "message": "City required"}), 400
+
+    city = City.query.filter(db.func.lower(City.name) == city_name.lower()).first()
+    if not city:
+        return jsonify({"status": "error", "message": "No data found for this city"}), 404
+
+    lazy = parse_flag(request.args.get("lazy"))
+    compact = parse_flag(request.args.get("compact"))
+    etag = representation_etag(itinerary_etag(city, days, radius_km, center, lazy, compact))
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.vary.add("Accept")
+    else:
+        try:
+            itinerary = coalesced_itinerary(city_name, days, radius_km=radius_km, center=center,
+                                            with_routes=not lazy)
+        except SingleFlightTimeout:
+            return jsonify({"status": "error", "message": "Itinerary is still being generated, please retry"}), 503
+        if not itinerary:
+            return jsonify({"status": "error", "message": "No data found for this city"}), 404
+        response = api_response(itinerary_payload(itinerary, compact))
+        if itinerary.get("partial"):
+            # Not what the ETag stands for: never reuse it
+            response.headers["Cache-Control"] = "no-store"
+            return response
+        # Generating may have loaded a graph: tag what was actually served
+        etag = representation_etag(itinerary_etag(city, days, radius_km, center, lazy, compact))
+    response.set_etag(etag)
+    # Per-user (login required) and must be revalidated, which is cheap
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+@app.route("/api/cities/<int:city_id>/catalog")
+@login_required
+def city_catalog(city_id):
+    """
+    Every site of a city, for joining against compact itineraries.  The
+    versioned URL (?v=<city version>) is cached as immutable; the content
+    only changes when the city's version does.
+    """
+    city = db.session.get(City, city_id)
+    if not city:
+        return jsonify({"status": "error", "message": "City not found"}), 404
+
+    etag = representation_etag(hashlib.sha256(f"catalog:{city.id}:{city.version}".encode("utf-8")).hexdigest()[:32])
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.vary.add("Accept")
+    else:
+        response = api_response({
+            "status": "success",
+            "city": {"id": city.id, "name": city.name, "lat": city.lat, "lng": city.lng, "version": city.version},
+            "sites": get_spatial_index(city.id, city.version).sites,
+        })
+
+    response.set_etag(etag)
+    if request.args.get("v", type=int) == city.version:
+        response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@app.route("/api/cities/<int:city_id>/changes")
+@login_required
+def city_changes(city_id):
+    """
+    ?since=<version>: what changed in the city's catalog since then, for
+    clients keeping derived data up to date.  "complete": false means the
+    log does not reach back that far, so reload everything.
+    """
+    city = db.session.get(City, city_id)
+    if not city:
+        return jsonify({"status": "error", "message": "City not found"}), 404
+    since = request.args.get("since", type=int)
+    if since is None or since < 0:
+        return jsonify({"status": "error", "message": "since must be a dataset version"}), 400
+
+    changes = catalog_changes(city.id, since, city.version)
+    return jsonify({
+        "status": "success",
+        "city_id": city.id,
+        "since": since,
+        "version": city.version,
+        "complete": changes is not None,
+        "changes": changes or [],
+    })
+
+
+@app.route("/api/cities/<int:city_id>/day-route")
+@login_required
+def day_route(city_id):
+    """
+    Road geometry for one day of an itinerary, in visiting order.
+      ?sites=3,7,1   site ids in order
+      ?v=            day_route_version() the ids were planned against
+      ?format=       coords (default) | geojson | polyline
+    """
+    city = db.session.get(City, city_id)
+    if not city:
+        return jsonify({"status": "error", "message": "City not found"}), 404
+    try:
+        site_ids = [int(v) for v in request.args.get("sites", "").split(",") if v.strip()]
+    except ValueError:
+        site_ids = []
+    if not site_ids:
+        return jsonify({"status": "error", "message": "sites required"}), 400
+    fmt = request.args.get("format", "coords")
+    if fmt not in ("coords", "geojson", "polyline"):
+        return jsonify({"status": "error", "message": "format must be coords, geojson or polyline"}), 400
+
+    version = day_route_version(city)
+    etag = representation_etag(hashlib.sha256(
+        f"{ITINERARY_ENGINE_VERSION}:{city.id}:{version}:{fmt}:{site_ids}".encode("utf-8")
+    ).hexdigest()[:32])
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.vary.add("Accept")
+    else:
+        with routing_budget() as budget:
+            result = get_day_route(city, site_ids, budget)
+        if result is None:
+            return jsonify({"status": "error", "message": "Unknown site for this city"}), 404
+        route, instructions, distance_km = result
+
+        payload = {"status": "success", "distance_km": distance_km, "instructions": instructions}
+        if budget.partial:
+            payload["partial"] = True
+            payload["degraded"] = dict(budget.degraded)
+        if fmt == "geojson":
+            payload["geometry"] = {"type": "LineString", "coordinates": [[lng, lat] for lat, lng in route]}
+        elif fmt == "polyline":
+            payload["polyline"] = encode_polyline(route)
+        else:
+            payload["route"] = route
+        response = api_response(payload)
+        if budget.partial:
+            # The client asks again for the full route later
+            response.headers["Cache-Control"] = "no-store"
+            return response
+
+    response.set_etag(etag)
+    if request.args.get("v") == version:
+        # Versioned URL: its content cannot change
+        response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@app.route("/api/itinerary/replan", methods=["POST"])
+@login_required
+def replan():
+    """
+    Body: {"city", "plan": [[site ids], ...], "pinned": [site ids],
+    "version", "edits": [{"op": ...}, ...], "lazy"}.  Returns the new plan
+    and, per day, either the full day or {"changed": false, "from": old
+    index} for days that did not change.
+    """
+    data = request.get_json(silent=True) or {}
+    city_name = (data.get("city") or "").strip()
+    plan = data.get("plan")
+    edits = data.get("edits") or []
+    if not city_name:
+        return jsonify({"status": "error", "message": "City required"}), 400
+    if not isinstance(plan, list) or not all(isinstance(day, list) for day in plan):
+        return jsonify({"status": "error", "message": "plan must be a list of site id lists"}), 400
+    if not isinstance(edits, list) or len(edits) > REPLAN_MAX_EDITS:
+        return jsonify({"status": "error", "message": f"edits must be a list of at most {REPLAN_MAX_EDITS} edits"}), 400
+    if not all(isinstance(edit, dict) for edit in edits):
+        return jsonify({"status": "error", "message": "each edit must be an object"}), 400
+
+    city = City.query.filter(db.func.lower(City.name) == city_name.lower()).first()
+    if not city:
+        return jsonify({"status": "error", "message": "No data found for this city"}), 404
+
+    lazy = parse_flag(data.get("lazy"))
+    try:
+        with routing_budget(needed=not lazy) as budget:
+            result = replan_itinerary(
+                city, plan, edits, pinned=data.get("pinned"), version=data.get("version"),
+                with_routes=not lazy, budget=budget
+            )
+    except (ReplanError, TypeError, ValueError, KeyError) as e:
+        return jsonify({"status": "error", "message": str(e) or "Invalid edit"}), 400
+
+    if parse_flag(data.get("compact")):
+        result["city"]["catalog_url"] = catalog_url(result["city"])
+        for day in result["days"]:
+            day.pop("places", None)
+    return api_response({"status": "success", **result})
+
 @app.route("/api/db-route", methods=["POST"])
 @login_required
+@profile_if_requested
 def db_route():
     try:
         data = request.get_json()
-        city = data.get("city")
-        days = int(data.get("days", 3))
+        capture_request("/api/db-route", data)
+        city, days, radius_km, center = parse_itinerary_params(data)
 
         if not city:
             return jsonify({"status": "error", "message": "City required"}), 400
@@ -828,7 +4887,14 @@ def db_route():
         # Debug
         logger.info(f"Generating itinerary for {city}, {days} days")
 
-        itinerary = generate_procedural_itinerary(city, days)
+        # lazy=true: day summaries only, geometry fetched per day on demand
+        lazy = parse_flag(data.get("lazy"))
+        try:
+            itinerary = coalesced_itinerary(
+                city, days, radius_km=radius_km, center=center, with_routes=not lazy
+            )
+        except SingleFlightTimeout:
+            return jsonify({"status": "error", "message": "Itinerary is still being generated, please retry"}), 503
         
         if not itinerary:
             return jsonify({"status": "error", "message": "No data found for this city"}), 404
@@ -841,15 +4907,15 @@ def db_route():
             session.clear()
             return jsonify({"status": "error", "message": "User session invalid. Please login again."}), 401
 
-        trip = Trip(city=city, days=days, user_id=user.id)
-        db.session.add(trip)
-        db.session.commit()
+        # Replays of an existing trip pass record=false so viewing history
+        # does not add new history rows.
+        # A partial itinerary is not snapshotted: replays regenerate it.
+        if data.get("record", True):
+            trip_writer.record(city=city, days=days, user_id=user.id,
+                               itinerary=None if itinerary.get("partial") else itinerary)
 
-        return jsonify({
-            "status": "success",
-            "city": itinerary["city"],
-            "days": itinerary["days"]
-        })
+        # compact=true: site ids only, joined client-side with the catalog
+        return api_response(itinerary_payload(itinerary, parse_flag(data.get("compact"))))
 
     except Exception as e:
         logger.error(f"CRITICAL ERROR in db_route: {e}")
@@ -899,6 +4965,8 @@ def register():
 # ADMIN PANEL
 # ===========================================================
 
+ADMIN_PAGE_SIZE = 50
+
 def admin_required(func):
     """Decorator: requires logged-in user with is_admin=True."""
     @wraps(func)
@@ -917,8 +4985,61 @@ def admin_required(func):
 @admin_required
 def admin_dashboard():
     cities = City.query.order_by(City.name).all()
-    total_sites = Site.query.count()
-    return render_template("admin/dashboard.html", cities=cities, total_sites=total_sites)
+    # One GROUP BY instead of lazy-loading every city's sites to count them
+    site_counts = dict(
+        db.session.query(Site.city_id, db.func.count(Site.id)).group_by(Site.city_id).all()
+    )
+    total_sites = sum(site_counts.values())
+    return render_template(
+        "admin/dashboard.html", cities=cities, site_counts=site_counts, total_sites=total_sites,
+        memory=memory_report(deep=request.args.get("deep") == "1")
+    )
+
+
+@app.route("/admin/api/stats")
+@admin_required
+def admin_stats():
+    return jsonify({
+        "status": "success",
+        "itinerary_singleflight": dict(itinerary_flight.stats),
+        "graph_rebuilds": GRAPH_REBUILDS,
+        "shared_cache": {"backend": SHARED_CACHE.backend_name, **SHARED_CACHE.stats},
+        "graphs": {
+            key: {k: m.get(k) for k in ("version", "bbox", "nodes", "edges", "built_at")}
+            for key, m in GRAPH_MANIFESTS.items()
+        }
+    })
+
+
+@app.route("/admin/api/memory")
+@admin_required
+def admin_memory():
+    return jsonify({"status": "success", **memory_report(deep=request.args.get("deep") == "1")})
+
+
+@app.route("/admin/profiles")
+@admin_required
+def admin_profiles():
+    return render_template("admin/profiles.html", profiles=list_profiles(), profile=None, report=None)
+
+
+@app.route("/admin/profiles/<name>")
+@admin_required
+def admin_view_profile(name):
+    path = os.path.join(PROFILE_DIR, f"{name}.txt")
+    if not PROFILE_NAME_RE.match(name) or not os.path.exists(path):
+        abort(404)
+    with open(path, encoding="utf-8") as f:
+        report = f.read()
+    return render_template("admin/profiles.html", profiles=list_profiles(), profile=name, report=report)
+
+
+@app.route("/admin/profiles/<name>/download")
+@admin_required
+def admin_download_profile(name):
+    if not PROFILE_NAME_RE.match(name):
+        abort(404)
+    return send_from_directory(PROFILE_DIR, f"{name}.prof", as_attachment=True)
 
 
 @app.route("/admin/cities/add", methods=["GET", "POST"])
@@ -932,8 +5053,10 @@ def admin_add_city():
             return render_template("admin/city_form.html", error="All fields are required.", city=None)
         if City.query.filter_by(name=name).first():
             return render_template("admin/city_form.html", error=f"City '{name}' already exists.", city=None)
-        db.session.add(City(name=name, lat=lat, lng=lng))
+        city = City(name=name, lat=lat, lng=lng)
+        db.session.add(city)
         db.session.commit()
+        invalidate_city_caches(city.id)
         return redirect(url_for("admin_dashboard"))
     return render_template("admin/city_form.html", city=None, error=None)
 
@@ -949,6 +5072,7 @@ def admin_edit_city(city_id):
         city.lat  = request.form.get("lat",  type=float) or city.lat
         city.lng  = request.form.get("lng",  type=float) or city.lng
         db.session.commit()
+        invalidate_city_caches(city_id)
         return redirect(url_for("admin_dashboard"))
     return render_template("admin/city_form.html", city=city, error=None)
 
@@ -961,6 +5085,7 @@ def admin_delete_city(city_id):
         Site.query.filter_by(city_id=city_id).delete()
         db.session.delete(city)
         db.session.commit()
+        invalidate_city_caches(city_id)
     return redirect(url_for("admin_dashboard"))
 
 
@@ -970,8 +5095,20 @@ def admin_sites(city_id):
     city  = db.session.get(City, city_id)
     if not city:
         return "City not found", 404
-    sites = Site.query.filter_by(city_id=city_id).order_by(Site.name).all()
-    return render_template("admin/sites.html", city=city, sites=sites)
+    try:
+        after = decode_cursor(request.args.get("after"), (str, int))
+        before = decode_cursor(request.args.get("before"), (str, int))
+    except ValueError:
+        return "Invalid page cursor", 400
+    sites, has_prev, has_next = keyset_page(
+        Site.query.filter_by(city_id=city_id),
+        [Site.name, Site.id], ADMIN_PAGE_SIZE, after=after, before=before
+    )
+    return render_template(
+        "admin/sites.html", city=city, sites=sites,
+        prev_cursor=encode_cursor([sites[0].name, sites[0].id]) if sites and has_prev else None,
+        next_cursor=encode_cursor([sites[-1].name, sites[-1].id]) if sites and has_next else None
+    )
 
 
 @app.route("/admin/cities/<int:city_id>/sites/add", methods=["GET", "POST"])
@@ -998,6 +5135,7 @@ def admin_add_site(city_id):
         )
         db.session.add(site)
         db.session.commit()
+        invalidate_city_caches(city_id)
         return redirect(url_for("admin_sites", city_id=city_id))
     return render_template("admin/site_form.html", city=city, site=None, error=None)
 
@@ -1021,6 +5159,7 @@ def admin_edit_site(site_id):
         site.description      = request.form.get("description","").strip() or site.description
         site.image_url        = request.form.get("image_url","").strip() or site.image_url
         db.session.commit()
+        invalidate_city_caches(site.city_id)
         return redirect(url_for("admin_sites", city_id=site.city_id))
     return render_template("admin/site_form.html", city=site.city, site=site, error=None)
 
@@ -1033,11 +5172,46 @@ def admin_delete_site(site_id):
         city_id = site.city_id
         db.session.delete(site)
         db.session.commit()
+        invalidate_city_caches(city_id)
         return redirect(url_for("admin_sites", city_id=city_id))
     return redirect(url_for("admin_dashboard"))
 
 
 
+@app.route("/admin/sites/import", methods=["GET", "POST"])
+@admin_required
+def admin_import_sites():
+    """
+    Bulk import. Accepts either a multipart upload ("file" field) or a raw
+    request body with ?format=csv|json|ndjson, streamed row by row.
+    """
+    cities = City.query.order_by(City.name).all()
+    if request.method == "GET":
+        return render_template("admin/import.html", cities=cities, report=None, error=None)
+
+    upload = request.files.get("file")
+    city_id = request.values.get("city_id", type=int)
+    wants_json = upload is None or request.accept_mimetypes.best == "application/json"
+
+    try:
+        if upload is not None:
+            fmt = detect_import_format(upload.filename, request.values.get("format"))
+            stream = upload.stream
+        else:
+            fmt = detect_import_format(explicit=request.args.get("format"))
+            stream = request.stream
+        if city_id is not None and not db.session.get(City, city_id):
+            raise ValueError("City not found")
+        report = import_sites(stream, fmt, default_city_id=city_id)
+    except ValueError as e:
+        if wants_json:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return render_template("admin/import.html", cities=cities, report=None, error=str(e)), 400
+
+    if wants_json:
+        return jsonify({"status": "success", "report": report})
+    return render_template("admin/import.html", cities=cities, report=report, error=None)
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5050))
     app.run(host="0.0.0.0", port=port, debug=True)
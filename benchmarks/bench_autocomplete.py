@@ -0,0 +1,118 @@
+"""
+Build time, memory and lookup latency of the autocomplete index on a
+synthetic catalog.
+
+    python benchmarks/bench_autocomplete.py [--sites 300000] [--cities 500] [--queries 2000] [--json out.json]
+
+Names are made of random place-name syllables plus common words (Fort,
+Temple...), so the index has the shared prefixes and very common
+trigrams of a real catalog.  After the build 1,000 names are added
+incrementally, as admin writes would, and the lookups then run against
+both.  Queries are prefixes of names (2 to 8 characters, or 1 to 4
+within one city), later words of names, and misspelt names that need
+trigram matching.  Nothing touches the database.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+# Lightweight mode: importing the app must not start graph downloads.
+os.environ.setdefault("RENDER", "true")
+# Importing the app creates and seeds its database: keep that in memory,
+# away from instance/travel.db or whatever DATABASE_URL points at.
+os.environ["DATABASE_URL"] = "sqlite://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import AutocompleteIndex, deep_sizeof  # noqa: E402
+
+SYLLABLES = ["am", "ba", "char", "da", "deva", "ga", "hari", "in", "jal", "ka", "la", "ma", "mo", "na",
+             "pa", "ra", "sa", "shan", "su", "ta", "u", "va", "vi", "ya", "ti", "ko", "ne", "ru", "bha", "dhi"]
+STEMS = ["garh", "pur", "bagh", "mahal", "sagar", "niwas", "kund", "ghat", "vilas", "bhavan", "nagar", "abad"]
+KINDS = ["Fort", "Palace", "Temple", "Museum", "Garden", "Market", "Lake", "Stepwell", "Gate", "Haveli"]
+CATEGORIES = ["Fort", "Palace", "Temple", "Museum", "Garden", "Market", "Lake Palace", "Religious Site"]
+
+
+def place_word(rng: random.Random) -> str:
+    return ("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3))) + rng.choice(STEMS)).title()
+
+
+def synthetic_catalog(sites: int, cities: int, seed: int):
+    rng = random.Random(seed)
+    entries = [("city", c + 1, place_word(rng), c + 1, None) for c in range(cities)]
+    for i in range(sites):
+        words = [place_word(rng) for _ in range(rng.randint(1, 2))] + [rng.choice(KINDS)]
+        entries.append(("site", i + 1, " ".join(words), rng.randint(1, cities), rng.choice(CATEGORIES)))
+    return entries
+
+
+def misspell(name: str, rng: random.Random) -> str:
+    i = rng.randrange(1, len(name) - 1)
+    return name[:i] + name[i + 1:]
+
+
+def time_queries(index, queries, limit: int):
+    samples = []
+    for text, city_id in queries:
+        started = time.perf_counter()
+        index.search(text, limit, city_id=city_id)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "queries": len(samples),
+        "p50_ms": round(statistics.median(samples), 4),
+        "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 4),
+        "max_ms": round(samples[-1], 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", type=int, default=300000)
+    parser.add_argument("--cities", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=2000, help="queries per kind")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    entries = synthetic_catalog(args.sites, args.cities, args.seed)
+    started = time.perf_counter()
+    index = AutocompleteIndex(entries, {})
+    build_s = time.perf_counter() - started
+    size_mb = deep_sizeof(index) / (1024 * 1024)
+
+    started = time.perf_counter()
+    for i in range(1000):
+        index.add(("site", args.sites + i + 1, f"{place_word(rng)} Addition", rng.randint(1, args.cities), "Museum"))
+    add_ms = time.perf_counter() - started  # per add: seconds / 1000 * 1000
+
+    names = [entry[2] for entry in entries[args.cities:]]
+    kinds = {
+        "prefix": [(rng.choice(names)[:rng.randint(2, 8)], None) for _ in range(args.queries)],
+        "prefix_in_city": [(rng.choice(names)[:rng.randint(1, 4)], rng.randint(1, args.cities))
+                           for _ in range(args.queries)],
+        "later_word": [(rng.choice(names).split()[-1][:5], None) for _ in range(args.queries)],
+        "misspelt": [(misspell(rng.choice(names)[:14], rng), None) for _ in range(args.queries)],
+    }
+    results = {kind: time_queries(index, queries, args.limit) for kind, queries in kinds.items()}
+
+    print(f"{len(index):,} names: built in {build_s:.2f}s, ~{size_mb:.0f} MB, "
+          f"{add_ms:.3f} ms per incremental add")
+    print(f"{'queries':<18}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, r in results.items():
+        print(f"{kind:<18}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['max_ms']:>10.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"params": vars(args), "build_s": round(build_s, 3), "size_mb": round(size_mb, 1),
+                       "add_ms": round(add_ms, 4), "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
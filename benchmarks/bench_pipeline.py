@@ -0,0 +1,228 @@
+"""
+Per-stage timings of the itinerary pipeline on synthetic cities.
+
+    python benchmarks/bench_pipeline.py [--sizes 30:900,100:2500,200:6400] [--kind grid]
+                                        [--days 3] [--repeat 5] [--json out.json]
+                                        [--baseline base.json] [--fail-over 25]
+
+Each size is SITES:NODES.  For every size a synthetic city is generated
+(benchmarks/synthetic.py), its road graph written to --cache-dir as
+GraphML and loaded back the way the app loads graph_cache/, then the
+pipeline stages are timed: clustering, day ordering, snapping, path
+search, geometry assembly, the whole route, and serialization.  Nothing
+touches the network or the database.
+
+--baseline compares medians against an earlier --json file; --fail-over
+makes the run exit non-zero if any stage is that many percent slower.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+# Lightweight mode: importing the app must not start graph downloads.
+os.environ.setdefault("RENDER", "true")
+# Importing the app creates and seeds its database: keep that in memory,
+# away from instance/travel.db or whatever DATABASE_URL points at.
+os.environ["DATABASE_URL"] = "sqlite://"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import networkx as nx  # noqa: E402
+import numpy as np  # noqa: E402
+import osmnx as ox  # noqa: E402
+
+from app import (  # noqa: E402
+    app, logger, msgpack, encode_msgpack,
+    cluster_sites, order_day_places, route_on_graph, path_geometry, path_length_km,
+)
+from synthetic import synthetic_graph, synthetic_sites, write_graph  # noqa: E402
+
+STAGES = ["graph_load_disk", "clustering", "day_ordering", "snapping", "shortest_path",
+          "geometry", "route_total", "serialize_json", "serialize_msgpack"]
+
+
+def parse_sizes(text: str):
+    sizes = []
+    for part in text.split(","):
+        sites, nodes = part.split(":")
+        sizes.append((int(sites), int(nodes)))
+    return sizes
+
+
+class Timer:
+    """Accumulates wall time per stage within one repeat."""
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, stage, started):
+        self.totals[stage] = self.totals.get(stage, 0.0) + (time.perf_counter() - started) * 1000
+
+
+def run_once(G, sites, days, timer: Timer):
+    started = time.perf_counter()
+    clusters = cluster_sites(sites, days)
+    timer.add("clustering", started)
+
+    planned = []
+    for cluster in clusters:
+        if not cluster:
+            continue
+        started = time.perf_counter()
+        planned.append(order_day_places(cluster))
+        timer.add("day_ordering", started)
+
+    # The routing stages one by one, as route_on_graph() runs them...
+    for day_places in planned:
+        for o, d in zip(day_places, day_places[1:]):
+            started = time.perf_counter()
+            orig = ox.distance.nearest_nodes(G, o["lng"], o["lat"])
+            dest = ox.distance.nearest_nodes(G, d["lng"], d["lat"])
+            timer.add("snapping", started)
+
+            started = time.perf_counter()
+            path = nx.shortest_path(G, orig, dest, weight="length")
+            timer.add("shortest_path", started)
+
+            started = time.perf_counter()
+            if len(path) > 1:
+                path_geometry(G, path)
+            timer.add("geometry", started)
+
+    # ...and end to end, including the stitching between legs
+    itinerary = []
+    for i, day_places in enumerate(planned):
+        started = time.perf_counter()
+        route, instructions = route_on_graph(G, day_places)
+        timer.add("route_total", started)
+        itinerary.append({
+            "day": f"Day {i + 1}",
+            "places": day_places,
+            "site_ids": [p["id"] for p in day_places],
+            "distance_km": round(path_length_km([[p["lat"], p["lng"]] for p in day_places]), 3),
+            "route": route,
+            "instructions": instructions,
+        })
+
+    payload = {"status": "success", "city": {"name": "Synthetic"}, "days": itinerary}
+    started = time.perf_counter()
+    body = app.json.dumps(payload).encode("utf-8")
+    timer.add("serialize_json", started)
+    if msgpack is not None:
+        started = time.perf_counter()
+        encode_msgpack(payload)
+        timer.add("serialize_msgpack", started)
+    return len(body), sum(len(day["route"]) for day in itinerary)
+
+
+def bench_size(sites_n, nodes_n, args):
+    label = f"{sites_n}:{nodes_n}:{args.kind}"
+    graph_path = os.path.join(args.cache_dir, f"synthetic-{args.kind}-{nodes_n}-{args.span_km:g}km-{args.seed}.graphml")
+    if not os.path.exists(graph_path):
+        write_graph(synthetic_graph(nodes_n, args.kind, args.span_km, args.seed), graph_path)
+
+    started = time.perf_counter()
+    G = ox.load_graphml(graph_path)
+    load_ms = (time.perf_counter() - started) * 1000
+    sites = synthetic_sites(sites_n, args.span_km, args.seed)
+
+    samples = {stage: [] for stage in STAGES}
+    samples["graph_load_disk"].append(load_ms)
+    body_bytes = route_points = 0
+    for _ in range(args.repeat):
+        timer = Timer()
+        body_bytes, route_points = run_once(G, sites, args.days, timer)
+        for stage, total in timer.totals.items():
+            samples[stage].append(total)
+
+    rows = []
+    for stage in STAGES:
+        values = samples[stage]
+        if not values:
+            continue
+        rows.append({
+            "size": label, "sites": sites_n, "nodes": len(G.nodes), "edges": len(G.edges),
+            "stage": stage,
+            "median_ms": round(statistics.median(values), 3),
+            "min_ms": round(min(values), 3),
+            "max_ms": round(max(values), 3),
+        })
+    print(f"{label}: {len(G.nodes):,} nodes, {len(G.edges):,} edges, "
+          f"{route_points:,} route points, {body_bytes:,} JSON bytes", file=sys.stderr)
+    return rows
+
+
+def compare(results, baseline_path, fail_over):
+    with open(baseline_path) as f:
+        baseline = {(r["size"], r["stage"]): r for r in json.load(f)["results"]}
+
+    regressions = []
+    print(f"\n{'size':<22}{'stage':<20}{'base ms':>10}{'now ms':>10}{'change':>10}")
+    for r in results:
+        base = baseline.get((r["size"], r["stage"]))
+        if not base or not base["median_ms"]:
+            continue
+        change = r["median_ms"] / base["median_ms"] - 1
+        flag = ""
+        if fail_over is not None and change * 100 > fail_over:
+            regressions.append(r)
+            flag = "  <-- slower"
+        print(f"{r['size']:<22}{r['stage']:<20}{base['median_ms']:>10.2f}{r['median_ms']:>10.2f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="30:900,100:2500,200:6400", help="comma-separated SITES:NODES")
+    parser.add_argument("--kind", choices=["grid", "random"], default="grid")
+    parser.add_argument("--span-km", type=float, default=20.0)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cache-dir", default=os.path.join(ROOT, "benchmarks", ".synthetic"))
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against results from an earlier --json run")
+    parser.add_argument("--fail-over", type=float, help="exit 1 if a stage is this many %% slower than the baseline")
+    args = parser.parse_args()
+
+    # Per-leg routing logs would dominate the output
+    logger.setLevel(logging.WARNING)
+
+    results = []
+    for sites_n, nodes_n in parse_sizes(args.sizes):
+        results.extend(bench_size(sites_n, nodes_n, args))
+
+    print(f"{'size':<22}{'stage':<20}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for r in results:
+        print(f"{r['size']:<22}{r['stage']:<20}{r['median_ms']:>12.2f}{r['min_ms']:>10.2f}{r['max_ms']:>10.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "params": vars(args),
+                "environment": {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "numpy": np.__version__,
+                    "networkx": nx.__version__,
+                    "osmnx": ox.__version__,
+                },
+                "results": results,
+            }, f, indent=2)
+        print(f"Results written to {args.json}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.fail_over)
+        if regressions:
+            print(f"{len(regressions)} stage(s) regressed by more than {args.fail_over:g}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
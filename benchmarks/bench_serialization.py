@@ -0,0 +1,112 @@
+"""
+Encode time and payload size of an itinerary response per wire format.
+
+    python benchmarks/bench_serialization.py [--days 3] [--points 1500] [--json out.json]
+
+The payload is synthetic (road-like random-walk polylines), so the
+benchmark runs offline and is reproducible for a given --seed.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+# Lightweight mode: importing the app must not start graph downloads.
+os.environ.setdefault("RENDER", "true")
+# Importing the app creates and seeds its database: keep that in memory,
+# away from instance/travel.db or whatever DATABASE_URL points at.
+os.environ["DATABASE_URL"] = "sqlite://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, msgpack, brotli, encode_msgpack, compress_body  # noqa: E402
+
+
+def synthetic_itinerary(days: int, points: int, sites_per_day: int, seed: int):
+    rng = random.Random(seed)
+    itinerary = []
+    for d in range(days):
+        lat, lng = 26.9 + rng.uniform(-0.05, 0.05), 75.8 + rng.uniform(-0.05, 0.05)
+        route = []
+        for _ in range(points):
+            lat += rng.uniform(-0.0004, 0.0004)
+            lng += rng.uniform(-0.0004, 0.0004)
+            route.append([lat, lng])
+        places = [{
+            "id": d * 100 + i,
+            "name": f"Site {d}-{i}",
+            "lat": route[i * points // sites_per_day][0],
+            "lng": route[i * points // sites_per_day][1],
+            "category": "Fort",
+            "opening_time": "9:00 AM",
+            "closing_time": "5:00 PM",
+            "ticket_price": "₹100 (Indian) / ₹500 (Foreigner)",
+            "best_time_to_visit": "Morning",
+            "visit_duration": "2 hours",
+            "description": "A magnificent hilltop fort offering panoramic views and rich history. " * 3,
+            "image_url": "https://upload.wikimedia.org/wikipedia/commons/0/0d/Example.jpg",
+        } for i in range(sites_per_day)]
+        itinerary.append({
+            "day": f"Day {d + 1}",
+            "places": places,
+            "route": route,
+            "instructions": [f"Travel from {a['name']} to {b['name']}" for a, b in zip(places, places[1:])],
+        })
+    return {"status": "success", "city": {"name": "Synthetic", "lat": 26.9, "lng": 75.8}, "days": itinerary}
+
+
+def time_encoder(fn, payload, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn(payload)
+        samples.append((time.perf_counter() - start) * 1000)
+    return body, statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--points", type=int, default=1500, help="route points per day")
+    parser.add_argument("--sites", type=int, default=6, help="sites per day")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    payload = synthetic_itinerary(args.days, args.points, args.sites, args.seed)
+
+    with app.app_context():
+        # Same serializer settings as jsonify() in production
+        to_json = lambda p: app.json.dumps(p).encode("utf-8")  # noqa: E731
+        base = {"json": to_json}
+        if msgpack is not None:
+            base["msgpack"] = encode_msgpack
+
+        results = []
+        for name, encoder in base.items():
+            body, encode_ms = time_encoder(encoder, payload, args.repeat)
+            results.append({"format": name, "encoding": "identity", "bytes": len(body), "encode_ms": encode_ms})
+            encodings = ["gzip"] + (["br"] if brotli is not None else [])
+            for encoding in encodings:
+                compressed, compress_ms = time_encoder(lambda b: compress_body(b, encoding), body, args.repeat)
+                results.append({
+                    "format": name, "encoding": encoding, "bytes": len(compressed),
+                    "encode_ms": encode_ms + compress_ms,
+                })
+
+    baseline = results[0]["bytes"]
+    print(f"{'format':<10}{'encoding':<10}{'bytes':>12}{'vs json':>10}{'encode ms':>12}")
+    for r in results:
+        print(f"{r['format']:<10}{r['encoding']:<10}{r['bytes']:>12,}{r['bytes'] / baseline:>10.1%}{r['encode_ms']:>12.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
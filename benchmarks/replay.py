@@ -0,0 +1,328 @@
+"""
+Replay captured (or synthetic) itinerary traffic against gunicorn and
+report latency percentiles, throughput, error/timeout rates and peak RSS.
+
+    # capture on a running server
+    CAPTURE_TRAFFIC_PATH=traffic.ndjson gunicorn app:app
+
+    # replay it against a local gunicorn started with the given settings
+    python benchmarks/replay.py --capture traffic.ndjson --workers 1 --threads 4 --concurrency 8
+
+    # or a synthetic mix, against a server that is already running
+    python benchmarks/replay.py --synthetic 200 --cities Jaipur,Delhi --url http://localhost:10000 --pid 1234
+
+By default requests are sent as fast as --concurrency allows; --speed N
+keeps the captured inter-arrival times, N times faster.  Unless --url
+is given, gunicorn is started from gunicorn.conf.py with GUNICORN_WORKERS/GUNICORN_THREADS/
+GUNICORN_TIMEOUT set from the arguments, and the RSS of the master plus
+its workers is sampled from /proc throughout the run.  That server gets
+a throwaway SQLite database (seeded at startup), so the load test's
+users and trips never reach the real one; synthetic requests also send
+record=false.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_capture(path: str):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda e: e["ts"])
+    return entries
+
+
+def synthetic_traffic(n: int, cities, max_days: int, lazy_ratio: float, seed: int):
+    rng = random.Random(seed)
+    now = time.time()
+    return [{
+        "ts": now + i * 0.5,
+        "endpoint": "/api/db-route",
+        "params": {
+            "city": rng.choice(cities),
+            "days": rng.randint(1, max_days),
+            "lazy": rng.random() < lazy_ratio,
+            # Load, not history: no Trip row per request
+            "record": False,
+        },
+    } for i in range(n)]
+
+
+# --------------------------------------------------
+# Server and memory sampling
+# --------------------------------------------------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port: int, database_url: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "DATABASE_URL": database_url,
+        "GUNICORN_WORKERS": str(args.workers),
+        "GUNICORN_THREADS": str(args.threads),
+        "GUNICORN_TIMEOUT": str(args.server_timeout),
+        # Replayed requests must not be captured again
+        "CAPTURE_TRAFFIC_PATH": "",
+    })
+    if args.lightweight:
+        env["RENDER"] = "true"
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_until_up(base_url: str, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f"{base_url}/login", timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(0.25)
+    raise SystemExit(f"Server at {base_url} did not come up within {timeout:.0f}s")
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid: int):
+    kids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Field 4 is the parent pid; the command name may contain spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            kids.append(int(entry))
+    return kids
+
+
+class RssSampler(threading.Thread):
+    """Peak summed RSS of a process and its direct children (the gunicorn workers)."""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            total = _rss_kb(self.pid) + sum(_rss_kb(c) for c in _children(self.pid))
+            self.peak_kb = max(self.peak_kb, total)
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+# --------------------------------------------------
+# Load generation
+# --------------------------------------------------
+
+def login(base_url: str):
+    """Register and log in a throwaway user; returns its session cookies."""
+    s = requests.Session()
+    creds = {"email": f"loadtest-{uuid.uuid4().hex[:12]}@example.com", "password": uuid.uuid4().hex}
+    s.post(f"{base_url}/register", data=creds, allow_redirects=False, timeout=30)
+    s.post(f"{base_url}/login", data=creds, allow_redirects=False, timeout=30)
+    if "session" not in s.cookies:
+        raise SystemExit("Could not log in to the server under test")
+    return s.cookies.get_dict()
+
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Nearest rank: the smallest value with at least p% of samples at or below it.
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def replay(base_url: str, entries, cookies, args):
+    local = threading.local()
+    results = []
+    lock = threading.Lock()
+
+    def send(entry):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.cookies.update(cookies)
+        started = time.perf_counter()
+        try:
+            r = local.session.post(f"{base_url}{entry['endpoint']}", json=entry["params"], timeout=args.timeout)
+            outcome = (r.status_code, (time.perf_counter() - started) * 1000, len(r.content))
+        except requests.Timeout:
+            outcome = ("timeout", (time.perf_counter() - started) * 1000, 0)
+        except requests.RequestException:
+            outcome = ("error", (time.perf_counter() - started) * 1000, 0)
+        with lock:
+            results.append(outcome)
+
+    t0 = entries[0]["ts"] if entries else 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for entry in entries:
+            if args.speed:
+                # Open loop: send at the captured offset, scaled by --speed
+                delay = (entry["ts"] - t0) / args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, entry)
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed: float, peak_rss_mb, args):
+    statuses = Counter(str(status) for status, _, _ in results)
+    latencies = sorted(ms for status, ms, _ in results if isinstance(status, int))
+    ok = sum(1 for status, _, _ in results if isinstance(status, int) and status < 400)
+    timeouts = statuses.get("timeout", 0)
+    n = len(results)
+    return {
+        "requests": n,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(n / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "max": round(latencies[-1], 1) if latencies else 0.0,
+        },
+        "error_rate": round((n - ok - timeouts) / n, 4) if n else 0.0,
+        "timeout_rate": round(timeouts / n, 4) if n else 0.0,
+        "statuses": dict(statuses),
+        "peak_rss_mb": peak_rss_mb,
+        "rss_budget_mb": args.budget_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--capture", help="NDJSON written with CAPTURE_TRAFFIC_PATH")
+    source.add_argument("--synthetic", type=int, metavar="N", help="send N synthetic requests instead")
+    parser.add_argument("--cities", default="Jaipur", help="comma-separated cities for --synthetic")
+    parser.add_argument("--max-days", type=int, default=5)
+    parser.add_argument("--lazy-ratio", type=float, default=0.5, help="share of synthetic requests with lazy=true")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--limit", type=int, help="replay at most this many captured requests")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--speed", type=float, default=0, help="keep captured pacing, N times faster (0: no pacing)")
+    parser.add_argument("--timeout", type=float, default=60, help="client timeout per request, seconds")
+    parser.add_argument("--url", help="target an already running server instead of starting gunicorn")
+    parser.add_argument("--pid", type=int, help="with --url: gunicorn master pid to sample RSS from")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--server-timeout", type=int, default=120)
+    parser.add_argument("--lightweight", action="store_true", help="start the server with RENDER=true (straight lines)")
+    parser.add_argument("--budget-mb", type=float, default=512)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    if args.capture:
+        entries = load_capture(args.capture)[:args.limit]
+    else:
+        entries = synthetic_traffic(args.synthetic, [c.strip() for c in args.cities.split(",")],
+                                    args.max_days, args.lazy_ratio, args.seed)
+    if not entries:
+        raise SystemExit("Nothing to replay")
+
+    server = None
+    db_dir = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+        pid = args.pid
+    else:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        db_dir = tempfile.mkdtemp(prefix="replay-db-")
+        server = start_server(args, port, f"sqlite:///{os.path.join(db_dir, 'travel.db')}")
+        pid = server.pid
+
+    sampler = None
+    try:
+        wait_until_up(base_url, timeout=120)
+        if pid:
+            sampler = RssSampler(pid)
+            sampler.start()
+        cookies = login(base_url)
+        results, elapsed = replay(base_url, entries, cookies, args)
+    finally:
+        if sampler:
+            sampler.stop()
+        if server:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if db_dir:
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+    peak_rss_mb = round(sampler.peak_kb / 1024, 1) if sampler else None
+    report = summarize(results, elapsed, peak_rss_mb, args)
+    report["settings"] = {
+        "workers": None if args.url else args.workers,
+        "threads": None if args.url else args.threads,
+        "concurrency": args.concurrency,
+        "speed": args.speed,
+        "source": args.capture or f"synthetic:{args.synthetic}",
+    }
+
+    lat = report["latency_ms"]
+    print(f"requests      {report['requests']} in {report['duration_s']:.1f}s ({report['throughput_rps']:.2f} req/s)")
+    print(f"latency ms    p50 {lat['p50']:.0f}  p95 {lat['p95']:.0f}  p99 {lat['p99']:.0f}  max {lat['max']:.0f}")
+    print(f"errors        {report['error_rate']:.2%}   timeouts {report['timeout_rate']:.2%}   {report['statuses']}")
+    if peak_rss_mb is not None:
+        verdict = "within" if peak_rss_mb <= args.budget_mb else "OVER"
+        print(f"peak RSS      {peak_rss_mb:.1f} MB ({verdict} the {args.budget_mb:g} MB budget)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
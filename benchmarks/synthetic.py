@@ -0,0 +1,148 @@
+"""
+Synthetic cities for offline benchmarks: N sites plus a grid or random
+planar road network, saved as GraphML exactly like graph_cache/.
+
+    python benchmarks/synthetic.py --name bench --sites 500 --nodes 2500 --kind grid --out graph_cache
+
+Everything is derived from --seed, so a given set of arguments always
+produces the same city.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+from typing import Any, Dict, List
+
+import networkx as nx
+import numpy as np
+import osmnx as ox
+from shapely.geometry import LineString
+
+CENTER = (26.9124, 75.7873)
+CATEGORIES = ["Fort", "Palace", "Temple", "Museum", "Garden", "Market", "Lake"]
+VISIT_TIMES = ["Morning", "Afternoon", "Evening", "Any"]
+
+
+def _meters(lat1, lng1, lat2, lng2) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+def bbox_for(span_km: float, center=CENTER):
+    """(south, west, north, east) of a square span_km wide around center."""
+    dlat = span_km / 2 / 111.32
+    dlng = dlat / math.cos(math.radians(center[0]))
+    return center[0] - dlat, center[1] - dlng, center[0] + dlat, center[1] + dlng
+
+
+def synthetic_sites(n: int, span_km: float = 20.0, seed: int = 42) -> List[Dict[str, Any]]:
+    """Site dicts shaped like site_to_dict(), scattered over the city."""
+    rng = random.Random(seed)
+    south, west, north, east = bbox_for(span_km * 0.9)
+    return [{
+        "id": i + 1,
+        "name": f"Synthetic Site {i + 1}",
+        "lat": rng.uniform(south, north),
+        "lng": rng.uniform(west, east),
+        "category": rng.choice(CATEGORIES),
+        "opening_time": "9:00 AM",
+        "closing_time": "6:00 PM",
+        "ticket_price": "₹100",
+        "best_time_to_visit": rng.choice(VISIT_TIMES),
+        "visit_duration": "2 hours",
+        "description": "A synthetic landmark used for benchmarking the itinerary pipeline.",
+        "image_url": None,
+    } for i in range(n)]
+
+
+def synthetic_graph(nodes: int, kind: str = "grid", span_km: float = 20.0, seed: int = 42) -> nx.MultiDiGraph:
+    """
+    An unprojected, osmnx-compatible MultiDiGraph with about `nodes`
+    nodes.  "grid" is a jittered street grid with a few missing blocks;
+    "random" is a Delaunay triangulation of random points.  Every third
+    street carries a curved geometry so both branches of path_geometry()
+    are exercised.
+    """
+    rng = np.random.default_rng(seed)
+    south, west, north, east = bbox_for(span_km)
+
+    if kind == "grid":
+        side = max(2, int(round(math.sqrt(nodes))))
+        ys, xs = np.meshgrid(np.linspace(south, north, side), np.linspace(west, east, side), indexing="ij")
+        jitter = (north - south) / side * 0.2
+        ys = ys + rng.uniform(-jitter, jitter, ys.shape)
+        xs = xs + rng.uniform(-jitter, jitter, xs.shape)
+        points = np.column_stack([ys.ravel(), xs.ravel()])
+        pairs = set()
+        for r in range(side):
+            for c in range(side):
+                i = r * side + c
+                if c + 1 < side:
+                    pairs.add((i, i + 1))
+                if r + 1 < side:
+                    pairs.add((i, i + side))
+        # Knock out ~5% of streets so shortest paths are not trivially Manhattan
+        pairs = {p for p in pairs if rng.random() > 0.05}
+    elif kind == "random":
+        from scipy.spatial import Delaunay
+
+        points = np.column_stack([rng.uniform(south, north, nodes), rng.uniform(west, east, nodes)])
+        pairs = set()
+        for a, b, c in Delaunay(points).simplices:
+            for u, v in ((a, b), (b, c), (a, c)):
+                pairs.add((min(u, v), max(u, v)))
+    else:
+        raise ValueError(f"Unknown graph kind: {kind}")
+
+    G = nx.MultiDiGraph(crs="epsg:4326", created_with="benchmarks/synthetic.py")
+    for i, (lat, lng) in enumerate(points):
+        G.add_node(i, y=float(lat), x=float(lng))
+
+    for osmid, (u, v) in enumerate(sorted(pairs)):
+        (lat_u, lng_u), (lat_v, lng_v) = points[u], points[v]
+        attrs = {"osmid": osmid, "highway": "residential", "oneway": False}
+        if osmid % 3 == 0:
+            # Bend the street through a point just off its midpoint
+            mid_lat = (lat_u + lat_v) / 2 + (lng_v - lng_u) * 0.1
+            mid_lng = (lng_u + lng_v) / 2 - (lat_v - lat_u) * 0.1
+            coords = [(lng_u, lat_u), (mid_lng, mid_lat), (lng_v, lat_v)]
+            length = sum(_meters(a[1], a[0], b[1], b[0]) for a, b in zip(coords, coords[1:]))
+            G.add_edge(u, v, length=length, geometry=LineString(coords), reversed=False, **attrs)
+            G.add_edge(v, u, length=length, geometry=LineString(coords[::-1]), reversed=True, **attrs)
+        else:
+            length = _meters(lat_u, lng_u, lat_v, lng_v)
+            G.add_edge(u, v, length=length, reversed=False, **attrs)
+            G.add_edge(v, u, length=length, reversed=True, **attrs)
+
+    G = ox.utils_graph.get_largest_component(G, strongly=True)
+    for n, degree in G.degree():
+        G.nodes[n]["street_count"] = degree // 2
+    return G
+
+
+def write_graph(G: nx.MultiDiGraph, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    ox.save_graphml(G, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--name", default="synthetic", help="city name; the file is <out>/<name>.graphml")
+    parser.add_argument("--nodes", type=int, default=2500)
+    parser.add_argument("--kind", choices=["grid", "random"], default="grid")
+    parser.add_argument("--span-km", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="graph_cache")
+    args = parser.parse_args()
+
+    G = synthetic_graph(args.nodes, args.kind, args.span_km, args.seed)
+    path = os.path.join(args.out, f"{args.name.lower()}.graphml")
+    write_graph(G, path)
+    print(f"Wrote {path} ({len(G.nodes):,} nodes, {len(G.edges):,} edges)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Precompute road legs between each site and its nearest neighbours, so
+lightweight mode (RENDER=true, no graph in memory) can serve road routes.
+
+    python build_leg_store.py [--city Jaipur ...] [--k 8 | --all-pairs] [--out leg_store]
+
+Needs the road graphs: they are loaded from GRAPH_CACHE_DIR, or downloaded
+if missing or too small for the city's sites (--offline: cached graphs
+only, whatever they cover).  Writes leg_store/<city>/<build>/*.npy and then
+leg_store/<city>/manifest.json, which running servers pick up on their
+next lookup.  Commit or deploy the leg_store/ directory with the app.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+
+os.environ.setdefault("GRAPH_PRELOAD", "false")
+
+import networkx as nx  # noqa: E402
+import numpy as np  # noqa: E402
+import osmnx as ox  # noqa: E402
+from sklearn.neighbors import BallTree  # noqa: E402
+
+import app as A  # noqa: E402
+from app import app, db, City, Site, site_to_dict, get_city_graph, path_geometry, leg_key, haversine  # noqa: E402
+
+# Roads are rarely more than this much longer than the straight line;
+# bounds each Dijkstra search
+DETOUR_FACTOR = 3.0
+KEEP_BUILDS = 2
+
+
+def load_graph(city, places, offline: bool):
+    city_key = city.name.lower()
+    if offline:
+        if not (A.read_graph_manifest(city_key) or os.path.exists(A.graph_cache_path(city_key))):
+            return None
+        return A.graph_flight.do(city_key, lambda: A._load_city_graph(city.name, places, city.lat, city.lng))
+
+    G = get_city_graph(city.name, places=places, city_lat=city.lat, city_lng=city.lng)
+    manifest = A.GRAPH_MANIFESTS.get(city_key)
+    if manifest and not A.graph_covers(manifest, places):
+        # get_city_graph() serves the old graph while it rebuilds; a
+        # build should wait for (or join) the rebuild instead
+        print(f"⏳ {city.name}: graph v{manifest['version']} misses some sites, rebuilding...")
+        G = A.graph_flight.do(
+            f"rebuild:{city_key}",
+            lambda: A._rebuild_city_graph(city.name, places, city.lat, city.lng)
+        )
+    return G
+
+
+def neighbour_pairs(places, k: int, all_pairs: bool):
+    """Directed (i, j) index pairs: every pair, or each site with its k nearest."""
+    n = len(places)
+    if all_pairs or k >= n - 1:
+        return {(i, j) for i in range(n) for j in range(n) if i != j}
+    coords = np.radians([[p["lat"], p["lng"]] for p in places])
+    _, ind = BallTree(coords, metric="haversine").query(coords, k=k + 1)
+    pairs = set()
+    for i, row in enumerate(ind):
+        for j in row:
+            if i != j:
+                pairs.add((i, int(j)))
+                pairs.add((int(j), i))
+    return pairs
+
+
+def compute_legs(G, places, pairs):
+    """{(from_id, to_id): (polyline, metres)} along shortest road paths."""
+    nodes = ox.distance.nearest_nodes(G, X=[p["lng"] for p in places], Y=[p["lat"] for p in places])
+    targets_by_source = {}
+    for i, j in pairs:
+        targets_by_source.setdefault(i, []).append(j)
+
+    legs = {}
+    for i, targets in sorted(targets_by_source.items()):
+        o = places[i]
+        farthest_m = max(haversine(o["lat"], o["lng"], places[j]["lat"], places[j]["lng"]) for j in targets) * 1000
+        dist, paths = nx.single_source_dijkstra(G, nodes[i], cutoff=max(farthest_m * DETOUR_FACTOR, 2000), weight="length")
+        for j in targets:
+            d = places[j]
+            if nodes[j] == nodes[i]:
+                # Both snap to one node: nothing better than a straight line
+                continue
+            if nodes[j] in paths:
+                path, metres = paths[nodes[j]], dist[nodes[j]]
+            else:
+                try:
+                    metres, path = nx.single_source_dijkstra(G, nodes[i], nodes[j], weight="length")
+                except nx.NetworkXNoPath:
+                    continue
+            # Start and end at the sites themselves, like the app's routes
+            polyline = [[o["lat"], o["lng"]]] + path_geometry(G, path) + [[d["lat"], d["lng"]]]
+            legs[(o["id"], d["id"])] = (polyline, metres)
+    return legs
+
+
+def write_store(city, places, legs, out_dir: str, k, graph_version):
+    city_key = city.name.lower()
+    city_dir = os.path.join(out_dir, city_key)
+    build = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    build_dir = os.path.join(city_dir, build)
+    os.makedirs(build_dir, exist_ok=True)
+
+    items = sorted((leg_key(a, b), poly, metres) for (a, b), (poly, metres) in legs.items())
+    keys = np.array([key for key, _, _ in items], dtype=np.int64)
+    lengths = [len(poly) for _, poly, _ in items]
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    coords = np.array([pt for _, poly, _ in items for pt in poly], dtype=np.float32).reshape(-1, 2)
+    distances = np.array([metres for _, _, metres in items], dtype=np.float32)
+    for name, array in (("keys", keys), ("offsets", offsets), ("coords", coords), ("distances", distances)):
+        np.save(os.path.join(build_dir, f"{name}.npy"), array)
+
+    manifest = {
+        "city": city_key,
+        "build": build,
+        "built_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "dataset_version": city.version,
+        "graph_version": graph_version,
+        "k": k,
+        "legs": len(items),
+        "points": len(coords),
+        "sites": {str(p["id"]): [p["lat"], p["lng"]] for p in places},
+    }
+    # The arrays are complete before the manifest that points at them appears
+    tmp_path = os.path.join(city_dir, f"manifest.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(city_dir, "manifest.json"))
+
+    builds = sorted(d for d in os.listdir(city_dir) if os.path.isdir(os.path.join(city_dir, d)))
+    for old in builds[:-KEEP_BUILDS]:
+        shutil.rmtree(os.path.join(city_dir, old), ignore_errors=True)
+    return manifest, sum(a.nbytes for a in (keys, offsets, coords, distances))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--city", action="append", help="City to build (repeatable); default: all")
+    parser.add_argument("--k", type=int, default=8, help="nearest neighbours per site")
+    parser.add_argument("--all-pairs", action="store_true", help="every site pair instead of k nearest")
+    parser.add_argument("--out", default=A.LEG_STORE_DIR)
+    parser.add_argument("--offline", action="store_true", help="use cached graphs only, never download")
+    args = parser.parse_args()
+
+    if not A.ENABLE_ROUTING_GRAPH:
+        print("❌ Road graphs are disabled (RENDER=true); build the leg store where graphs can be loaded.")
+        return 1
+
+    with app.app_context():
+        query = City.query.order_by(City.name)
+        if args.city:
+            query = query.filter(db.func.lower(City.name).in_([c.strip().lower() for c in args.city]))
+        cities = query.all()
+        if not cities:
+            print("❌ No matching cities.")
+            return 1
+
+        for city in cities:
+            places = [site_to_dict(s) for s in Site.query.filter_by(city_id=city.id).order_by(Site.id)
+                      if s.latitude is not None and s.longitude is not None]
+            if len(places) < 2:
+                print(f"⏭  {city.name}: fewer than two sites, skipped.")
+                continue
+            G = load_graph(city, places, args.offline)
+            if G is None:
+                print(f"⏭  {city.name}: no cached graph, skipped.")
+                continue
+            pairs = neighbour_pairs(places, args.k, args.all_pairs)
+            legs = compute_legs(G, places, pairs)
+            graph_version = A.GRAPH_MANIFESTS.get(city.name.lower(), {}).get("version")
+            manifest, nbytes = write_store(city, places, legs, args.out, None if args.all_pairs else args.k, graph_version)
+            print(f"✅ {city.name}: {manifest['legs']} legs of {len(pairs)} pairs, "
+                  f"{manifest['points']:,} points, {nbytes / 1024:.0f} KB -> {args.out}/{city.name.lower()}/{manifest['build']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
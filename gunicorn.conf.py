@@ -6,10 +6,12 @@ bind = f"0.0.0.0:{port}"
 
 # Render Free Tier has 512MB RAM and 0.1 CPU
 # Keep workers at 1 to prevent Out-Of-Memory (OOM) errors.
-workers = 1
+# GUNICORN_WORKERS / GUNICORN_THREADS / GUNICORN_TIMEOUT override these, so
+# benchmarks/replay.py can try other settings against the same budget.
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
 
 # Using threads can handle concurrent requests better in a single worker
-threads = 4
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
 
 # Increase timeout since some initial map rendering/loading can take time
-timeout = 120
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
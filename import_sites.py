@@ -0,0 +1,43 @@
+import argparse
+import sys
+
+from app import app, db, City, detect_import_format, import_sites, SITE_IMPORT_BATCH
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import tourist sites from a CSV, JSON or NDJSON file.")
+    parser.add_argument("path", help="File to import")
+    parser.add_argument("--format", choices=["csv", "json", "ndjson"], help="Defaults to the file extension")
+    parser.add_argument("--city", help="City for rows without a 'city' column")
+    parser.add_argument("--batch-size", type=int, default=SITE_IMPORT_BATCH)
+    args = parser.parse_args()
+
+    with app.app_context():
+        city_id = None
+        if args.city:
+            city = City.query.filter(db.func.lower(City.name) == args.city.strip().lower()).first()
+            if not city:
+                print(f"❌ City '{args.city}' not found in database.")
+                return 1
+            city_id = city.id
+
+        try:
+            fmt = detect_import_format(args.path, args.format)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return 1
+
+        with open(args.path, "rb") as f:
+            report = import_sites(f, fmt, default_city_id=city_id, batch_size=args.batch_size)
+
+    print(f"📄 Processed {report['processed']} row(s).")
+    print(f"✅ Added {report['inserted']}, updated {report['updated']}, unchanged {report['unchanged']}.")
+    if report["failed"]:
+        print(f"❌ {report['failed']} row(s) failed:")
+        for err in report["errors"]:
+            print(f"   row {err['row']}: {err['error']}")
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,12 @@ let routeLayers = [];
 let markers = [];
 let placeMarkerMap = {};
 let isEventListenersSetup = false;
+let currentDays = [];
+let dayFallbackLayers = {};
+let dayRouteRequests = {};
+let currentCity = null;
+let currentPinned = [];
+let siteCatalogs = {};
 
 /* ---------------- INITIALIZATION ---------------- */
 
@@ -15,6 +21,7 @@ document.addEventListener("DOMContentLoaded", () => {
   const urlParams = new URLSearchParams(window.location.search);
   const city = urlParams.get('city');
   const days = urlParams.get('days');
+  const tripId = urlParams.get('trip');
 
   if (city) {
     const cityInput = document.getElementById("priority-input");
@@ -24,7 +31,11 @@ document.addEventListener("DOMContentLoaded", () => {
 
     // Small delay to ensure map is ready
     setTimeout(() => {
-      handleRoute();
+      if (tripId) {
+        replayTrip(tripId, city, parseInt(days) || 3);
+      } else {
+        handleRoute();
+      }
     }, 500);
   }
 });
@@ -85,6 +96,8 @@ function setupEventListeners() {
       toggleItineraryPanel(true); // expand
     });
   }
+
+  setupCityAutocomplete();
 }
 
 /* ---------------- UI LOGIC ---------------- */
@@ -138,6 +151,11 @@ function clearMap() {
   routeLayers = [];
   markers = [];
   placeMarkerMap = {};
+  currentDays = [];
+  dayFallbackLayers = {};
+  dayRouteRequests = {};
+  currentCity = null;
+  currentPinned = [];
   document.getElementById("instruction-list").innerHTML = "";
   document.getElementById("route-instructions").classList.add("hidden");
 
@@ -147,8 +165,98 @@ function clearMap() {
 }
 
 
+// Suggestions for the destination input as the user types. Sites are
+// offered too: picking one fills in the city it is in.
+function setupCityAutocomplete() {
+  const input = document.getElementById("priority-input");
+  const list = document.getElementById("city-suggestions");
+  if (!input || !list) return;
+
+  const cache = new Map();
+  let timer = null;
+  let pending = null;
+
+  const render = (results) => {
+    list.innerHTML = "";
+    const shown = new Set();
+    results.forEach(r => {
+      const value = r.type === "city" ? r.name : r.city;
+      const label = r.type === "city" ? "City" : `${r.name} · ${r.category || "Site"}`;
+      if (!value || shown.has(`${value}|${label}`)) return;
+      shown.add(`${value}|${label}`);
+      const option = document.createElement("option");
+      option.value = value;
+      option.label = label;
+      list.appendChild(option);
+    });
+  };
+
+  input.addEventListener("input", () => {
+    clearTimeout(timer);
+    const q = input.value.trim();
+    if (!q) { list.innerHTML = ""; return; }
+    if (cache.has(q.toLowerCase())) { render(cache.get(q.toLowerCase())); return; }
+    timer = setTimeout(async () => {
+      if (pending) pending.abort();
+      pending = new AbortController();
+      try {
+        const res = await fetch(`/api/autocomplete?q=${encodeURIComponent(q)}&limit=8`, { signal: pending.signal });
+        if (!res.ok) return;
+        const data = await res.json();
+        cache.set(q.toLowerCase(), data.results);
+        if (input.value.trim() === q) render(data.results);
+      } catch (err) {
+        if (err.name !== "AbortError") console.warn("Autocomplete failed", err);
+      }
+    }, 150);
+  });
+}
+
 /* ---------------- ROUTING LOGIC ---------------- */
 
+// Itineraries are large float arrays: ask for MessagePack when the decoder
+// loaded, JSON otherwise. Errors always come back as JSON.
+function apiHeaders(extra = {}) {
+  const accept = window.MessagePack
+    ? "application/msgpack, application/json;q=0.9"
+    : "application/json";
+  return { Accept: accept, ...extra };
+}
+
+async function readApiResponse(res) {
+  const type = res.headers.get("Content-Type") || "";
+  if (type.includes("application/msgpack") && window.MessagePack) {
+    return MessagePack.decode(new Uint8Array(await res.arrayBuffer()));
+  }
+  return res.json();
+}
+
+// Compact itineraries carry only site ids; the places come from the
+// city's catalog, which the browser caches until the city's data changes.
+async function loadCatalog(city) {
+  if (!city || !city.catalog_url) return null;
+  if (siteCatalogs[city.catalog_url]) return siteCatalogs[city.catalog_url];
+  const res = await fetch(city.catalog_url, { headers: apiHeaders() });
+  const data = await readApiResponse(res);
+  if (!res.ok || !data || data.status !== "success") {
+    throw new Error("Could not load the site catalog");
+  }
+  const byId = {};
+  data.sites.forEach(site => { byId[site.id] = site; });
+  siteCatalogs = { [city.catalog_url]: byId };
+  return byId;
+}
+
+async function hydrateDays(city, days) {
+  if (days.every(d => !d || Array.isArray(d.places))) return;
+  const byId = await loadCatalog(city);
+  days.forEach(day => {
+    if (day && !Array.isArray(day.places)) {
+      day.places = (day.site_ids || []).map(id => byId && byId[id]).filter(Boolean);
+    }
+  });
+}
+
 async function handleRoute() {
   const cityInput = document.getElementById("priority-input");
   const daysInput = document.getElementById("days-input");
@@ -167,10 +275,90 @@ async function handleRoute() {
     return;
   }
 
+  // Same city, new day count: re-plan the loaded itinerary instead of
+  // generating a new one
+  if (currentCity && currentCity.name.toLowerCase() === city.toLowerCase() && days !== currentDays.length
+      && currentDays.every(d => Array.isArray(d.site_ids))) {
+    await replanItinerary([{ op: "set_days", days }]);
+    return;
+  }
+
   await fetchDBRoute(city, days);
 }
 
-async function fetchDBRoute(city, days) {
+// Applies edits to the loaded itinerary; only the days they touch come
+// back in full, the rest keep their places and any road geometry loaded.
+async function replanItinerary(edits) {
+  if (!currentCity) return;
+  showLoader();
+  try {
+    const res = await fetch("/api/itinerary/replan", {
+      method: "POST",
+      headers: apiHeaders({ "Content-Type": "application/json" }),
+      body: JSON.stringify({
+        city: currentCity.name,
+        version: currentCity.version,
+        plan: currentDays.map(d => d.site_ids),
+        pinned: currentPinned,
+        edits,
+        lazy: true,
+        compact: true
+      })
+    });
+    const data = await readApiResponse(res);
+    if (!res.ok || !data || data.status !== "success") {
+      showToast((data && data.message) || "Could not update itinerary.", "error");
+      return;
+    }
+
+    await hydrateDays(data.city, data.days.filter(d => d.changed));
+    const previous = currentDays;
+    const days = data.days.map(d => d.changed ? d : { ...previous[d.from], day: d.day });
+    const city = data.city;
+    const pinned = data.pinned;
+
+    clearMap();
+    currentCity = city;
+    currentPinned = pinned;
+    currentDays = days;
+    renderRoutes(days);
+    renderItinerary(days);
+    ensureDayRoute(0);
+  } catch (err) {
+    console.error(err);
+    showToast("Something went wrong. Please check console.", "error");
+  } finally {
+    hideLoader();
+  }
+}
+
+async function replayTrip(tripId, city, days) {
+  // Stored trips replay from their snapshot; older trips without one are
+  // regenerated without being recorded again.
+  showLoader();
+  clearMap();
+
+  try {
+    const res = await fetch(`/api/trips/${encodeURIComponent(tripId)}/itinerary`, {
+      headers: apiHeaders()
+    });
+    if (res.ok) {
+      const data = await readApiResponse(res);
+      if (data && data.status === "success" && Array.isArray(data.days)) {
+        showItinerary(data);
+        return;
+      }
+    }
+  } catch (err) {
+    console.error(err);
+  } finally {
+    hideLoader();
+  }
+
+  await fetchDBRoute(city, days, { record: false });
+}
+
+async function fetchDBRoute(city, days, options = {}) {
   showLoader();
   clearMap(); // Ensure state is clean before we start
 
@@ -184,8 +372,8 @@ async function fetchDBRoute(city, days) {
     console.log("Sending POST request to /api/db-route");
     const res = await fetch("/api/db-route", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ city, days })
+      headers: apiHeaders({ "Content-Type": "application/json" }),
+      body: JSON.stringify({ city, days, lazy: true, compact: true, record: options.record !== false })
     });
 
     console.log("Fetch response received:", res.status, res.url);
@@ -201,27 +389,15 @@ async function fetchDBRoute(city, days) {
       console.error("Server Error Details:", errData);
       throw new Error(`Server error: ${res.status} - ${errData.message || res.statusText}`);
     }
-    const data = await res.json();
+    const data = await readApiResponse(res);
 
     if (!data || data.status !== "success" || !Array.isArray(data.days)) {
       showToast("Could not generate itinerary. Try another city.", "error");
       return;
     }
 
-    showToast(`Itinerary generated for ${data.days.length} days!`, "success");
-
-    // Center map
-    if (data.city && (data.city.lat || data.city.latitude) && (data.city.lng || data.city.longitude)) {
-      const lat = data.city.lat || data.city.latitude;
-      const lng = data.city.lng || data.city.longitude;
-      map.setView([lat, lng], 12);
-    }
-
-    renderRoutes(data.days);
-    renderItinerary(data.days);
-
-    // Open panel if collapsed
-    toggleItineraryPanel(true);
+    await hydrateDays(data.city, data.days);
+    showItinerary(data);
 
   } catch (err) {
     console.error(err);
@@ -231,6 +407,56 @@ async function fetchDBRoute(city, days) {
   }
 }
 
+function showItinerary(data) {
+  showToast(`Itinerary generated for ${data.days.length} days!`, "success");
+
+  // Center map
+  if (data.city && (data.city.lat || data.city.latitude) && (data.city.lng || data.city.longitude)) {
+    const lat = data.city.lat || data.city.latitude;
+    const lng = data.city.lng || data.city.longitude;
+    map.setView([lat, lng], 12);
+  }
+
+  currentDays = data.days;
+  currentCity = data.city || null;
+  currentPinned = [];
+  renderRoutes(data.days);
+  renderItinerary(data.days);
+
+  // Open panel if collapsed
+  toggleItineraryPanel(true);
+
+  // Lazy itineraries: only the first day's road geometry is fetched up front
+  ensureDayRoute(0);
+}
+
+async function ensureDayRoute(dayIdx) {
+  const day = currentDays[dayIdx];
+  if (!day || !day.route_url || Array.isArray(day.route)) return;
+  if (dayRouteRequests[dayIdx]) return dayRouteRequests[dayIdx];
+
+  const days = currentDays;
+  dayRouteRequests[dayIdx] = (async () => {
+    try {
+      const res = await fetch(day.route_url, { headers: apiHeaders() });
+      if (!res.ok) throw new Error(`Day route error: ${res.status}`);
+      const data = await readApiResponse(res);
+      // Ignore responses that arrive after a new itinerary was loaded
+      if (days !== currentDays || !Array.isArray(data.route)) return;
+
+      day.route = data.route;
+      day.instructions = data.instructions;
+      (dayFallbackLayers[dayIdx] || []).forEach(l => map.removeLayer(l));
+      delete dayFallbackLayers[dayIdx];
+      drawDayRoute(day.route, routeColors[dayIdx % routeColors.length]);
+    } catch (err) {
+      console.error(err);
+      delete dayRouteRequests[dayIdx];
+    }
+  })();
+  return dayRouteRequests[dayIdx];
+}
+
 /* ---------------- RENDERING ---------------- */
 
 const routeColors = ["#4f46e5", "#10b981", "#f59e0b", "#ef4444", "#8b5cf6"];
@@ -359,42 +585,10 @@ function renderRoutes(days) {
     }
 
     // Routes (Polylines)
-    if (Array.isArray(day.route) && day.route.length > 0) {
-      // Flatten logic for different route formats
-      let segments = [];
-
-      // Check structure: [[lat,lng],...] vs [[[lat,lng]...],...]
-      if (Array.isArray(day.route[0]) && typeof day.route[0][0] === "number") {
-        segments.push(day.route); // Single segment
-      } else {
-        segments = day.route; // Multiple segments
-      }
-
-      segments.forEach(segment => {
-        if (!Array.isArray(segment) || segment.length < 2) return;
-
-        // Glow/Shadow effect
-        const glowPolyline = L.polyline(segment, {
-          color: color,
-          weight: 10,
-          opacity: 0.3,
-          className: 'route-glow'
-        }).addTo(map).bringToBack();
-        routeLayers.push(glowPolyline);
-
-        const polyline = L.polyline(segment, {
-          color: color,
-          weight: 5,
-          opacity: 1.0,
-          lineCap: 'round',
-          lineJoin: 'round'
-        }).addTo(map);
-        routeLayers.push(polyline);
-
-        anyRouteDrawn = true;
-
-        segment.forEach(pt => allLatLngs.push(pt));
-      });
+    const drawn = drawDayRoute(day.route, color);
+    if (drawn.length > 0) {
+      anyRouteDrawn = true;
+      drawn.forEach(pt => allLatLngs.push(pt));
     }
   });
 
@@ -427,6 +621,8 @@ function renderRoutes(days) {
           lineJoin: 'round'
         }).addTo(map);
         routeLayers.push(fallback);
+        // Replaced by the road geometry once a lazy day's route loads
+        (dayFallbackLayers[dayIdx] = dayFallbackLayers[dayIdx] || []).push(fallback);
         placeLatLngs.forEach(pt => allLatLngs.push(pt));
         anyRouteDrawn = true;
       }
@@ -438,6 +634,47 @@ function renderRoutes(days) {
 }
 
 
+// Draws one day's route; returns every point drawn (for map bounds)
+function drawDayRoute(route, color) {
+  const drawnLatLngs = [];
+  if (!Array.isArray(route) || route.length === 0) return drawnLatLngs;
+
+  // Flatten logic for different route formats
+  let segments = [];
+
+  // Check structure: [[lat,lng],...] vs [[[lat,lng]...],...]
+  if (Array.isArray(route[0]) && typeof route[0][0] === "number") {
+    segments.push(route); // Single segment
+  } else {
+    segments = route; // Multiple segments
+  }
+
+  segments.forEach(segment => {
+    if (!Array.isArray(segment) || segment.length < 2) return;
+
+    // Glow/Shadow effect
+    const glowPolyline = L.polyline(segment, {
+      color: color,
+      weight: 10,
+      opacity: 0.3,
+      className: 'route-glow'
+    }).addTo(map).bringToBack();
+    routeLayers.push(glowPolyline);
+
+    const polyline = L.polyline(segment, {
+      color: color,
+      weight: 5,
+      opacity: 1.0,
+      lineCap: 'round',
+      lineJoin: 'round'
+    }).addTo(map);
+    routeLayers.push(polyline);
+
+    segment.forEach(pt => drawnLatLngs.push(pt));
+  });
+  return drawnLatLngs;
+}
+
 function renderItinerary(days) {
   console.log("Rendering Itinerary...", days);
   const container = document.getElementById("itinerary");
@@ -458,8 +695,11 @@ function renderItinerary(days) {
 
     header.innerHTML = `
         <span style="color: ${dayColor}">${dayLabel}</span>
-        <span class="text-xs text-muted">${day.places.length} stops</span>
+        <span class="text-xs text-muted">${day.places.length} stops${day.distance_km ? ` • ${day.distance_km.toFixed(1)} km` : ''}</span>
     `;
+    // Opening a day loads its road geometry (lazy itineraries)
+    header.style.cursor = "pointer";
+    header.addEventListener("click", () => ensureDayRoute(idx));
     dayCard.appendChild(header);
 
     // Places List
@@ -478,7 +718,10 @@ function renderItinerary(days) {
                   <div class="place-name">${placeIdx + 1}. ${place.name}</div>
                   <div class="place-meta">${place.category || "Sightseeing"} • ${place.visit_duration || place.time_spent || "1h"}</div>
               </div>
-              <button class="btn btn-ghost btn-sm dropdown-trigger" style="padding: 0 8px;"><i class="fa-solid fa-chevron-down"></i></button>
+              <div style="display:flex; align-items:center;">
+                  ${place.id != null ? `<button class="btn btn-ghost btn-sm remove-place" title="Remove from itinerary" style="padding: 0 8px;"><i class="fa-solid fa-xmark"></i></button>` : ''}
+                  <button class="btn btn-ghost btn-sm dropdown-trigger" style="padding: 0 8px;"><i class="fa-solid fa-chevron-down"></i></button>
+              </div>
           </div>
           <div class="place-details hidden" style="font-size: 0.83rem; color: var(--text-muted); margin-top: 8px; padding: 10px; border-radius: 6px; background: rgba(0,0,0,0.03);">
               ${place.image_url ? `<img src="${place.image_url}" alt="${place.name}" style="width: 100%; height: 120px; object-fit: cover; border-radius: 4px; margin-bottom: 8px;">` : ''}
@@ -494,6 +737,14 @@ function renderItinerary(days) {
       const dropdownBtn = item.querySelector('.dropdown-trigger');
       const detailsDiv = item.querySelector('.place-details');
 
+      const removeBtn = item.querySelector('.remove-place');
+      if (removeBtn) {
+          removeBtn.addEventListener("click", (e) => {
+              e.stopPropagation();
+              replanItinerary([{ op: "remove", site_id: place.id }]);
+          });
+      }
+
       dropdownBtn.addEventListener("click", (e) => {
           e.stopPropagation();
           if (detailsDiv.classList.contains("hidden")) {
@@ -554,6 +805,7 @@ function renderItinerary(days) {
 
       // Handle card click to focus map
       headerDiv.addEventListener("click", () => {
+          ensureDayRoute(idx);
           if (marker) {
               if (window.innerWidth < 768) {
                   toggleItineraryPanel(false);